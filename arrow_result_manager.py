@@ -0,0 +1,119 @@
+import importlib
+import importlib.util
+import itertools
+import logging
+import os
+import pandas as pd
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from engine_manager import get_engine
+from execution_manager import SQLExecutionError, backend_slot
+from instrumentation_manager import span
+from utils import get_env_bool, get_env_int
+
+# ADBC drivers fetch query results as Arrow record batches, with no Python object per value
+ADBC_DRIVERS = {"postgresql": "adbc_driver_postgresql.dbapi", "sqlite": "adbc_driver_sqlite.dbapi"}
+
+ARROW_FILE_FORMATS = {".parquet": "parquet", ".arrow": "ipc", ".ipc": "ipc", ".feather": "ipc"}
+
+def import_pyarrow():
+    try:
+        return importlib.import_module("pyarrow")
+    except ImportError:
+        raise ImportError("The Arrow result path needs pyarrow: pip install pyarrow")
+
+def get_adbc_driver(database_url):
+    module_name = ADBC_DRIVERS.get(make_url(database_url).get_backend_name())
+    if module_name is None or not get_env_bool("SQL_ARROW_USE_ADBC", True):
+        return None
+    if importlib.util.find_spec(module_name.split(".")[0]) is None:
+        return None
+    return importlib.import_module(module_name)
+
+def build_adbc_uri(database_url):
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        return url.database or ":memory:"
+    # libpq takes the plain postgresql:// form, without SQLAlchemy's +driver suffix
+    return url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+def iter_adbc_batches(adbc_driver, sql, database_url):
+    with adbc_driver.connect(build_adbc_uri(database_url)) as connection, connection.cursor() as cursor:
+        cursor.execute(sql)
+        yield from cursor.fetch_record_batch()
+
+def iter_sqlalchemy_batches(sql, database_url, chunksize):
+    pa = import_pyarrow()
+    with get_engine(database_url).connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=chunksize)
+        for chunk in pd.read_sql_query(sql, connection, chunksize=chunksize, dtype_backend="pyarrow"):
+            # pyarrow-backed columns already hold Arrow arrays, so the batch shares their buffers
+            yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+def fetch_arrow_batches(sql, database_url, chunksize=None):
+    """Yields the result of sql as Arrow record batches, through ADBC when its driver is installed.
+
+    Without ADBC, the rows are read in chunks of chunksize into pyarrow-backed DataFrames.
+    """
+    import_pyarrow()
+    chunksize = chunksize or get_env_int("SQL_CHUNK_SIZE", 10000)
+    adbc_driver = get_adbc_driver(database_url)
+    try:
+        if adbc_driver is not None:
+            yield from iter_adbc_batches(adbc_driver, sql, database_url)
+        else:
+            yield from iter_sqlalchemy_batches(sql, database_url, chunksize)
+
+    except SQLAlchemyError as e:
+        logging.debug(e.orig)
+        raise SQLExecutionError(e.orig)
+
+    except ImportError:
+        raise
+
+    except Exception as e:
+        logging.debug(e)
+        raise SQLExecutionError(e)
+
+def run_sql_arrow(sql, database_url):
+    # The Arrow counterpart of run_sql: one pyarrow Table over the fetched batches, without copying them
+    pa = import_pyarrow()
+    with span("run_sql", result_format="arrow") as sql_span, backend_slot("database"):
+        batches = list(fetch_arrow_batches(sql, database_url))
+        table = pa.Table.from_batches(batches) if batches else pa.table({})
+        sql_span.set(rows=table.num_rows, bytes=table.nbytes)
+    return table
+
+def dataframe_to_arrow(df):
+    # Zero-copy for pyarrow-backed columns; numpy and object columns are converted
+    return import_pyarrow().Table.from_pandas(df, preserve_index=False)
+
+def get_arrow_file_format(path):
+    file_format = ARROW_FILE_FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise ValueError(f"Cannot tell the Arrow file format of {path}; use one of {', '.join(ARROW_FILE_FORMATS)}")
+    return file_format
+
+def write_arrow_result(result, path):
+    """Writes a Table, a DataFrame or an iterable of record batches to Parquet or Arrow IPC, chosen by extension.
+
+    Batches are written as they arrive, so a streamed result is never held in memory whole. Returns the row count.
+    """
+    pa = import_pyarrow()
+    if isinstance(result, pd.DataFrame):
+        result = dataframe_to_arrow(result)
+    batches = iter(result.to_batches() if isinstance(result, pa.Table) else result)
+    first_batch = next(batches, None)
+    schema = result.schema if isinstance(result, pa.Table) else (first_batch.schema if first_batch else pa.schema([]))
+
+    if get_arrow_file_format(path) == "parquet":
+        parquet = importlib.import_module("pyarrow.parquet")
+        writer = parquet.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    row_count = 0
+    with writer:
+        for batch in itertools.chain([first_batch] if first_batch is not None else [], batches):
+            writer.write_batch(batch)
+            row_count += batch.num_rows
+    return row_count
@@ -0,0 +1,468 @@
+import asyncio
+import logging
+import weakref
+import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
+from global_event_publisher import EventPublisher, get_event_publisher, request_event_scope
+from instrumentation_manager import span, record_completion_usage, record_retry, record_result_cache_hit
+from utils import truncate_content, get_env_int, get_env_str_choice
+from engine_manager import get_async_engine
+from completion_cache_manager import get_completion_cache
+from result_cache_manager import get_result_cache
+from completion_scheduler_manager import get_completion_scheduler, is_retryable
+from database_and_synonym_manager import set_database_connection, get_API_key
+from schema_catalog_manager import get_schema_catalog
+from question_cache_manager import get_question_cache, is_question_cache_enabled
+from sql_validation_manager import check_sql_against_schema, build_explain_sql
+from schema_format_manager import render_schema
+from model_registry_manager import get_stage_model
+from profiling_manager import use_value_hints, add_value_hints
+from speculative_sql_manager import (get_sql_candidate_count, get_candidate_selection, get_candidate_timeout_seconds,
+                                     build_candidate_messages, candidate_completion_options, distinct_sql_queries,
+                                     choose_agreed_candidate)
+from execution_manager import (SQLExecutionError, FallbackBudget, FallbackBudgetExceeded, SQLResultStream,
+                               MAX_SQL_FIX_RETRIES, get_completion_backend, record_completion_call, get_completion_request_timeout,
+                               charge_completion, get_answer_result_budget, build_sql_generation_directive,
+                               build_first_fix_directive, build_next_fix_directive, build_single_pass_repair_directive,
+                               build_error_analysis_directives, parse_error_analysis_sections, get_read_sql_options)
+from data_preparation_manager import (partition_df_for_prompt, parse_index_list, merge_partition_rows,
+                                      INDEX_LIST_REASK_DIRECTIVE, prefilter_schema_rows, build_data_rows_directive,
+                                      build_join_rows_directive, get_join_candidate_rows, use_join_graph,
+                                      identify_join_rows_using_graph, merge_data_and_join_rows)
+
+class RequestContext:
+    """State of one question answered through the async API, so concurrent questions share no mutable globals."""
+
+    def __init__(self, question, database_url, api_key=None, model=None, background_events=False, stage_models=None,
+                 priority=None):
+        self.question = question
+        self.database_url = database_url
+        self.api_key = api_key
+        # "interactive" or "batch"; None takes the priority class of the calling context
+        self.priority = priority
+        # A model for every stage, overridden per stage by stage_models such as {"filter": "gpt-3.5-turbo"}
+        self.model = model
+        self.stage_models = dict(stage_models or {})
+        self.budget = None
+        self.events = {}
+        # Subscribe here before answering to follow this question only
+        self.event_publisher = EventPublisher(parent=get_event_publisher(), background=background_events)
+        self.event_publisher.on("*", self._record_event)
+        self.sql_query = None
+        self.answered_sql_query = None
+        self.answer = None
+
+    def get_model(self, stage):
+        return self.stage_models.get(stage) or self.model or get_stage_model(stage)
+
+    def emit(self, event_name, data):
+        self.event_publisher.emit(event_name, data)
+
+    def _record_event(self, data, event_name):
+        self.events[event_name] = data
+
+# Semaphores belong to the event loop that waits on them, so they are kept per loop
+_backend_semaphores = weakref.WeakKeyDictionary()
+
+def get_backend_concurrency(backend_name):
+    if backend_name == "llm":
+        return get_env_int("ASYNC_LLM_CONCURRENCY", 16)
+    # Waiting here is cheaper than waiting for a pooled connection
+    return get_env_int("ASYNC_DB_CONCURRENCY", get_env_int("DB_POOL_SIZE", 5) + get_env_int("DB_MAX_OVERFLOW", 10))
+
+def get_backend_semaphore(backend_name):
+    semaphores = _backend_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if backend_name not in semaphores:
+        semaphores[backend_name] = asyncio.Semaphore(get_backend_concurrency(backend_name))
+    return semaphores[backend_name]
+
+async def async_create_chat_completion(context, messages, temperature=0, use_cache=True, budget=None, stage="generation"):
+    model = context.get_model(stage)
+    with span("llm_completion", model=model):
+        return await async_create_chat_completion_in_span(context, messages, model, temperature, use_cache, budget)
+
+async def async_create_chat_completion_in_span(context, messages, model, temperature, use_cache, budget):
+    request_timeout = get_completion_request_timeout(messages, budget)
+
+    completion_cache = get_completion_cache()
+    use_cache = use_cache and completion_cache.enabled
+    if use_cache:
+        cache_key = completion_cache.make_key(model, temperature, messages)
+        # The cache may read its SQLite file, so it is used off the event loop
+        response = await asyncio.to_thread(completion_cache.get, cache_key)
+        if response is not None:
+            logging.debug("Completion cache hit.")
+            record_completion_usage(model, cache_hit=True)
+            return response
+
+    async def request():
+        async with get_backend_semaphore("llm"):
+            record_completion_call()
+            return await get_completion_backend().acreate(
+                model=model,
+                temperature=temperature,
+                messages=messages,
+                request_timeout=request_timeout,
+                api_key=context.api_key
+            )
+
+    completion = await get_completion_scheduler().run_async(request, messages, model, priority=context.priority,
+                                                             budget=budget)
+    response = completion.choices[0].message['content']
+    charge_completion(completion, messages, budget)
+    record_completion_usage(model, completion.get("usage"))
+    logging.debug(f"PROMPT: {truncate_content(messages)}")
+    logging.debug(f"RESPONSE: {truncate_content(response)}\n")
+
+    if use_cache:
+        await asyncio.to_thread(completion_cache.set, cache_key, response)
+    return response
+
+async def async_run_sql(sql, database_url, result_budget=None) -> pd.DataFrame:
+    engine = get_async_engine(database_url)
+    try:
+        with span("run_sql") as sql_span:
+            async with get_backend_semaphore(("database", database_url)):
+                async with engine.connect() as connection:
+                    # pandas reads through the sync facade of the async connection
+                    if result_budget is None or not any(result_budget.values()):
+                        sql_answer_df = await connection.run_sync(
+                            lambda sync_connection: pd.read_sql_query(sql, sync_connection, **get_read_sql_options()))
+                    else:
+                        stream = SQLResultStream(sql, database_url, chunksize=get_env_int("SQL_CHUNK_SIZE", 10000),
+                                                 **result_budget)
+                        sql_answer_df = await connection.run_sync(stream.to_dataframe)
+            sql_span.set(rows=len(sql_answer_df), truncated=bool(sql_answer_df.attrs.get("truncated")))
+        return sql_answer_df
+
+    except SQLAlchemyError as e:
+        logging.debug(e.orig)
+        raise SQLExecutionError(e.orig)
+
+    except Exception as e:
+        logging.debug(e)
+        raise SQLExecutionError(e)
+
+async def async_run_cached_sql(sql, database_url, result_budget) -> pd.DataFrame:
+    # The lookup may probe table versions over a sync connection, so the cache is used off the event loop
+    result_cache = get_result_cache()
+    if not result_cache.enabled:
+        return await async_run_sql(sql, database_url, result_budget)
+    sql_answer_df = await asyncio.to_thread(result_cache.get, sql, database_url, result_budget)
+    if sql_answer_df is not None:
+        record_result_cache_hit()
+        return sql_answer_df
+    sql_answer_df = await async_run_sql(sql, database_url, result_budget)
+    await asyncio.to_thread(result_cache.set, sql, database_url, sql_answer_df, result_budget)
+    return sql_answer_df
+
+async def async_run_answer_sql(context, sql) -> pd.DataFrame:
+    sql_answer_df = await async_run_cached_sql(sql, context.database_url, get_answer_result_budget())
+    if sql_answer_df.attrs.get("truncated"):
+        context.emit("answer_truncated_set", len(sql_answer_df))
+    return sql_answer_df
+
+async def async_check_sql_before_execution(context, sql, schema_df):
+    if check_sql_against_schema(sql, schema_df):
+        await async_run_sql(build_explain_sql(sql), context.database_url)
+
+async def async_identify_indices_in_partition(context, df, prompt_directive):
+    with span("identify_partition", rows=len(df)):
+        return await async_identify_indices_in_partition_in_span(context, df, prompt_directive)
+
+async def async_identify_indices_in_partition_in_span(context, df, prompt_directive):
+    conversation = [{"role": "user", "content": prompt_directive + render_schema(df)}]
+    response = await async_create_chat_completion(context, conversation, stage="filter")
+    valid_indices = set(df.index)
+    indices = parse_index_list(response, valid_indices)
+
+    for _ in range(get_env_int("LLM_INDEX_LIST_REASKS", 1)):
+        if indices is not None:
+            break
+        logging.debug(f"Could not parse index list: {truncate_content(response)}. Re-asking this partition.")
+        conversation = conversation + [{"role": "assistant", "content": response},
+                                       {"role": "user", "content": INDEX_LIST_REASK_DIRECTIVE}]
+        response = await async_create_chat_completion(context, conversation, stage="filter")
+        indices = parse_index_list(response, valid_indices)
+
+    if indices is None:
+        logging.debug("Giving up on this partition after re-asking.")
+        return []
+    return indices
+
+async def async_prompt_for_df_from_token_limited_df(context, prompt_directive, token_limited_df):
+    model = context.get_model("filter")
+    partitioned_df_list = await asyncio.to_thread(partition_df_for_prompt, prompt_directive, token_limited_df, model)
+    with span("identify_rows", partitions=len(partitioned_df_list)):
+        indices_list = await asyncio.gather(
+            *(async_identify_indices_in_partition(context, df, prompt_directive) for df in partitioned_df_list))
+    result_df = merge_partition_rows(partitioned_df_list, indices_list)
+    result_df.reset_index(inplace=True)
+    return result_df
+
+async def async_filter_schema_and_synonyms_df(context, schema_and_synonyms_df, schema_index=None, join_graph=None):
+    candidate_df = prefilter_schema_rows(schema_and_synonyms_df, context.question, schema_index)
+
+    schema_and_synonyms_df_filtered_for_data = await async_prompt_for_df_from_token_limited_df(
+        context, build_data_rows_directive(context.question), candidate_df)
+
+    schema_and_synonyms_df_filtered_for_joins = None
+    if use_join_graph(join_graph):
+        with span("join_graph"):
+            schema_and_synonyms_df_filtered_for_joins = identify_join_rows_using_graph(
+                schema_and_synonyms_df, schema_and_synonyms_df_filtered_for_data, join_graph)
+
+    if schema_and_synonyms_df_filtered_for_joins is None:
+        join_candidate_df = get_join_candidate_rows(
+            schema_and_synonyms_df, candidate_df, schema_and_synonyms_df_filtered_for_data)
+        schema_and_synonyms_df_filtered_for_joins = await async_prompt_for_df_from_token_limited_df(
+            context, build_join_rows_directive(schema_and_synonyms_df_filtered_for_data), join_candidate_df)
+
+    schema_and_synonyms_df_for_data_or_joins = merge_data_and_join_rows(
+        schema_and_synonyms_df_filtered_for_data, schema_and_synonyms_df_filtered_for_joins)
+    context.emit("filtered_schema_and_synonyms_set", schema_and_synonyms_df_for_data_or_joins)
+    return schema_and_synonyms_df_for_data_or_joins
+
+async def async_generate_sql_query(context, filtered_schema_and_synonyms_df):
+    prompt = build_sql_generation_directive(context.question) + render_schema(filtered_schema_and_synonyms_df)
+    with span("generate_sql", schema_rows=len(filtered_schema_and_synonyms_df)):
+        sql_query = await async_create_chat_completion(context, [{"role": "user", "content": prompt}])
+    context.sql_query = sql_query
+    context.emit("initial_sql_query_set", sql_query)
+    return sql_query
+
+async def async_generate_sql_candidates(context, filtered_schema_and_synonyms_df, candidate_count):
+    messages = build_candidate_messages(context.question, filtered_schema_and_synonyms_df)
+
+    async def generate(candidate_number):
+        try:
+            return await async_create_chat_completion(context, messages, **candidate_completion_options(candidate_number))
+        except Exception as e:
+            if candidate_number == 0:
+                raise
+            logging.debug(f"Candidate {candidate_number} could not be generated: {e}")
+            return None
+
+    with span("generate_sql", schema_rows=len(filtered_schema_and_synonyms_df), candidates=candidate_count):
+        sql_queries = await asyncio.gather(*(generate(candidate_number) for candidate_number in range(candidate_count)))
+    context.sql_query = sql_queries[0]
+    context.emit("initial_sql_query_set", sql_queries[0])
+    context.emit("sql_candidates_set", sql_queries)
+    return sql_queries
+
+async def async_run_candidate(context, candidate_number, sql_query, schema_df):
+    with span("candidate_sql", candidate=candidate_number):
+        await async_check_sql_before_execution(context, sql_query, schema_df)
+        try:
+            # Cancelling the task cancels the statement through the async driver
+            return await asyncio.wait_for(
+                async_run_cached_sql(sql_query, context.database_url, get_answer_result_budget()),
+                get_candidate_timeout_seconds() or None)
+        except asyncio.TimeoutError:
+            raise SQLExecutionError("Candidate query timed out.")
+
+async def async_execute_sql_candidates(context, sql_queries, schema_df=None):
+    sql_queries = distinct_sql_queries(sql_queries)
+    tasks = {asyncio.create_task(async_run_candidate(context, candidate_number, sql_query, schema_df)): candidate_number
+             for candidate_number, sql_query in enumerate(sql_queries)}
+    successes = []
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    successes.append((tasks[task], sql_queries[tasks[task]], task.result()))
+                except SQLExecutionError as e:
+                    context.emit(f"candidate_exception_{tasks[task]}_set", e.original_exception)
+            if successes and get_candidate_selection() == "first":
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if not successes:
+        return None
+    candidate_number, sql_query, sql_answer_df = (min(successes, key=lambda success: success[0])
+                                                  if get_candidate_selection() == "first"
+                                                  else choose_agreed_candidate(successes))
+    context.emit("winning_candidate_set", candidate_number)
+    if sql_answer_df.attrs.get("truncated"):
+        context.emit("answer_truncated_set", len(sql_answer_df))
+    context.answered_sql_query = sql_query
+    return sql_answer_df
+
+async def async_attempt_to_fix_sql_query(context, sql_query, exception, reference_df, conversation, retry_count):
+    if retry_count == 0:
+        prompt_directive = build_first_fix_directive(sql_query, context.question, exception, reference_df)
+        conversation.append({"role": "user", "content": prompt_directive})
+        fixed_sql_query = await async_create_chat_completion(
+            context, [{"role": "user", "content": prompt_directive}], budget=context.budget, stage="repair")
+    else:
+        conversation.append({"role": "user", "content": build_next_fix_directive(exception)})
+        fixed_sql_query = await async_create_chat_completion(
+            context, list(conversation), budget=context.budget, stage="repair")
+    conversation.append({"role": "assistant", "content": fixed_sql_query})
+    logging.debug(f"New SQL query: {fixed_sql_query}\n")
+    return fixed_sql_query
+
+async def async_execute_sql_with_error_analysis(context, sql_query, filtered_schema_and_synonyms_df, exception):
+    strategy = get_env_str_choice("ERROR_ANALYSIS_STRATEGY", "single_pass", ("single_pass", "conversation"))
+    with span("error_analysis", strategy=strategy):
+        return await async_execute_sql_with_error_analysis_in_span(
+            context, sql_query, filtered_schema_and_synonyms_df, exception, strategy)
+
+async def async_execute_sql_with_error_analysis_in_span(context, sql_query, filtered_schema_and_synonyms_df, exception,
+                                                        strategy):
+    if strategy == "single_pass":
+        directive = build_single_pass_repair_directive(sql_query, context.question, filtered_schema_and_synonyms_df, exception)
+        response = await async_create_chat_completion(
+            context, [{"role": "user", "content": directive}], budget=context.budget, stage="repair")
+        sections = parse_error_analysis_sections(response)
+        for section_number, section_content in enumerate(sections, start=1):
+            context.emit(f"error_analysis_content_{section_number}_set", section_content)
+        corrected_sql_query = sections[-1]
+    else:
+        conversation = []
+        directives = build_error_analysis_directives(sql_query, context.question, filtered_schema_and_synonyms_df, exception)
+        for step_number, directive in enumerate(directives, start=1):
+            conversation.append({"role": "user", "content": directive})
+            response = await async_create_chat_completion(
+                context, list(conversation), budget=context.budget, stage="repair")
+            conversation.append({"role": "assistant", "content": response})
+            context.emit(f"error_analysis_content_{step_number}_set", response)
+        corrected_sql_query = response
+
+    try:
+        context.budget.check()
+        sql_result = await async_run_answer_sql(context, corrected_sql_query)
+        context.answered_sql_query = corrected_sql_query
+        return sql_result
+    except SQLExecutionError:
+        logging.debug("Corrected SQL query still produces an error. Quitting.")
+        return "Unable to answer."
+
+async def async_execute_sql_with_fallback(context, sql_query, filtered_schema_and_synonyms_df, schema_df=None):
+    # Same chain as execute_sql_with_fallback, written as a loop so each attempt awaits instead of blocking
+    with span("execute_sql"):
+        return await async_execute_sql_with_fallback_in_span(context, sql_query, filtered_schema_and_synonyms_df, schema_df)
+
+async def async_execute_sql_with_fallback_in_span(context, sql_query, filtered_schema_and_synonyms_df, schema_df):
+    context.budget = FallbackBudget.from_env()
+    conversation = []
+    last_sql_query = None
+    retry_count = 0
+    try:
+        while True:
+            try:
+                context.budget.check()
+                context.emit(f"fallback_query_{retry_count}_set", sql_query)
+                if retry_count:
+                    record_retry()
+                with span("fallback_attempt", retry_count=retry_count):
+                    await async_check_sql_before_execution(context, sql_query, schema_df)
+                    sql_result = await async_run_answer_sql(context, sql_query)
+                context.answered_sql_query = sql_query
+                return sql_result
+            except SQLExecutionError as e:
+                context.emit(f"fallback_exception_{retry_count}_set", e.original_exception)
+                if sql_query == last_sql_query or retry_count >= MAX_SQL_FIX_RETRIES:
+                    logging.debug(f"Latest error: {e.original_exception}. Switching to error analysis.")
+                    return await async_execute_sql_with_error_analysis(
+                        context, sql_query, filtered_schema_and_synonyms_df, e.original_exception)
+
+                logging.debug(f"An error occurred while executing SQL: {e.original_exception}. "
+                              f"Retrying... ({retry_count + 1}/{MAX_SQL_FIX_RETRIES})\n")
+                last_sql_query = sql_query
+                try:
+                    with span("fix_sql", retry_count=retry_count):
+                        sql_query = await async_attempt_to_fix_sql_query(
+                            context, sql_query, e.original_exception, filtered_schema_and_synonyms_df, conversation,
+                            retry_count)
+                except FallbackBudgetExceeded:
+                    raise
+                except Exception as fix_e:
+                    if is_retryable(fix_e):
+                        raise
+                    logging.debug(f"An error occurred while attempting to fix the SQL: {fix_e}.")
+                    sql_query = conversation[-1]["content"]
+                retry_count += 1
+    except FallbackBudgetExceeded as e:
+        logging.debug(f"{e} Quitting.")
+        context.emit("fallback_budget_exceeded_set", str(e))
+        return "Unable to answer."
+    except Exception as e:
+        if not is_retryable(e):
+            raise
+        logging.debug(f"Completion failed after retries: {e}. Quitting.")
+        context.emit("completion_unavailable_set", str(e))
+        return "Unable to answer."
+
+async def async_answer_from_question_cache(context, schema_fingerprint):
+    question_cache = get_question_cache()
+    cached_sql_query = question_cache.lookup(context.database_url, schema_fingerprint, context.question)
+    if cached_sql_query is None:
+        return None
+    context.emit("cached_sql_query_set", cached_sql_query)
+    try:
+        answer = await async_run_answer_sql(context, cached_sql_query)
+    except SQLExecutionError as e:
+        logging.debug(f"Cached SQL query no longer executes: {e.original_exception}. Answering from scratch.")
+        question_cache.discard(context.database_url, context.question)
+        return None
+    context.answered_sql_query = cached_sql_query
+    return answer
+
+def load_schema_catalog(schema_catalog):
+    return (schema_catalog.get_schema_and_synonyms_df(), schema_catalog.get_schema_index(),
+            schema_catalog.get_join_graph())
+
+async def answer_request(context):
+    # Tasks and threads started below inherit the scope, so shared code emits to this question's publisher too
+    with request_event_scope(context.event_publisher), span("question"):
+        return await answer_in_event_scope(context)
+
+async def answer_in_event_scope(context):
+    schema_catalog = get_schema_catalog(context.database_url)
+    # The catalog is loaded once and then only re-checked now and then, so a worker thread is enough
+    with span("schema_load"):
+        schema_and_synonyms_df, schema_index, join_graph = await asyncio.to_thread(load_schema_catalog, schema_catalog)
+
+    answer = None
+    if is_question_cache_enabled():
+        with span("question_cache"):
+            answer = await async_answer_from_question_cache(context, schema_catalog.fingerprint)
+
+    if answer is None:
+        with span("filter_schema"):
+            filtered_schema_and_synonyms_df = await async_filter_schema_and_synonyms_df(
+                context, schema_and_synonyms_df, schema_index=schema_index, join_graph=join_graph)
+        if use_value_hints():
+            with span("value_hints"):
+                column_profile_df = await asyncio.to_thread(schema_catalog.get_column_profile_df)
+                filtered_schema_and_synonyms_df = add_value_hints(filtered_schema_and_synonyms_df, column_profile_df)
+        if get_sql_candidate_count() > 1:
+            sql_queries = await async_generate_sql_candidates(
+                context, filtered_schema_and_synonyms_df, get_sql_candidate_count())
+            with span("execute_candidates", candidates=len(sql_queries)):
+                answer = await async_execute_sql_candidates(context, sql_queries, schema_df=schema_and_synonyms_df)
+            sql_query = sql_queries[0]
+        else:
+            sql_query = await async_generate_sql_query(context, filtered_schema_and_synonyms_df)
+        # The sequential repair chain runs only when no candidate answered
+        if context.answered_sql_query is None:
+            answer = await async_execute_sql_with_fallback(
+                context, sql_query, filtered_schema_and_synonyms_df, schema_df=schema_and_synonyms_df)
+        if context.answered_sql_query is not None and is_question_cache_enabled():
+            get_question_cache().store(
+                context.database_url, schema_catalog.fingerprint, context.question, context.answered_sql_query)
+
+    context.answer = answer
+    context.emit("answer_set", answer)
+    return answer
+
+async def answer(question, database_url=None, api_key=None, stage_models=None, priority=None):
+    context = RequestContext(question, database_url or set_database_connection(),
+                             api_key=api_key if api_key is not None else get_API_key(), stage_models=stage_models,
+                             priority=priority)
+    return await answer_request(context)
@@ -0,0 +1,151 @@
+import contextvars
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database_and_synonym_manager import set_database_connection, set_API_key
+import pandas as pd
+from execution_manager import set_concurrency_limit
+from completion_scheduler_manager import completion_priority
+from arrow_result_manager import write_arrow_result
+from global_event_publisher import request_event_scope
+from instrumentation_manager import span
+from schema_catalog_manager import get_schema_catalog
+from main import answer_question
+from utils import get_env_int, get_env_str_choice
+
+def read_questions(input_path):
+    # CSV files need a "question" column; JSON lines hold {"question": ...}. Either may give each question an "id".
+    with open(input_path, newline="") as f:
+        if input_path.endswith(".csv"):
+            records = list(csv.DictReader(f))
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+    return [{"id": str(line_number if record.get("id") in (None, "") else record["id"]), "question": record["question"]}
+            for line_number, record in enumerate(records, start=1)]
+
+def read_answered_ids(output_path):
+    # Questions that failed are answered again on resume; a line cut off by a crash is ignored
+    answered_ids = set()
+    if not os.path.exists(output_path):
+        return answered_ids
+    with open(output_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("error") is None:
+                answered_ids.add(result["id"])
+    return answered_ids
+
+def answer_to_rows(answer):
+    if not hasattr(answer, "to_json"):
+        return None
+    return json.loads(answer.to_json(orient="records", date_format="iso", default_handler=str))
+
+class BatchResultWriter:
+    """Appends one JSON line per answered question and flushes it, so a crash loses at most the line being written."""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self._lock = threading.Lock()
+        needs_newline = os.path.exists(output_path) and os.path.getsize(output_path) > 0 and not self._ends_with_newline()
+        self._file = open(output_path, "a")
+        if needs_newline:
+            self._file.write("\n")
+
+    def _ends_with_newline(self):
+        with open(self.output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def write(self, result):
+        line = json.dumps(result, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def get_batch_result_format():
+    # json keeps the rows in the results file; parquet and arrow write each answer to its own file next to it
+    return get_env_str_choice("BATCH_RESULT_FORMAT", "json", ("json", "parquet", "arrow"))
+
+def build_rows_path(rows_directory, record_id, result_format):
+    return os.path.join(rows_directory, re.sub(r"[^\w.-]", "_", record_id) + "." + result_format)
+
+def answer_batch_question(record, database_url, rows_directory=None, result_format="json", priority="batch"):
+    started_at = time.perf_counter()
+    result = {"id": record["id"], "question": record["question"], "sql_query": None, "rows": None,
+              "truncated": False, "error": None}
+    try:
+        with request_event_scope(), completion_priority(priority), span("question", batch_id=record["id"]):
+            answer, result["sql_query"] = answer_question(record["question"], database_url, return_sql_query=True)
+        if rows_directory is not None and isinstance(answer, pd.DataFrame):
+            result["rows_path"] = build_rows_path(rows_directory, record["id"], result_format)
+            write_arrow_result(answer, result["rows_path"])
+        else:
+            result["rows"] = answer_to_rows(answer)
+        result["truncated"] = bool(getattr(answer, "attrs", {}).get("truncated"))
+        if result["sql_query"] is None:
+            result["error"] = "No SQL query could be executed."
+    except Exception as e:
+        logging.exception(f"Question {record['id']} failed.")
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["duration_ms"] = round((time.perf_counter() - started_at) * 1000, 3)
+    return result
+
+def run_batch(input_path, output_path, database_url=None, workers=None, llm_concurrency=None, db_concurrency=None,
+              result_format=None):
+    # Loads the API key, connection and schema once, then answers the questions not yet in output_path
+    set_API_key()
+    database_url = database_url or set_database_connection()
+    workers = workers or get_env_int("BATCH_WORKERS", 8)
+    set_concurrency_limit("llm", llm_concurrency or get_env_int("BATCH_LLM_CONCURRENCY", 16))
+    set_concurrency_limit("database", db_concurrency or get_env_int(
+        "BATCH_DB_CONCURRENCY", get_env_int("DB_POOL_SIZE", 5) + get_env_int("DB_MAX_OVERFLOW", 10)))
+
+    result_format = result_format or get_batch_result_format()
+    rows_directory = None
+    if result_format != "json":
+        rows_directory = os.path.splitext(output_path)[0] + "_rows"
+        os.makedirs(rows_directory, exist_ok=True)
+
+    answered_ids = read_answered_ids(output_path)
+    records = [record for record in read_questions(input_path) if record["id"] not in answered_ids]
+    logging.info(f"Answering {len(records)} questions; {len(answered_ids)} already answered in {output_path}.")
+
+    with span("schema_load"):
+        get_schema_catalog(database_url).get_schema_and_synonyms_df()
+
+    writer = BatchResultWriter(output_path)
+    failed_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, answer_batch_question, record, database_url,
+                                       rows_directory, result_format)
+                       for record in records]
+            # Results are written as they finish, so a crash only loses questions still in flight
+            for future in as_completed(futures):
+                result = future.result()
+                writer.write(result)
+                failed_count += result["error"] is not None
+    finally:
+        writer.close()
+        set_concurrency_limit("llm", None)
+        set_concurrency_limit("database", None)
+    logging.info(f"Batch finished: {len(records) - failed_count} answered, {failed_count} failed.")
+    return failed_count
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python batch_manager.py <questions.csv|questions.jsonl> <results.jsonl>")
+        sys.exit(1)
+    sys.exit(1 if run_batch(sys.argv[1], sys.argv[2]) else 0)
@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, Table, Column, Integer, Text, Numeric, DateTime, ForeignKey, insert
+from engine_manager import get_engine, dispose_engine
+from completion_cache_manager import CompletionCache, set_completion_cache
+from result_cache_manager import ResultCache, set_result_cache
+from completion_replay_manager import ReplayCompletionBackend, RecordingCompletionBackend
+from execution_manager import set_completion_backend, get_completion_call_count, reset_completion_call_count
+from schema_catalog_manager import get_schema_catalog
+from instrumentation_manager import span, get_span_recorder, latency_report
+from global_event_publisher import request_event_scope
+from main import answer_question
+
+SCALES = [100, 1000, 10000]
+
+QUESTIONS = [
+    "What is the frequency of each film category?",
+    "Which actors appear in the most films?",
+    "How much payment revenue did each store take?",
+    "Which customers rented the most films?",
+    "What is the average rental rate of films by rating?",
+]
+
+COLUMN_TYPES = {"integer": Integer, "text": Text, "numeric": Numeric, "timestamp": DateTime}
+
+# dvdrental's core tables, with the keys that link them
+DVDRENTAL_TABLES = {
+    "language": [("language_id", "integer"), ("name", "text")],
+    "category": [("category_id", "integer"), ("name", "text")],
+    "actor": [("actor_id", "integer"), ("first_name", "text"), ("last_name", "text")],
+    "film": [("film_id", "integer"), ("title", "text"), ("description", "text"), ("release_year", "integer"),
+             ("language_id", "integer"), ("rental_rate", "numeric"), ("length", "integer"), ("rating", "text")],
+    "film_actor": [("actor_id", "integer"), ("film_id", "integer")],
+    "film_category": [("film_id", "integer"), ("category_id", "integer")],
+    "country": [("country_id", "integer"), ("country", "text")],
+    "city": [("city_id", "integer"), ("city", "text"), ("country_id", "integer")],
+    "address": [("address_id", "integer"), ("address", "text"), ("district", "text"), ("city_id", "integer"),
+                ("phone", "text")],
+    "store": [("store_id", "integer"), ("address_id", "integer")],
+    "staff": [("staff_id", "integer"), ("first_name", "text"), ("last_name", "text"), ("address_id", "integer"),
+              ("store_id", "integer")],
+    "customer": [("customer_id", "integer"), ("store_id", "integer"), ("first_name", "text"), ("last_name", "text"),
+                 ("email", "text"), ("address_id", "integer")],
+    "inventory": [("inventory_id", "integer"), ("film_id", "integer"), ("store_id", "integer")],
+    "rental": [("rental_id", "integer"), ("rental_date", "timestamp"), ("inventory_id", "integer"),
+               ("customer_id", "integer"), ("staff_id", "integer")],
+    "payment": [("payment_id", "integer"), ("customer_id", "integer"), ("staff_id", "integer"),
+                ("rental_id", "integer"), ("amount", "numeric"), ("payment_date", "timestamp")],
+}
+
+BRIDGE_TABLES = {"film_actor", "film_category"}
+
+# Words for the generated tables that pad the schema out to the requested column count
+FILLER_DOMAINS = ["warehouse", "supplier", "shipment", "invoice", "campaign", "review", "ticket", "device",
+                  "contract", "vendor", "budget", "license", "session", "promotion", "survey", "audit"]
+FILLER_COLUMNS = [("code", "text"), ("status", "text"), ("quantity", "integer"), ("amount", "numeric"),
+                  ("created_at", "timestamp"), ("updated_at", "timestamp"), ("notes", "text"), ("score", "numeric"),
+                  ("priority", "integer"), ("region", "text"), ("owner_name", "text"), ("external_ref", "text")]
+
+def build_fixture_metadata(column_count):
+    metadata = MetaData()
+    table_names = set(DVDRENTAL_TABLES)
+    for table_name, columns in DVDRENTAL_TABLES.items():
+        Table(table_name, metadata, *[
+            Column(column_name, COLUMN_TYPES[data_type],
+                   ForeignKey(f"{column_name[:-3]}.{column_name}") if column_name.endswith("_id")
+                   and column_name[:-3] in table_names and column_name[:-3] != table_name else None,
+                   primary_key=table_name not in BRIDGE_TABLES and column_name == f"{table_name}_id")
+            for column_name, data_type in columns])
+
+    randomizer = random.Random(column_count)
+    remaining_columns = column_count - sum(len(columns) for columns in DVDRENTAL_TABLES.values())
+    table_number = 0
+    while remaining_columns > 0:
+        domain = FILLER_DOMAINS[table_number % len(FILLER_DOMAINS)]
+        table_name = f"{domain}_{table_number // len(FILLER_DOMAINS) + 1}"
+        width = min(remaining_columns, randomizer.randint(6, 12))
+        linked_table_name = randomizer.choice(["store", "customer", "film", "staff"])
+        columns = [Column(f"{table_name}_id", Integer, primary_key=True)]
+        if width > 1:
+            columns.append(Column(f"{linked_table_name}_id", Integer,
+                                  ForeignKey(f"{linked_table_name}.{linked_table_name}_id")))
+        for column_name, data_type in randomizer.sample(FILLER_COLUMNS, max(width - 2, 0)):
+            columns.append(Column(f"{domain}_{column_name}", COLUMN_TYPES[data_type]))
+        Table(table_name, metadata, *columns)
+        remaining_columns -= width
+        table_number += 1
+    return metadata
+
+def fixture_rows(randomizer):
+    started_at = datetime(2023, 1, 1)
+    rows = {
+        "language": [{"language_id": 1, "name": "English"}, {"language_id": 2, "name": "French"}],
+        "category": [{"category_id": i, "name": name} for i, name in enumerate(
+            ["Action", "Comedy", "Drama", "Horror", "Family", "Sci-Fi"], start=1)],
+        "actor": [{"actor_id": i, "first_name": f"First{i}", "last_name": f"Last{i}"} for i in range(1, 41)],
+        "film": [{"film_id": i, "title": f"Film {i}", "description": f"Description of film {i}",
+                  "release_year": 2000 + i % 20, "language_id": 1 + i % 2, "rental_rate": (i % 3) + 0.99,
+                  "length": 80 + i % 60, "rating": ["G", "PG", "PG-13", "R"][i % 4]} for i in range(1, 201)],
+        "country": [{"country_id": 1, "country": "Canada"}, {"country_id": 2, "country": "Australia"}],
+        "city": [{"city_id": 1, "city": "Lethbridge", "country_id": 1}, {"city_id": 2, "city": "Woodridge", "country_id": 2}],
+        "address": [{"address_id": i, "address": f"{i} Main Street", "district": "Central", "city_id": 1 + i % 2,
+                     "phone": f"555-{i:04d}"} for i in range(1, 61)],
+        "store": [{"store_id": 1, "address_id": 1}, {"store_id": 2, "address_id": 2}],
+        "staff": [{"staff_id": i, "first_name": f"Staff{i}", "last_name": f"Member{i}", "address_id": 2 + i,
+                   "store_id": i} for i in (1, 2)],
+        "customer": [{"customer_id": i, "store_id": 1 + i % 2, "first_name": f"Customer{i}", "last_name": f"Family{i}",
+                      "email": f"customer{i}@example.com", "address_id": 5 + i % 50} for i in range(1, 101)],
+        "inventory": [{"inventory_id": i, "film_id": 1 + i % 200, "store_id": 1 + i % 2} for i in range(1, 401)],
+    }
+    rows["film_actor"] = [{"actor_id": actor_id, "film_id": film_id} for film_id in range(1, 201)
+                          for actor_id in randomizer.sample(range(1, 41), 3)]
+    rows["film_category"] = [{"film_id": film_id, "category_id": randomizer.randint(1, 6)} for film_id in range(1, 201)]
+    rows["rental"] = [{"rental_id": i, "rental_date": started_at + timedelta(hours=i), "inventory_id": randomizer.randint(1, 400),
+                       "customer_id": randomizer.randint(1, 100), "staff_id": 1 + i % 2} for i in range(1, 2001)]
+    rows["payment"] = [{"payment_id": i, "customer_id": rental["customer_id"], "staff_id": rental["staff_id"],
+                        "rental_id": rental["rental_id"], "amount": randomizer.choice([0.99, 2.99, 4.99]),
+                        "payment_date": rental["rental_date"]} for i, rental in enumerate(rows["rental"], start=1)]
+    return rows
+
+def build_fixture(database_url, column_count):
+    # Drops and recreates the fixture tables, so point database_url at a database kept for benchmarking
+    metadata = build_fixture_metadata(column_count)
+    engine = get_engine(database_url)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table_name, rows in fixture_rows(random.Random(0)).items():
+            connection.execute(insert(metadata.tables[table_name]), rows)
+    logging.info(f"Built fixture with {len(metadata.tables)} tables and {column_count} columns at {database_url}")
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def run_questions(database_url, questions, repeats):
+    answered = 0
+    for _ in range(repeats):
+        for question in questions:
+            with request_event_scope(), span("question"):
+                answer = answer_question(question, database_url)
+            answered += int(hasattr(answer, "columns"))
+    return answered
+
+def benchmark_scale(database_url, questions, repeats):
+    # Each scale starts cold: no cached completions, results, questions, spans or schema
+    completion_cache = CompletionCache()
+    completion_cache.enabled = False
+    set_completion_cache(completion_cache)
+    result_cache = ResultCache()
+    result_cache.enabled = False
+    set_result_cache(result_cache)
+    get_schema_catalog(database_url).invalidate()
+    get_span_recorder().clear()
+    reset_completion_call_count()
+
+    started_at = time.perf_counter()
+    answered = run_questions(database_url, questions, repeats)
+    wall_seconds = time.perf_counter() - started_at
+    question_count = len(questions) * repeats
+
+    report_df = latency_report()
+    question_durations = [span.duration * 1000 for span in get_span_recorder().spans() if span.name == "question"]
+    result = {
+        "questions": question_count,
+        "answered": answered,
+        "wall_seconds": round(wall_seconds, 3),
+        "question_p50_ms": round(percentile(question_durations, 0.5), 3),
+        "question_p95_ms": round(percentile(question_durations, 0.95), 3),
+        "llm_calls_per_question": round(get_completion_call_count() / question_count, 3),
+        "prompt_tokens_per_question": round(float(report_df.loc["question", "prompt_tokens"]) / question_count, 1),
+        "completion_tokens_per_question": round(float(report_df.loc["question", "completion_tokens"]) / question_count, 1),
+        "stages": {name: {"count": int(row["count"]), "p50_ms": float(row["p50_ms"]), "p95_ms": float(row["p95_ms"])}
+                   for name, row in report_df.iterrows()},
+    }
+
+    # Memory is traced in a separate pass, since tracing slows every allocation down
+    get_schema_catalog(database_url).invalidate()
+    tracemalloc.start()
+    try:
+        run_questions(database_url, questions, 1)
+        result["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+    finally:
+        tracemalloc.stop()
+    return result
+
+# Allowed growth over the baseline before a metric counts as a regression
+TOLERANCES = {
+    "question_p50_ms": 0.25,
+    "question_p95_ms": 0.25,
+    "llm_calls_per_question": 0.0,
+    "prompt_tokens_per_question": 0.02,
+    "completion_tokens_per_question": 0.02,
+    "peak_memory_mb": 0.2,
+}
+
+def compare_to_baseline(results, baseline):
+    regressions = []
+    for scale, result in results.items():
+        if scale not in baseline:
+            continue
+        for metric, tolerance in TOLERANCES.items():
+            baseline_value = baseline[scale].get(metric)
+            value = result.get(metric)
+            if baseline_value is None or value is None:
+                continue
+            if value > baseline_value * (1 + tolerance) + 1e-9:
+                regressions.append(f"{scale} columns: {metric} {value} > baseline {baseline_value} (+{tolerance:.0%} allowed)")
+    return regressions
+
+def run_benchmark(scales, questions, repeats, database_url=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as fixture_directory:
+        for column_count in scales:
+            scale_database_url = database_url or "sqlite:///" + os.path.join(fixture_directory, f"fixture_{column_count}.db")
+            build_fixture(scale_database_url, column_count)
+            results[str(column_count)] = benchmark_scale(scale_database_url, questions, repeats)
+            logging.info(f"{column_count} columns: {json.dumps(results[str(column_count)])}")
+            dispose_engine(scale_database_url)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the question pipeline offline against a fixture database.")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="Schema sizes in columns.")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of the question set per scale.")
+    parser.add_argument("--recordings", help="JSON lines file of recorded completions to replay.")
+    parser.add_argument("--record", action="store_true", help="Call the OpenAI API and append to --recordings.")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="Simulated latency of each replayed call.")
+    parser.add_argument("--database-url", help="Build the fixture here instead of in temporary SQLite files.")
+    parser.add_argument("--baseline", help="Baseline results to compare against.")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results to --baseline.")
+    parser.add_argument("--output", help="Write the results to this file.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    os.environ["QUESTION_CACHE_ENABLED"] = "false"
+    os.environ.pop("SCHEMA_SNAPSHOT_FILE_PATH", None)
+    os.environ.pop("INSTRUMENTATION_FILE_PATH", None)
+
+    if args.record:
+        if not args.recordings:
+            parser.error("--record needs --recordings")
+        from database_and_synonym_manager import set_API_key
+        set_API_key()
+        set_completion_backend(RecordingCompletionBackend(args.recordings))
+    else:
+        recordings_path = args.recordings if args.recordings and os.path.exists(args.recordings) else None
+        set_completion_backend(ReplayCompletionBackend(recordings_path, latency_seconds=args.llm_latency_ms / 1000))
+
+    results = run_benchmark(args.scales, QUESTIONS, args.repeats, database_url=args.database_url)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        return 0
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f))
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from utils import get_env_int, get_env_bool
+
+class CompletionCache:
+    """Two-tier cache of completion responses: an in-memory LRU in front of an optional SQLite file."""
+
+    def __init__(self, max_entries=1024, max_age_seconds=None, file_path=None, max_file_entries=100000):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.file_path = file_path
+        self.max_file_entries = max_file_entries
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        # The file is trimmed every so many inserts, so it overshoots max_file_entries by at most a tenth
+        self._file_eviction_interval = max(1, min(100, max_file_entries // 10))
+        self._inserts_since_eviction = 0
+        if file_path:
+            self._connection = sqlite3.connect(file_path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL)"
+            )
+            self._connection.commit()
+            self._evict_file_entries()
+
+    @staticmethod
+    def make_key(model, temperature, messages):
+        key_material = json.dumps({"model": model, "temperature": temperature, "messages": messages}, sort_keys=True)
+        return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._is_expired(entry[1], now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT response, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._is_expired(row[1], now):
+                    self._connection.execute("UPDATE completions SET last_used_at = ? WHERE key = ?", (now, key))
+                    self._connection.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._connection is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO completions (key, response, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                    (key, response, now, now))
+                self._connection.commit()
+                self._inserts_since_eviction += 1
+                if self._inserts_since_eviction >= self._file_eviction_interval:
+                    self._evict_file_entries()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM completions")
+                self._connection.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _is_expired(self, created_at, now):
+        return self.max_age_seconds is not None and now - created_at > self.max_age_seconds
+
+    def _remember(self, key, response, created_at):
+        self._entries[key] = (response, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _evict_file_entries(self):
+        if self.max_age_seconds is not None:
+            self._connection.execute("DELETE FROM completions WHERE created_at < ?",
+                                     (time.time() - self.max_age_seconds,))
+        self._connection.execute(
+            "DELETE FROM completions WHERE key NOT IN "
+            "(SELECT key FROM completions ORDER BY last_used_at DESC LIMIT ?)", (self.max_file_entries,))
+        self._connection.commit()
+        self._inserts_since_eviction = 0
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache():
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            max_age_seconds = get_env_int("LLM_CACHE_MAX_AGE_SECONDS", 0)
+            _completion_cache = CompletionCache(
+                max_entries=get_env_int("LLM_CACHE_MAX_ENTRIES", 1024),
+                max_age_seconds=max_age_seconds or None,
+                file_path=os.getenv("LLM_CACHE_FILE_PATH") or None,
+                max_file_entries=get_env_int("LLM_CACHE_MAX_FILE_ENTRIES", 100000),
+            )
+            _completion_cache.enabled = get_env_bool("LLM_CACHE_ENABLED", True)
+            logging.debug(f"Completion cache enabled: {_completion_cache.enabled}")
+        return _completion_cache
+
+def set_completion_cache(completion_cache):
+    global _completion_cache
+    with _completion_cache_lock:
+        _completion_cache = completion_cache
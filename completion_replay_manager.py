@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+import openai
+from openai.openai_object import OpenAIObject
+from completion_cache_manager import CompletionCache
+from schema_index_manager import split_words
+from data_preparation_manager import token_count
+from schema_format_manager import COMPACT_SCHEMA_HEADER
+
+def make_completion(content, prompt_tokens=0, completion_tokens=0):
+    return OpenAIObject.construct_from({
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    })
+
+def count_message_tokens(messages):
+    # Four tokens of chat framing per message, as the API counts them
+    return sum(token_count(message["content"]) + 4 for message in messages)
+
+COMPACT_ENTRY_PATTERN = re.compile(r"(\d+) ([^\s:,()\[\]]+)(?::([^,()\[\]]+))?")
+
+def parse_schema_table_rows(text):
+    # Reads a rendered schema back as (index, {column: value}); names hold no spaces
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    if lines[0] == COMPACT_SCHEMA_HEADER:
+        rows = []
+        for line in lines[1:]:
+            table_match = re.match(r"([^\s(]+)\((.*)\)$", line)
+            if not table_match:
+                break
+            for entry in COMPACT_ENTRY_PATTERN.finditer(re.sub(r"\[[^\]]*\]", "", table_match.group(2))):
+                rows.append((int(entry.group(1)), {"table_name": table_match.group(1), "column_name": entry.group(2),
+                                                   "data_type": entry.group(3)}))
+        return rows
+    header = lines[0].split()
+    rows = []
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) > 1 and re.fullmatch(r"\d+", fields[0]):
+            rows.append((int(fields[0]), dict(zip(header, fields[1:]))))
+    return rows
+
+def stub_index_list_response(prompt):
+    question_match = re.search(r"Here is the question: (.*?)\n", prompt)
+    rows = parse_schema_table_rows(prompt.rsplit("Table:\n", 1)[-1])
+    if question_match:
+        question_words = set(split_words(question_match.group(1)))
+        selected = [index for index, row in rows if question_words & set(
+            split_words(row.get("table_name", "")) + split_words(row.get("column_name", "")))]
+    else:
+        # Join pass: key columns of the tables that need to be joined
+        joined_text = prompt.split("need to be joined:\n", 1)[-1].split("\nHere is the Full", 1)[0]
+        joined_tables = {row.get("table_name") for _, row in parse_schema_table_rows(joined_text)}
+        selected = [index for index, row in rows if row.get("column_name", "").endswith("_id")
+                    and (row.get("table_name") in joined_tables or row["column_name"][:-3] in joined_tables)]
+    return "[" + ", ".join(str(index) for index in selected) + "]"
+
+def stub_sql_response(prompt):
+    question_match = re.search(r"Here is the question: (.*?)Here is the Database Schema Table", prompt, re.S)
+    question_words = set(split_words(question_match.group(1))) if question_match else set()
+    columns_by_table = {}
+    for _, row in parse_schema_table_rows(prompt.rsplit("Table:\n", 1)[-1]):
+        if "table_name" in row and "column_name" in row:
+            columns_by_table.setdefault(row["table_name"], []).append(row["column_name"])
+    if not columns_by_table:
+        return "SELECT 1;"
+    table_name = max(columns_by_table, key=lambda table: (
+        len(question_words & set(split_words(table + " " + " ".join(columns_by_table[table])))), -len(table)))
+    return f"SELECT {', '.join(columns_by_table[table_name][:3])} FROM {table_name} LIMIT 100;"
+
+def stub_response(messages):
+    # Answers the pipeline's prompts deterministically, well enough to exercise every stage
+    prompt = next(message["content"] for message in messages if message["role"] == "user")
+    last_prompt = messages[-1]["content"]
+    if "Only return the index numbers" in prompt:
+        return stub_index_list_response(prompt)
+    if "you provide SQL" in prompt:
+        return stub_sql_response(prompt)
+    if "Answer with exactly these labelled sections" in last_prompt:
+        return ("SUMMARY: The question.\nINTENT: Query the data.\nERROR: The query failed.\n"
+                "SCHEMA CHANGES: None.\nSTEPS: Simplify the query.\nSQL: SELECT 1;")
+    return "SELECT 1;"
+
+class ReplayCompletionBackend:
+    """Deterministic stand-in for openai.ChatCompletion: replays recorded responses and stubs the rest locally."""
+
+    def __init__(self, recordings_path=None, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+        self.recordings = {}
+        self.replayed = 0
+        self.stubbed = 0
+        self._lock = threading.Lock()
+        if recordings_path:
+            with open(recordings_path) as f:
+                for line in f:
+                    if line.strip():
+                        recording = json.loads(line)
+                        self.recordings[recording["key"]] = recording
+
+    def respond(self, model, messages, temperature=0):
+        recording = self.recordings.get(CompletionCache.make_key(model, temperature, messages))
+        with self._lock:
+            if recording is not None:
+                self.replayed += 1
+            else:
+                self.stubbed += 1
+        if recording is not None:
+            usage = recording.get("usage") or {}
+            return make_completion(recording["response"], usage.get("prompt_tokens", 0),
+                                   usage.get("completion_tokens", 0))
+        response = stub_response(messages)
+        return make_completion(response, count_message_tokens(messages), token_count(response))
+
+    def create(self, model, messages, temperature=0, **kwargs):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return self.respond(model, messages, temperature)
+
+    async def acreate(self, model, messages, temperature=0, **kwargs):
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return self.respond(model, messages, temperature)
+
+class RecordingCompletionBackend:
+    """Calls the OpenAI API and appends every prompt and response to a recordings file for later replay."""
+
+    def __init__(self, recordings_path):
+        self.recordings_path = recordings_path
+        self._lock = threading.Lock()
+
+    def record(self, model, messages, temperature, completion):
+        recording = {
+            "key": CompletionCache.make_key(model, temperature, messages),
+            "model": model,
+            "messages": messages,
+            "response": completion.choices[0].message["content"],
+            "usage": dict(completion.get("usage") or {}),
+        }
+        with self._lock:
+            with open(self.recordings_path, "a") as f:
+                f.write(json.dumps(recording) + "\n")
+        logging.debug(f"Recorded completion {recording['key']}")
+
+    def create(self, model, messages, temperature=0, **kwargs):
+        completion = openai.ChatCompletion.create(model=model, messages=messages, temperature=temperature, **kwargs)
+        self.record(model, messages, temperature, completion)
+        return completion
+
+    async def acreate(self, model, messages, temperature=0, **kwargs):
+        completion = await openai.ChatCompletion.acreate(model=model, messages=messages, temperature=temperature, **kwargs)
+        self.record(model, messages, temperature, completion)
+        return completion
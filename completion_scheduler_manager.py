@@ -0,0 +1,258 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from model_registry_manager import get_model_encoding, get_model_spec
+from instrumentation_manager import record_retry
+from utils import get_env_float, get_env_int
+
+# Lower numbers are served first: an interactive question waiting for capacity goes ahead of every batch request
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+
+# openai.error classes worth retrying, matched by name so openai is not imported before the first request
+RETRYABLE_ERRORS = {"RateLimitError", "ServiceUnavailableError", "APIConnectionError", "Timeout", "TryAgain"}
+
+# How often async waiters check for capacity, since they cannot wait on the scheduler's condition
+ASYNC_POLL_SECONDS = 0.05
+
+_completion_priority = contextvars.ContextVar("completion_priority", default="interactive")
+
+@contextmanager
+def completion_priority(priority):
+    token = _completion_priority.set(priority)
+    try:
+        yield
+    finally:
+        _completion_priority.reset(token)
+
+def estimate_completion_tokens(messages, model):
+    # Prompt tokens by the model's tokenizer, plus the room the model keeps for its answer; the difference to
+    # the actual usage is settled after the response
+    encoding = get_model_encoding(model)
+    prompt_tokens = sum(len(encoding.encode(message["content"])) + 4 for message in messages)
+    return prompt_tokens + get_model_spec(model).response_token_reserve()
+
+def is_retryable(exception):
+    if type(exception).__name__ in RETRYABLE_ERRORS:
+        return True
+    # Server errors other than the typed ones above
+    return type(exception).__name__ == "APIError" and (getattr(exception, "http_status", None) or 500) >= 500
+
+def get_retry_after_seconds(exception):
+    headers = getattr(exception, "headers", None) or {}
+    retry_after = headers.get("retry-after-ms")
+    if retry_after is not None:
+        try:
+            return float(retry_after) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def cap_wait_to_budget(seconds, budget=None):
+    # Raises FallbackBudgetExceeded (through budget.check) once the question's time is spent, and otherwise
+    # shortens the wait to the time it has left
+    if budget is None:
+        return seconds
+    budget.check()
+    remaining_seconds = budget.remaining_seconds()
+    return seconds if remaining_seconds is None else max(min(seconds, remaining_seconds), 0)
+
+class TokenBucket:
+    """Refills at rate_per_minute up to one minute's worth; may go negative when a request's estimate was too low."""
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def seconds_until_available(self, amount):
+        # A request larger than the bucket waits for a full bucket rather than forever
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing / self.rate_per_second, 0)
+
+class CompletionScheduler:
+    """Admits completion requests under requests-per-minute and tokens-per-minute limits, in priority order,
+    and retries rate-limit and server errors with jittered exponential backoff, honoring Retry-After.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=4, base_delay_seconds=1,
+                 max_delay_seconds=60):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.paused_until = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def estimate_tokens(self, messages, model):
+        return estimate_completion_tokens(messages, model) if self.token_bucket is not None else 0
+
+    def run(self, request, messages, model, priority=None, budget=None):
+        """Calls request() once capacity allows, retrying it on retryable errors; returns its completion.
+
+        With a FallbackBudget, no wait outlasts the budget's remaining time and FallbackBudgetExceeded is raised
+        once it has run out.
+        """
+        estimated_tokens = self.estimate_tokens(messages, model)
+        for attempt in itertools.count():
+            self.acquire(estimated_tokens, priority, budget)
+            try:
+                completion = request()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(cap_wait_to_budget(delay, budget))
+                continue
+            self.settle(estimated_tokens, completion)
+            return completion
+
+    async def run_async(self, request, messages, model, priority=None, budget=None):
+        estimated_tokens = self.estimate_tokens(messages, model)
+        for attempt in itertools.count():
+            await self.acquire_async(estimated_tokens, priority, budget)
+            try:
+                completion = await request()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(cap_wait_to_budget(delay, budget))
+                continue
+            self.settle(estimated_tokens, completion)
+            return completion
+
+    def acquire(self, estimated_tokens, priority=None, budget=None):
+        cap_wait_to_budget(0, budget)
+        with self._condition:
+            ticket = self._enqueue(estimated_tokens, priority)
+            try:
+                while (delay := self._poll(ticket)) > 0:
+                    self._condition.wait(cap_wait_to_budget(delay, budget))
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+
+    async def acquire_async(self, estimated_tokens, priority=None, budget=None):
+        cap_wait_to_budget(0, budget)
+        with self._condition:
+            ticket = self._enqueue(estimated_tokens, priority)
+        try:
+            while True:
+                with self._condition:
+                    delay = self._poll(ticket)
+                if delay <= 0:
+                    return
+                await asyncio.sleep(cap_wait_to_budget(min(delay, ASYNC_POLL_SECONDS), budget))
+        except BaseException:
+            with self._condition:
+                self._dequeue(ticket)
+            raise
+
+    def settle(self, estimated_tokens, completion):
+        # Charges the difference between the estimate and the tokens the response actually used
+        if self.token_bucket is None:
+            return
+        usage = completion.get("usage") if hasattr(completion, "get") else None
+        total_tokens = usage.get("total_tokens") if isinstance(usage, dict) else None
+        if total_tokens is None:
+            return
+        with self._condition:
+            self.token_bucket.tokens -= total_tokens - estimated_tokens
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        # A rate-limit response holds back every caller, not only the one that received it
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _enqueue(self, estimated_tokens, priority):
+        priority = priority or _completion_priority.get()
+        ticket = [PRIORITY_CLASSES.get(priority, PRIORITY_CLASSES["batch"]), next(self._sequence), estimated_tokens]
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _dequeue(self, ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._condition.notify_all()
+
+    def _poll(self, ticket):
+        # Only the first waiter in priority order may take capacity; returns 0 once it has, otherwise the
+        # seconds until capacity for the first waiter could be there
+        now = time.monotonic()
+        head = self._waiting[0]
+        delay = self.paused_until - now
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, head[2])):
+            if bucket is not None:
+                bucket.refill(now)
+                delay = max(delay, bucket.seconds_until_available(amount))
+        if delay > 0 or head is not ticket:
+            return max(delay, 0) or ASYNC_POLL_SECONDS
+        heapq.heappop(self._waiting)
+        if self.request_bucket is not None:
+            self.request_bucket.tokens -= 1
+        if self.token_bucket is not None:
+            self.token_bucket.tokens -= ticket[2]
+        self._condition.notify_all()
+        return 0
+
+    def _retry_delay(self, exception, attempt):
+        # Returns the seconds to wait before the next attempt, or None when the error should be raised
+        if attempt >= self.max_retries or not is_retryable(exception):
+            return None
+        record_retry()
+        backoff = random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** attempt))
+        retry_after = get_retry_after_seconds(exception)
+        if retry_after is not None:
+            self.pause(retry_after)
+            backoff = retry_after + random.uniform(0, self.base_delay_seconds)
+        logging.debug(f"Completion attempt {attempt + 1} failed with {type(exception).__name__}; "
+                      f"retrying in {backoff:.2f}s.")
+        return backoff
+
+_completion_scheduler = None
+_completion_scheduler_lock = threading.Lock()
+
+def get_completion_scheduler():
+    global _completion_scheduler
+    with _completion_scheduler_lock:
+        if _completion_scheduler is None:
+            _completion_scheduler = CompletionScheduler(
+                requests_per_minute=get_env_int("LLM_REQUESTS_PER_MINUTE", 0) or None,
+                tokens_per_minute=get_env_int("LLM_TOKENS_PER_MINUTE", 0) or None,
+                max_retries=get_env_int("LLM_MAX_RETRIES", 4),
+                base_delay_seconds=get_env_float("LLM_RETRY_BASE_SECONDS", 1),
+                max_delay_seconds=get_env_float("LLM_RETRY_MAX_SECONDS", 60),
+            )
+        return _completion_scheduler
+
+def set_completion_scheduler(completion_scheduler):
+    global _completion_scheduler
+    with _completion_scheduler_lock:
+        _completion_scheduler = completion_scheduler
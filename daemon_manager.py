@@ -0,0 +1,104 @@
+import functools
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+# Only the standard library is imported here, so the client starts in milliseconds; the server imports the
+# pipeline once, when it starts, and keeps the engine pool, schema catalog, tokenizer and caches warm.
+
+def get_socket_path():
+    return os.getenv("DAEMON_SOCKET_PATH") or os.path.join(tempfile.gettempdir(), "queryascent.sock")
+
+class QuestionHandler(socketserver.StreamRequestHandler):
+    """Answers one JSON line {"question": ...} per connection with one JSON line in the batch result format."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            record = json.loads(line)
+            record = {"id": str(record.get("id") or self.server.next_id()), "question": record["question"]}
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+            result = {"error": "Expected one JSON line with a question."}
+        else:
+            result = self.server.answer(record, self.server.database_url)
+        self.wfile.write((json.dumps(result, default=str) + "\n").encode())
+
+class QuestionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, database_url, answer):
+        self.database_url = database_url
+        self.answer = answer
+        self._question_count = 0
+        self._lock = threading.Lock()
+        super().__init__(socket_path, QuestionHandler)
+
+    def next_id(self):
+        with self._lock:
+            self._question_count += 1
+            return self._question_count
+
+def warm_up(database_url):
+    from schema_catalog_manager import get_schema_catalog
+    from model_registry_manager import get_model_encoding, get_stage_model
+    from instrumentation_manager import span
+    schema_catalog = get_schema_catalog(database_url)
+    with span("schema_load"):
+        schema_catalog.get_schema_and_synonyms_df()
+        schema_catalog.get_schema_index()
+        schema_catalog.get_join_graph()
+    get_model_encoding(get_stage_model("filter"))
+
+def serve(socket_path=None, database_url=None):
+    # The pipeline is imported here rather than at module level, which would slow every client down
+    from database_and_synonym_manager import set_database_connection, set_API_key
+    from batch_manager import answer_batch_question
+    socket_path = socket_path or get_socket_path()
+    set_API_key()
+    database_url = database_url or set_database_connection()
+    warm_up(database_url)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Daemon callers wait for their answer, so their model requests go ahead of batch jobs
+    server = QuestionServer(socket_path, database_url, functools.partial(answer_batch_question, priority="interactive"))
+    os.chmod(socket_path, 0o600)
+    logging.info(f"Answering questions on {socket_path}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+def ask(question, socket_path=None, timeout=None):
+    """Sends a question to a running daemon and returns its result: sql_query, rows, truncated and error."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path or get_socket_path())
+        client.sendall((json.dumps({"question": question}) + "\n").encode())
+        response = b""
+        while not response.endswith(b"\n"):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "serve":
+        logging.basicConfig(level=logging.INFO)
+        serve()
+    elif len(sys.argv) == 3 and sys.argv[1] == "ask":
+        result = ask(sys.argv[2])
+        print(json.dumps(result, indent=2, default=str))
+        sys.exit(1 if result.get("error") else 0)
+    else:
+        print('Usage: python daemon_manager.py serve | python daemon_manager.py ask "<question>"')
+        sys.exit(1)
@@ -1,65 +1,76 @@
+import contextvars
 import logging
-import tiktoken
+import numpy as np
 import pandas as pd
-import ast
-from utils import truncate_content
+import re
+from concurrent.futures import ThreadPoolExecutor
+from utils import truncate_content, get_env_int, get_env_str_choice
 from global_event_publisher import event_publisher
-from execution_manager import prompt_on_df
+from execution_manager import prompt_on_df, prompt_on_directive
+from schema_index_manager import find_join_candidate_rows
+from schema_format_manager import render_schema, render_compact_entries, get_schema_prompt_format, COMPACT_SCHEMA_HEADER
+from instrumentation_manager import span
+from model_registry_manager import get_model_spec, get_model_encoding, get_stage_model
 
-TOKEN_CAP = 4096
-
-enc = tiktoken.get_encoding("cl100k_base")
-
-def token_count(input_data):
+def token_count(input_data, model=None):
     # Check if input is a DataFrame
     if isinstance(input_data, pd.DataFrame):
-        # Convert DataFrame to a string
-        string = input_data.to_string()
+        # Convert DataFrame to the string prompts embed
+        string = render_schema(input_data)
     else:
         # Assume it's a string
         string = input_data
     
-    # Count the tokens
-    tokens = sum(1 for _ in enc.encode(string))
+    # Count the tokens with the tokenizer of the model the text is for
+    tokens = len(get_model_encoding(model or get_stage_model("filter")).encode(string))
     return tokens
 
-def calculate_table_token_cap(prompt_directive):
-    prompt_directive_token_count = token_count(prompt_directive)
-    answer_token_count_estimate = 250
+def calculate_table_token_cap(prompt_directive, model=None):
+    # Whatever the filtering model's window leaves after the directive and its answer, up to LLM_MAX_PARTITION_TOKENS
+    model = model or get_stage_model("filter")
+    model_spec = get_model_spec(model)
+    prompt_directive_token_count = token_count(prompt_directive, model)
+    answer_token_count_estimate = model_spec.response_token_reserve()
     table_token_cap = (
-        TOKEN_CAP - prompt_directive_token_count - answer_token_count_estimate
+        model_spec.context_window - prompt_directive_token_count - answer_token_count_estimate
     )
-    logging.debug(f"Table token cap: {table_token_cap}")
+    max_partition_tokens = get_env_int("LLM_MAX_PARTITION_TOKENS", 0)
+    if max_partition_tokens:
+        table_token_cap = min(table_token_cap, max_partition_tokens)
+    logging.debug(f"Table token cap for {model}: {table_token_cap}")
     return table_token_cap
 
-def create_list_of_df_partitions_limited_by_token_count(schema_and_synonyms_df, table_token_cap):
-    # Initialize variables
-    current_token_count = 0
-    current_df_list = []
-    partitioned_df_list = []
+def render_row_legacy(df, position):
+    return pd.DataFrame([df.iloc[position]]).to_string(header=False, index=True)
+
+def render_rows(df):
+    # Renders every row exactly as a one-row DataFrame.to_string(header=False, index=True) would
+    if df.empty:
+        return []
+    if not all(dtype == object for dtype in df.dtypes):
+        return [render_row_legacy(df, position) for position in range(len(df))]
+
+    rendered_columns = [df.index.astype(str).to_series(index=df.index)]
+    simple_rows = np.ones(len(df), dtype=bool)
+    for column in df.columns:
+        values = df[column]
+        is_text = values.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+        is_nan = values.map(lambda value: isinstance(value, float) and value != value).to_numpy(dtype=bool)
+        simple_rows &= is_text | is_nan
+        escaped = values.where(is_text, "").str.replace("\t", "\\t").str.replace("\n", "\\n").str.replace("\r", "\\r")
+        rendered_columns.append((" " + escaped).where(is_text, "NaN"))
+    row_strings = pd.concat(rendered_columns, axis=1).agg(" ".join, axis=1).tolist()
+
+    # Values other than strings and NaN (None, numbers, timestamps) keep pandas' own formatting
+    for position in np.flatnonzero(~simple_rows):
+        row_strings[position] = render_row_legacy(df, position)
+    return row_strings
+
+def create_list_of_df_partitions_limited_by_token_count(schema_and_synonyms_df, table_token_cap, model=None):
+    with span("partition_schema", rows=len(schema_and_synonyms_df)) as partition_span:
+        partitioned_df_list = partition_df_by_token_count(schema_and_synonyms_df, table_token_cap, model)
+        partition_span.set(partitions=len(partitioned_df_list))
 
-    # Loop through the DataFrame
-    for index, row in schema_and_synonyms_df.iterrows():
-        temp_df = pd.DataFrame([row])
-        temp_token_count = token_count(temp_df.to_string(header=False, index=True))
-        
-        if current_token_count + temp_token_count > table_token_cap:
-            # If adding this row would exceed the token cap, save the current DataFrame
-            partitioned_df_list.append(pd.concat(current_df_list, ignore_index=True))
-            
-            # Reset variables
-            current_df_list = [temp_df]
-            current_token_count = temp_token_count
-        else:
-            # Otherwise, add this row to the current DataFrame
-            current_df_list.append(temp_df)
-            current_token_count += temp_token_count
-
-    # Add the last remaining DataFrame if it's not empty
-    if current_df_list:
-        partitioned_df_list.append(pd.concat(current_df_list, ignore_index=False))
-
-    # df_list now contains your partitioned DataFrames
     schema_partitions = len(partitioned_df_list)
     
     event_publisher.emit("schema_partitions_set", schema_partitions)
@@ -67,28 +78,161 @@ def create_list_of_df_partitions_limited_by_token_count(schema_and_synonyms_df,
     logging.debug(f"Number of df partitions by token count: {schema_partitions}")  
     return partitioned_df_list
 
-def identify_rows_using_LLM(partitioned_df_list, prompt_directive):
-    filtered_schema_and_synonyms_df = pd.DataFrame()
+def compact_row_token_counts(schema_and_synonyms_df, encoding):
+    # Each entry pays for itself plus its ", " or closing ")" separator, and the first entry of a run of rows from
+    # one table also pays for the "table_name(" that opens its line. Also returns the largest such opening, which a
+    # partition starting partway through a table pays again.
+    row_token_counts = np.fromiter(
+        (len(tokens) + 1 for tokens in encoding.encode_batch(render_compact_entries(schema_and_synonyms_df))),
+        dtype=np.int64, count=len(schema_and_synonyms_df))
+    table_names = schema_and_synonyms_df["table_name"].astype(str).to_numpy()
+    unique_table_names = list(dict.fromkeys(table_names))
+    opening_token_counts = dict(zip(unique_table_names, (
+        len(tokens) + 1 for tokens in encoding.encode_batch([f"{table_name}(" for table_name in unique_table_names]))))
+    for position in np.flatnonzero(np.r_[True, table_names[1:] != table_names[:-1]]):
+        row_token_counts[position] += opening_token_counts[table_names[position]]
+    return row_token_counts, max(opening_token_counts.values())
+
+def uses_compact_schema(schema_and_synonyms_df):
+    return get_schema_prompt_format() == "compact" and {"table_name", "column_name"} <= set(schema_and_synonyms_df.columns)
+
+def partition_df_by_token_count(schema_and_synonyms_df, table_token_cap, model=None):
+    if schema_and_synonyms_df.empty:
+        return []
+    model = model or get_stage_model("filter")
+    encoding = get_model_encoding(model)
+    if uses_compact_schema(schema_and_synonyms_df):
+        row_token_counts, max_opening_token_count = compact_row_token_counts(schema_and_synonyms_df, encoding)
+        table_token_cap -= token_count(COMPACT_SCHEMA_HEADER, model) + 1 + max_opening_token_count
+    else:
+        row_token_counts = np.fromiter(
+            (len(tokens) for tokens in encoding.encode_batch(render_rows(schema_and_synonyms_df))),
+            dtype=np.int64, count=len(schema_and_synonyms_df))
+    cumulative_token_counts = np.cumsum(row_token_counts)
+
+    # Greedily close a partition at the first row that would push it over the cap
+    partitioned_df_list = []
+    start = 0
+    while start < len(schema_and_synonyms_df):
+        tokens_before_start = cumulative_token_counts[start - 1] if start > 0 else 0
+        end = int(np.searchsorted(cumulative_token_counts, tokens_before_start + table_token_cap, side="right"))
+        # A single row over the cap still gets a partition of its own
+        end = max(end, start + 1)
+        partitioned_df_list.append(schema_and_synonyms_df.iloc[start:end])
+        start = end
+    return partitioned_df_list
+
+INDEX_LIST_REASK_DIRECTIVE = (
+    "Your response could not be read as a list of index numbers. "
+    "Only return the index numbers of the rows as a list, for example [3, 17, 42]. "
+    "Do not include any descriptions or explanations."
+)
+
+def parse_index_list(response, valid_indices):
+    # Returns None when the response holds no recognisable list, so the caller can re-ask
+    list_match = re.search(r"\[([^\[\]]*)\]", response)
+    if list_match:
+        list_content = list_match.group(1)
+    elif re.fullmatch(r"[\s\d,]*", response):
+        list_content = response
+    else:
+        return None
+
+    if re.search(r"[^\s\d,'\"-]", list_content):
+        return None
+
+    indices = []
+    for index in (int(number) for number in re.findall(r"-?\d+", list_content)):
+        if index in valid_indices and index not in indices:
+            indices.append(index)
+        elif index not in valid_indices:
+            logging.debug(f"Ignoring index {index} that is not in the partition.")
+    return indices
+
+def identify_indices_in_partition(df, prompt_directive, model=None):
+    with span("identify_partition", rows=len(df)):
+        return identify_indices_in_partition_in_span(df, prompt_directive, model or get_stage_model("filter"))
+
+def identify_indices_in_partition_in_span(df, prompt_directive, model):
+    response = prompt_on_df(prompt_directive, df, model=model)
+    valid_indices = set(df.index)
+    indices = parse_index_list(response, valid_indices)
 
-    for df in partitioned_df_list:
-        prompt_on_df(prompt_directive, df)
-        indices = ast.literal_eval(prompt_on_df(prompt_directive, df))
+    max_reasks = get_env_int("LLM_INDEX_LIST_REASKS", 1)
+    conversation = None
+    reask_count = 0
+    while indices is None and reask_count < max_reasks:
+        logging.debug(f"Could not parse index list: {truncate_content(response)}. Re-asking this partition.")
+        if conversation is None:
+            conversation = [{"role": "user", "content": prompt_directive + render_schema(df)}]
+        conversation += [{"role": "assistant", "content": response},
+                         {"role": "user", "content": INDEX_LIST_REASK_DIRECTIVE}]
+        response = prompt_on_directive(conversation, model=model)
+        indices = parse_index_list(response, valid_indices)
+        reask_count += 1
 
-        for index in indices:
-            filtered_schema_and_synonyms_df = filtered_schema_and_synonyms_df._append(df.loc[index])
+    if indices is None:
+        logging.debug("Giving up on this partition after re-asking.")
+        return []
+    return indices
 
-    return filtered_schema_and_synonyms_df
+def identify_rows_using_LLM(partitioned_df_list, prompt_directive, model=None):
+    with span("identify_rows", partitions=len(partitioned_df_list)):
+        indices_list = identify_indices_in_partitions(partitioned_df_list, prompt_directive, model)
+    return merge_partition_rows(partitioned_df_list, indices_list)
+
+def identify_indices_in_partitions(partitioned_df_list, prompt_directive, model=None):
+    max_workers = min(get_env_int("LLM_MAX_WORKERS", 8), len(partitioned_df_list))
+
+    if max_workers > 1:
+        # map() yields results in submission order, so the merge below stays in partition order. Each call runs
+        # in a copy of the caller's context so its events reach the caller's request scope.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            indices_list = list(executor.map(
+                lambda df, context: context.run(identify_indices_in_partition, df, prompt_directive, model),
+                partitioned_df_list, [contextvars.copy_context() for _ in partitioned_df_list]))
+    else:
+        indices_list = [identify_indices_in_partition(df, prompt_directive, model) for df in partitioned_df_list]
+    return indices_list
+
+def merge_partition_rows(partitioned_df_list, indices_list):
+    filtered_df_list = [df.loc[indices] for df, indices in zip(partitioned_df_list, indices_list) if indices]
+    if not filtered_df_list:
+        return pd.DataFrame(columns=partitioned_df_list[0].columns) if partitioned_df_list else pd.DataFrame()
+    return pd.concat(filtered_df_list)
+
+def partition_df_for_prompt(prompt_directive, token_limited_df, model):
+    # Tokenizes every row, so the async pipeline runs it in a worker thread
+    table_token_cap = calculate_table_token_cap(prompt_directive, model)
+    return create_list_of_df_partitions_limited_by_token_count(token_limited_df, table_token_cap, model)
 
 def prompt_for_df_from_token_limited_df(prompt_directive, token_limited_df):
-    table_token_cap = calculate_table_token_cap(prompt_directive)
-    partitioned_df_list = (create_list_of_df_partitions_limited_by_token_count(token_limited_df, table_token_cap))
-    result_df = identify_rows_using_LLM(partitioned_df_list, prompt_directive)
+    model = get_stage_model("filter")
+    partitioned_df_list = partition_df_for_prompt(prompt_directive, token_limited_df, model)
+    result_df = identify_rows_using_LLM(partitioned_df_list, prompt_directive, model)
     result_df.reset_index(inplace=True)
     return result_df
 
-def filter_schema_and_synonyms_df(schema_and_synonyms_df, question):
+def prefilter_schema_rows(schema_and_synonyms_df, question, schema_index):
+    top_k = get_env_int("SCHEMA_PREFILTER_TOP_K", 200)
+    if schema_index is None or not top_k or len(schema_and_synonyms_df) <= top_k:
+        return schema_and_synonyms_df
+    candidate_df = schema_index.search(question, top_k)
+    logging.debug(f"Pre-filtered schema from {len(schema_and_synonyms_df)} to {len(candidate_df)} rows.")
+    return candidate_df
+
+def identify_join_rows_using_graph(schema_and_synonyms_df, schema_and_synonyms_df_filtered_for_data, join_graph):
+    # Returns None when some selected table cannot be reached, so the caller can ask the model instead
+    if schema_and_synonyms_df_filtered_for_data.empty:
+        return schema_and_synonyms_df_filtered_for_data
+    join_rows_df, unreachable_tables = join_graph.find_join_rows(
+        schema_and_synonyms_df, schema_and_synonyms_df_filtered_for_data["table_name"])
+    if unreachable_tables:
+        return None
+    return join_rows_df.reset_index()
 
-    identify_data_rows_prompt_directive = (
+def build_data_rows_directive(question):
+    return (
     "I have a user question and a database schema table. The Database Schema Table is meta-information: each row"
     "represents a column in a specific table within the database. It details the 'table_name', 'column_name', "
      "'data_type', and, if applicable, 'synonym_list' for that column. "
@@ -97,32 +241,58 @@ def filter_schema_and_synonyms_df(schema_and_synonyms_df, question):
     "Here is the question: " + question + "\nHere is the Database Schema Table:\n"
     )
 
-    schema_and_synonyms_df_filtered_for_data = prompt_for_df_from_token_limited_df(
-        identify_data_rows_prompt_directive, schema_and_synonyms_df)
-
-    logging.debug("schema_and_synonyms_df_filtered_for_data:")
-    logging.debug(f"PROMPT: {truncate_content(schema_and_synonyms_df_filtered_for_data)}\n")
-
-    identify_join_rows_prompt_directive = (
+def build_join_rows_directive(schema_and_synonyms_df_filtered_for_data):
+    return (
     "I have a table of columns that need to be joined and a full database schema table. "
     "Your task is to identify rows from the full database schema table that could be used to join the columns from the table of "
     "columns that need to be joined. The Database Schema Table is meta-information: each row represents a column in a specific"
     " table within the database. It details the 'table_name', 'column_name', 'data_type', and, if applicable, 'synonym_list' for"
     " that column. Only return the index numbers of those rows as a list. Do not include any descriptions or explanations.\n"
-    "Here is the table of columns that need to be joined:\n" + schema_and_synonyms_df_filtered_for_data.to_string() + 
+    "Here is the table of columns that need to be joined:\n" + render_schema(schema_and_synonyms_df_filtered_for_data) + 
     "\nHere is the Full Database Schema Table:\n"
     )
 
-    schema_and_synonyms_df_filtered_for_joins = prompt_for_df_from_token_limited_df(
-        identify_join_rows_prompt_directive, schema_and_synonyms_df)
-    
-    logging.debug("schema_and_synonyms_df_filtered_for_joins:")
-    logging.debug(f"PROMPT: {truncate_content(schema_and_synonyms_df_filtered_for_joins)}\n")
+def get_join_candidate_rows(schema_and_synonyms_df, candidate_df, schema_and_synonyms_df_filtered_for_data):
+    if candidate_df is schema_and_synonyms_df:
+        return schema_and_synonyms_df
+    # Join columns are looked for among shared column names of the selected tables only
+    return find_join_candidate_rows(schema_and_synonyms_df, schema_and_synonyms_df_filtered_for_data)
+
+def use_join_graph(join_graph):
+    return join_graph is not None and get_env_str_choice("JOIN_COLUMN_STRATEGY", "graph", ("graph", "llm")) == "graph"
 
+def merge_data_and_join_rows(schema_and_synonyms_df_filtered_for_data, schema_and_synonyms_df_filtered_for_joins):
     schema_and_synonyms_df_for_data_or_joins = schema_and_synonyms_df_filtered_for_data._append(
         schema_and_synonyms_df_filtered_for_joins)
-    
     schema_and_synonyms_df_for_data_or_joins.drop_duplicates(inplace=True)
+    return schema_and_synonyms_df_for_data_or_joins
+
+def filter_schema_and_synonyms_df(schema_and_synonyms_df, question, schema_index=None, join_graph=None):
+    candidate_df = prefilter_schema_rows(schema_and_synonyms_df, question, schema_index)
+
+    identify_data_rows_prompt_directive = build_data_rows_directive(question)
+
+    schema_and_synonyms_df_filtered_for_data = prompt_for_df_from_token_limited_df(
+        identify_data_rows_prompt_directive, candidate_df)
+
+    logging.debug("schema_and_synonyms_df_filtered_for_data:")
+    logging.debug(f"PROMPT: {truncate_content(schema_and_synonyms_df_filtered_for_data)}\n")
+
+    schema_and_synonyms_df_filtered_for_joins = None
+    if use_join_graph(join_graph):
+        with span("join_graph"):
+            schema_and_synonyms_df_filtered_for_joins = identify_join_rows_using_graph(
+                schema_and_synonyms_df, schema_and_synonyms_df_filtered_for_data, join_graph)
+
+    if schema_and_synonyms_df_filtered_for_joins is None:
+        schema_and_synonyms_df_filtered_for_joins = identify_join_rows_using_LLM(
+            schema_and_synonyms_df, candidate_df, schema_and_synonyms_df_filtered_for_data)
+    
+    logging.debug("schema_and_synonyms_df_filtered_for_joins:")
+    logging.debug(f"PROMPT: {truncate_content(schema_and_synonyms_df_filtered_for_joins)}\n")
+
+    schema_and_synonyms_df_for_data_or_joins = merge_data_and_join_rows(
+        schema_and_synonyms_df_filtered_for_data, schema_and_synonyms_df_filtered_for_joins)
 
     event_publisher.emit("filtered_schema_and_synonyms_set", schema_and_synonyms_df_for_data_or_joins)
 
@@ -130,3 +300,8 @@ def filter_schema_and_synonyms_df(schema_and_synonyms_df, question):
     logging.debug(f"PROMPT: {truncate_content(schema_and_synonyms_df_for_data_or_joins)}\n")
 
     return schema_and_synonyms_df_for_data_or_joins
+
+def identify_join_rows_using_LLM(schema_and_synonyms_df, candidate_df, schema_and_synonyms_df_filtered_for_data):
+    identify_join_rows_prompt_directive = build_join_rows_directive(schema_and_synonyms_df_filtered_for_data)
+    join_candidate_df = get_join_candidate_rows(schema_and_synonyms_df, candidate_df, schema_and_synonyms_df_filtered_for_data)
+    return prompt_for_df_from_token_limited_df(identify_join_rows_prompt_directive, join_candidate_df)
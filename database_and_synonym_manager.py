@@ -1,13 +1,43 @@
 from dotenv import load_dotenv
 import os
 import pandas as pd
-import openai
+from sqlalchemy.engine import make_url
 from execution_manager import run_sql
 
-def set_API_key():
+# SQLite has no information_schema; its catalog is read through the table-valued pragma functions
+SQLITE_SCHEMA_SQL = """
+SELECT m.name AS table_name, p.name AS column_name, lower(p.type) AS data_type
+FROM sqlite_master m
+JOIN pragma_table_info(m.name) p
+WHERE m.type IN ('table', 'view') AND m.name NOT LIKE 'sqlite_%'
+ORDER BY m.name, p.cid;
+"""
+
+SQLITE_FOREIGN_KEYS_SQL = """
+SELECT m.name AS table_name, f."from" AS column_name,
+       f."table" AS referenced_table_name, f."to" AS referenced_column_name
+FROM sqlite_master m
+JOIN pragma_foreign_key_list(m.name) f
+WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%';
+"""
+
+SQLITE_PRIMARY_KEYS_SQL = """
+SELECT m.name AS table_name, p.name AS column_name
+FROM sqlite_master m
+JOIN pragma_table_info(m.name) p
+WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' AND p.pk > 0;
+"""
+
+def is_sqlite(database_url: str) -> bool:
+    return make_url(database_url).get_backend_name() == "sqlite"
+
+def get_API_key():
     load_dotenv()
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    openai.api_key = openai_api_key
+    return os.getenv("OPENAI_API_KEY")
+
+def set_API_key():
+    import openai
+    openai.api_key = get_API_key()
 
 def set_database_connection(): 
     load_dotenv()
@@ -20,9 +50,40 @@ def set_schema(database_url: str):
     FROM information_schema.columns
     WHERE table_schema NOT IN ('pg_catalog', 'information_schema');
     """
-    schema_df = run_sql(schema_sql, database_url)
+    schema_df = run_sql(SQLITE_SCHEMA_SQL if is_sqlite(database_url) else schema_sql, database_url)
     return schema_df
 
+def set_foreign_keys(database_url: str):
+    foreign_keys_sql = """
+    SELECT kcu.table_name, kcu.column_name,
+           referenced.table_name AS referenced_table_name, referenced.column_name AS referenced_column_name
+    FROM information_schema.table_constraints tc
+    JOIN information_schema.key_column_usage kcu
+      ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+    JOIN information_schema.referential_constraints rc
+      ON rc.constraint_schema = tc.constraint_schema AND rc.constraint_name = tc.constraint_name
+    JOIN information_schema.key_column_usage referenced
+      ON referenced.constraint_schema = rc.unique_constraint_schema
+     AND referenced.constraint_name = rc.unique_constraint_name
+     AND referenced.ordinal_position = kcu.position_in_unique_constraint
+    WHERE tc.constraint_type = 'FOREIGN KEY'
+    AND tc.table_schema NOT IN ('pg_catalog', 'information_schema');
+    """
+    foreign_keys_df = run_sql(SQLITE_FOREIGN_KEYS_SQL if is_sqlite(database_url) else foreign_keys_sql, database_url)
+    return foreign_keys_df
+
+def set_primary_keys(database_url: str):
+    primary_keys_sql = """
+    SELECT kcu.table_name, kcu.column_name
+    FROM information_schema.table_constraints tc
+    JOIN information_schema.key_column_usage kcu
+      ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+    WHERE tc.constraint_type = 'PRIMARY KEY'
+    AND tc.table_schema NOT IN ('pg_catalog', 'information_schema');
+    """
+    primary_keys_df = run_sql(SQLITE_PRIMARY_KEYS_SQL if is_sqlite(database_url) else primary_keys_sql, database_url)
+    return primary_keys_df
+
 def add_synonyms_if_available(schema_df):
     if os.getenv("SYNONYM_TABLE_FILE_PATH") and os.path.exists(os.getenv("SYNONYM_TABLE_FILE_PATH")):
         schema_and_synonyms_df = add_synonyms(schema_df)
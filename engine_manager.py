@@ -0,0 +1,96 @@
+import asyncio
+import atexit
+import logging
+import threading
+import weakref
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from utils import get_env_int, get_env_bool
+
+# One pooled engine per database URL, shared by every caller in the process
+_engines = {}
+_engines_lock = threading.Lock()
+
+# Async connections belong to the event loop that opened them, so async engines are kept per loop
+_async_engines = weakref.WeakKeyDictionary()
+
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+def get_engine_options(database_url: str, is_async=False) -> dict:
+    backend_name = make_url(database_url).get_backend_name()
+    engine_options = {"pool_pre_ping": get_env_bool("DB_POOL_PRE_PING", True)}
+
+    # SQLite picks its own pool class, which does not accept the sizing arguments
+    if backend_name != "sqlite":
+        engine_options.update({
+            "pool_size": get_env_int("DB_POOL_SIZE", 5),
+            "max_overflow": get_env_int("DB_MAX_OVERFLOW", 10),
+            "pool_timeout": get_env_int("DB_POOL_TIMEOUT", 30),
+            "pool_recycle": get_env_int("DB_POOL_RECYCLE", 1800),
+        })
+
+    statement_timeout_ms = get_env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+    if statement_timeout_ms and backend_name == "postgresql":
+        if is_async:
+            engine_options["connect_args"] = {"server_settings": {"statement_timeout": str(statement_timeout_ms)}}
+        else:
+            engine_options["connect_args"] = {"options": f"-c statement_timeout={statement_timeout_ms}"}
+
+    return engine_options
+
+def get_engine(database_url: str):
+    engine = _engines.get(database_url)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        # Another thread may have created the engine while we waited for the lock
+        engine = _engines.get(database_url)
+        if engine is None:
+            logging.debug("Creating engine...")
+            engine = create_engine(database_url, **get_engine_options(database_url))
+            logging.debug(f"Engine created: {engine}")
+            _engines[database_url] = engine
+    return engine
+
+def dispose_engine(database_url: str):
+    with _engines_lock:
+        engine = _engines.pop(database_url, None)
+    if engine is not None:
+        engine.dispose()
+
+def dispose_engines():
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        logging.debug(f"Disposing engine: {engine}")
+        engine.dispose()
+
+def to_async_url(database_url: str) -> str:
+    url = make_url(database_url)
+    backend_name = url.get_backend_name()
+    if backend_name not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend_name} databases")
+    return url.set(drivername=f"{backend_name}+{ASYNC_DRIVERS[backend_name]}").render_as_string(hide_password=False)
+
+def get_async_engine(database_url: str):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    # Only called from the loop's own thread, so no lock is needed
+    engines = _async_engines.setdefault(asyncio.get_running_loop(), {})
+    engine = engines.get(database_url)
+    if engine is None:
+        logging.debug("Creating async engine...")
+        async_url = to_async_url(database_url)
+        engine = create_async_engine(async_url, **get_engine_options(async_url, is_async=True))
+        engines[database_url] = engine
+    return engine
+
+async def dispose_async_engines():
+    engines = _async_engines.pop(asyncio.get_running_loop(), {})
+    for engine in engines.values():
+        logging.debug(f"Disposing async engine: {engine}")
+        await engine.dispose()
+
+atexit.register(dispose_engines)
@@ -1,10 +1,21 @@
-import openai
+import importlib
 import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
 import pandas as pd
 from global_event_publisher import event_publisher
-from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
-from utils import truncate_content
+from utils import truncate_content, get_env_float, get_env_int, get_env_str_choice
+from engine_manager import get_engine
+from completion_cache_manager import get_completion_cache
+from result_cache_manager import get_result_cache
+from completion_scheduler_manager import get_completion_scheduler, is_retryable
+from sql_validation_manager import check_sql_before_execution
+from schema_format_manager import render_schema
+from model_registry_manager import get_stage_model
+from instrumentation_manager import span, record_completion_usage, record_retry, record_result_cache_hit
 
 class SQLExecutionError(Exception):
     """Custom exception for SQL execution errors."""
@@ -12,37 +23,166 @@ class SQLExecutionError(Exception):
         self.original_exception = str(original_exception)
         super().__init__(self.original_exception)
 
-def prompt_on_df(prompt_directive, df, model="gpt-3.5-turbo"):
-    prompt = (prompt_directive + df.to_string(index=True))
-    completion = openai.ChatCompletion.create(
-    model=model,
-    temperature=0,
-    messages=[{"role": "user", "content": prompt}]
-    )
+class FallbackBudgetExceeded(Exception):
+    """Raised when the fallback chain for a question runs out of time or tokens."""
+
+class FallbackBudget:
+    """Time and token allowance shared by every attempt in the fallback chain of one question."""
+
+    def __init__(self, max_seconds=None, max_tokens=None):
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.started_at = time.monotonic()
+        self.tokens_used = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_seconds=get_env_float("FALLBACK_MAX_SECONDS", 0) or None,
+                   max_tokens=get_env_int("FALLBACK_MAX_TOKENS", 0) or None)
+
+    def remaining_seconds(self):
+        if self.max_seconds is None:
+            return None
+        return self.max_seconds - (time.monotonic() - self.started_at)
+
+    def check(self, estimated_tokens=0):
+        remaining_seconds = self.remaining_seconds()
+        if remaining_seconds is not None and remaining_seconds <= 0:
+            raise FallbackBudgetExceeded(f"Fallback time budget of {self.max_seconds}s exceeded.")
+        if self.max_tokens is not None and self.tokens_used + estimated_tokens > self.max_tokens:
+            raise FallbackBudgetExceeded(f"Fallback token budget of {self.max_tokens} tokens exceeded.")
+
+    def charge(self, tokens):
+        self.tokens_used += tokens
+
+def estimate_message_tokens(messages):
+    # Rough pre-flight estimate; the exact count is charged from the completion's usage afterwards
+    return sum(len(message["content"]) for message in messages) // 4
+
+# Number of completion requests sent by this process, so tests can assert calls per question
+_completion_call_count = 0
+_completion_call_count_lock = threading.Lock()
+
+def get_completion_call_count():
+    return _completion_call_count
+
+def reset_completion_call_count():
+    global _completion_call_count
+    with _completion_call_count_lock:
+        _completion_call_count = 0
+
+# Object with the create/acreate interface of openai.ChatCompletion, such as the benchmark's replay backend
+_completion_backend = None
+
+def set_completion_backend(completion_backend):
+    global _completion_backend
+    _completion_backend = completion_backend
+
+def get_completion_backend():
+    # Looked up on every call so patches of openai.ChatCompletion take effect; openai itself (and aiohttp with it)
+    # is only imported by the first request that needs it
+    return _completion_backend or importlib.import_module("openai").ChatCompletion
+
+# Optional caps on concurrent model requests ("llm") and SQL executions ("database"), shared by every thread
+_concurrency_limits = {}
+
+def set_concurrency_limit(backend_name, limit):
+    _concurrency_limits[backend_name] = threading.BoundedSemaphore(limit) if limit else None
+
+@contextmanager
+def backend_slot(backend_name):
+    semaphore = _concurrency_limits.get(backend_name)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+def record_completion_call():
+    global _completion_call_count
+    with _completion_call_count_lock:
+        _completion_call_count += 1
+
+def get_completion_request_timeout(messages, budget=None):
+    # Checks the budget before a request and caps the request timeout by the time it has left
+    request_timeout = get_env_float("LLM_REQUEST_TIMEOUT", None)
+    if budget is not None:
+        budget.check(estimate_message_tokens(messages))
+        remaining_seconds = budget.remaining_seconds()
+        if remaining_seconds is not None:
+            request_timeout = min(request_timeout or remaining_seconds, remaining_seconds)
+    return request_timeout
+
+def charge_completion(completion, messages, budget=None):
+    if budget is not None:
+        budget.charge(completion.get("usage", {}).get("total_tokens", estimate_message_tokens(messages)))
+
+def create_chat_completion(messages, model=None, temperature=0, use_cache=True, budget=None):
+    model = model or get_stage_model("generation")
+    with span("llm_completion", model=model):
+        return create_chat_completion_in_span(messages, model, temperature, use_cache, budget)
+
+def create_chat_completion_in_span(messages, model, temperature, use_cache, budget):
+    request_timeout = get_completion_request_timeout(messages, budget)
+
+    completion_cache = get_completion_cache()
+    use_cache = use_cache and completion_cache.enabled
+    if use_cache:
+        cache_key = completion_cache.make_key(model, temperature, messages)
+        response = completion_cache.get(cache_key)
+        if response is not None:
+            logging.debug("Completion cache hit.")
+            record_completion_usage(model, cache_hit=True)
+            return response
+
+    def request():
+        record_completion_call()
+        with backend_slot("llm"):
+            return get_completion_backend().create(
+                model=model,
+                temperature=temperature,
+                messages=messages,
+                request_timeout=request_timeout
+            )
+
+    # Waits for rate-limit capacity and retries rate-limit and server errors
+    completion = get_completion_scheduler().run(request, messages, model, budget=budget)
+    response = completion.choices[0].message['content']
+    charge_completion(completion, messages, budget)
+    record_completion_usage(model, completion.get("usage"))
+
+    if use_cache:
+        completion_cache.set(cache_key, response)
+    return response
+
+def prompt_on_df(prompt_directive, df, model=None):
+    prompt = (prompt_directive + render_schema(df))
+    response = create_chat_completion([{"role": "user", "content": prompt}], model=model)
     logging.debug(f"PROMPT: {truncate_content(prompt_directive)}")
-    logging.debug(f"RESPONSE: {truncate_content(completion.choices[0].message['content'])}\n")
-    return completion.choices[0].message['content']
-
-def prompt_on_directive(messages, model="gpt-3.5-turbo"):
-    completion = openai.ChatCompletion.create(
-        model=model,
-        temperature=0,
-        messages=messages
-    )
+    logging.debug(f"RESPONSE: {truncate_content(response)}\n")
+    return response
+
+def prompt_on_directive(messages, model=None, budget=None):
+    response = create_chat_completion(messages, model=model, budget=budget)
     logging.debug(f"PROMPT: {truncate_content(messages)}")
-    logging.debug(f"RESPONSE: {truncate_content(completion.choices[0].message['content'])}\n")
-    return completion.choices[0].message['content']
+    logging.debug(f"RESPONSE: {truncate_content(response)}\n")
+    return response
+
+def get_read_sql_options():
+    # pyarrow-backed columns keep text in Arrow buffers instead of one Python object per value
+    dtype_backend = get_env_str_choice("SQL_DTYPE_BACKEND", "numpy", ("numpy", "pyarrow"))
+    return {} if dtype_backend == "numpy" else {"dtype_backend": dtype_backend}
 
 def run_sql(sql: str, database_url: str) -> pd.DataFrame:
     logging.debug("About to try executing SQL...")  
     
     try:
-        logging.debug("Creating engine...")  
-        engine = create_engine(database_url)
-        logging.debug(f"Engine created: {engine}")
+        engine = get_engine(database_url)
 
         logging.debug("Executing SQL query...")  
-        sql_answer_df = pd.read_sql_query(sql, engine)
+        with span("run_sql") as sql_span, backend_slot("database"):
+            sql_answer_df = pd.read_sql_query(sql, engine, **get_read_sql_options())
+            sql_span.set(rows=len(sql_answer_df))
         return sql_answer_df
     
     except SQLAlchemyError as e:
@@ -57,8 +197,116 @@ def run_sql(sql: str, database_url: str) -> pd.DataFrame:
         # Re-raise as a custom exception
         raise SQLExecutionError(e)
 
-def generate_sql_query(question, filtered_schema_and_synonyms_df):
-    prompt_directive = (
+def wrap_sql_with_limit(sql: str, limit: int) -> str:
+    # Only plain queries can be wrapped; anything else runs unchanged
+    sql = sql.strip().rstrip(";").strip()
+    if not re.match(r"(?is)^\s*(select|with)\b", sql):
+        return sql
+    return f"SELECT * FROM (\n{sql}\n) AS preview LIMIT {int(limit)}"
+
+class SQLResultStream:
+    """Iterates over a query result in DataFrame chunks, stopping once the row or byte budget is spent."""
+
+    def __init__(self, sql, database_url, chunksize=10000, max_rows=None, max_bytes=None, preview_rows=None):
+        if preview_rows is not None:
+            # Fetch one extra row so a preview can tell whether it cut the result short
+            sql = wrap_sql_with_limit(sql, preview_rows + 1)
+            max_rows = preview_rows if max_rows is None else min(max_rows, preview_rows)
+        self.sql = sql
+        self.database_url = database_url
+        self.chunksize = chunksize
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.row_count = 0
+        self.byte_count = 0
+        self.truncated = False
+
+    def __iter__(self):
+        logging.debug("Streaming SQL query...")
+        try:
+            engine = get_engine(self.database_url)
+            with engine.connect() as connection:
+                yield from self.iter_connection(connection)
+
+        except SQLAlchemyError as e:
+            logging.debug(e.orig)
+            raise SQLExecutionError(e.orig)
+
+        except Exception as e:
+            logging.debug(e)
+            raise SQLExecutionError(e)
+
+    def iter_connection(self, connection):
+        # Streams over a connection the caller owns, such as the sync side of an async connection
+        connection = connection.execution_options(stream_results=True, max_row_buffer=self.chunksize)
+        for chunk in pd.read_sql_query(self.sql, connection, chunksize=self.chunksize,
+                                       **get_read_sql_options()):
+            chunk = self._trim_to_budget(chunk)
+            if len(chunk) or self.row_count == 0:
+                yield chunk
+            if self.truncated:
+                logging.debug(f"Result truncated after {self.row_count} rows and {self.byte_count} bytes.")
+                return
+
+    def _trim_to_budget(self, chunk):
+        if self.max_rows is not None and self.row_count + len(chunk) > self.max_rows:
+            chunk = chunk.iloc[:self.max_rows - self.row_count]
+            self.truncated = True
+
+        chunk_bytes = int(chunk.memory_usage(index=False, deep=True).sum())
+        if self.max_bytes is not None and self.byte_count + chunk_bytes > self.max_bytes and len(chunk):
+            bytes_per_row = chunk_bytes / len(chunk)
+            chunk = chunk.iloc[:max(int((self.max_bytes - self.byte_count) // bytes_per_row), 0)]
+            chunk_bytes = int(chunk.memory_usage(index=False, deep=True).sum())
+            self.truncated = True
+
+        self.row_count += len(chunk)
+        self.byte_count += chunk_bytes
+        return chunk
+
+    def to_dataframe(self, connection=None) -> pd.DataFrame:
+        chunks = list(self if connection is None else self.iter_connection(connection))
+        sql_answer_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        sql_answer_df.attrs["truncated"] = self.truncated
+        return sql_answer_df
+
+def stream_sql(sql: str, database_url: str, chunksize=None, max_rows=None, max_bytes=None, preview_rows=None) -> SQLResultStream:
+    return SQLResultStream(sql, database_url, chunksize=chunksize or get_env_int("SQL_CHUNK_SIZE", 10000),
+                           max_rows=max_rows, max_bytes=max_bytes, preview_rows=preview_rows)
+
+def get_answer_result_budget():
+    return {"max_rows": get_env_int("SQL_MAX_ROWS", 0) or None,
+            "max_bytes": get_env_int("SQL_MAX_BYTES", 0) or None,
+            "preview_rows": get_env_int("SQL_PREVIEW_ROWS", 0) or None}
+
+def execute_answer_sql(sql: str, database_url: str, result_budget: dict) -> pd.DataFrame:
+    if not any(result_budget.values()):
+        return run_sql(sql, database_url)
+
+    with span("run_sql", streamed=True) as sql_span, backend_slot("database"):
+        sql_answer_df = stream_sql(sql, database_url, **result_budget).to_dataframe()
+        sql_span.set(rows=len(sql_answer_df), truncated=sql_answer_df.attrs["truncated"])
+    return sql_answer_df
+
+def run_answer_sql(sql: str, database_url: str) -> pd.DataFrame:
+    # Runs a generated query under the configured result budget; run_sql stays unbounded for internal queries.
+    # Results are reused until they expire or a table they read changes.
+    result_budget = get_answer_result_budget()
+    result_cache = get_result_cache()
+    sql_answer_df = result_cache.get(sql, database_url, result_budget) if result_cache.enabled else None
+    if sql_answer_df is not None:
+        logging.debug("Result cache hit.")
+        record_result_cache_hit()
+    else:
+        sql_answer_df = execute_answer_sql(sql, database_url, result_budget)
+        if result_cache.enabled:
+            result_cache.set(sql, database_url, sql_answer_df, result_budget)
+    if sql_answer_df.attrs.get("truncated"):
+        event_publisher.emit("answer_truncated_set", len(sql_answer_df))
+    return sql_answer_df
+
+def build_sql_generation_directive(question):
+    return (
         "I provide a question and a Database Schema Table and you provide SQL."
         "The Database Schema Table is meta-information: each row represents a column in a specific table within the "
         "database. It details the 'table_name', 'column_name', 'data_type', and, if applicable, 'synonym_list' for that column."
@@ -67,153 +315,232 @@ def generate_sql_query(question, filtered_schema_and_synonyms_df):
         question +
         "Here is the Database Schema Table:\n"
     )
-    sql_query = prompt_on_df(prompt_directive, filtered_schema_and_synonyms_df)
+
+def generate_sql_query(question, filtered_schema_and_synonyms_df):
+    prompt_directive = build_sql_generation_directive(question)
+    with span("generate_sql", schema_rows=len(filtered_schema_and_synonyms_df)):
+        sql_query = prompt_on_df(prompt_directive, filtered_schema_and_synonyms_df, model=get_stage_model("generation"))
     event_publisher.emit("initial_sql_query_set", sql_query)
     return sql_query
 
-def execute_sql_with_fallback(sql_query, database_url, question, filtered_schema_and_synonyms_df):
+MAX_SQL_FIX_RETRIES = 5
+
+def execute_sql_with_fallback(sql_query, database_url, question, filtered_schema_and_synonyms_df, return_sql_query=False,
+                              schema_df=None):
     
     conversation = []
+    # The query that finally executed successfully, if any
+    answered_sql_query = None
+    budget = FallbackBudget.from_env()
+
+    def execute_sql_with_error_analysis_subcall(sql_query, exception):
+        nonlocal answered_sql_query
+        sql_result, answered_sql_query = execute_sql_with_error_analysis(
+            sql_query, database_url, question, filtered_schema_and_synonyms_df, exception, return_sql_query=True,
+            budget=budget)
+        return sql_result
 
     def execute_sql_with_fallback_subcall(sql_query, database_url, question, filtered_schema_and_synonyms_df, conversation = None, retry_count=0, last_sql_query=None):
+        nonlocal answered_sql_query
         try:
+            budget.check()
             event_publisher.emit(f"fallback_query_{retry_count}_set", sql_query)
-            sql_result = run_sql(sql_query, database_url)
+            if retry_count:
+                record_retry()
+            with span("fallback_attempt", retry_count=retry_count):
+                # Catches unknown tables and columns locally, without a database or model round trip
+                check_sql_before_execution(sql_query, database_url, schema_df)
+                sql_result = run_answer_sql(sql_query, database_url)
+            answered_sql_query = sql_query
             return sql_result
         except SQLExecutionError as e:
             event_publisher.emit(f"fallback_exception_{retry_count}_set", e.original_exception)
             if sql_query == last_sql_query:
                 logging.debug("SQL query is the same for two loops in a row. Switching to error analysis.")
-                return execute_sql_with_error_analysis(sql_query, database_url, question, filtered_schema_and_synonyms_df, e.original_exception)
+                return execute_sql_with_error_analysis_subcall(sql_query, e.original_exception)
             
-            if retry_count < 5:
-                logging.debug(f"An error occurred while executing SQL: {e.original_exception}. Retrying... ({retry_count + 1}/5)\n")
+            if retry_count < MAX_SQL_FIX_RETRIES:
+                logging.debug(f"An error occurred while executing SQL: {e.original_exception}. Retrying... ({retry_count + 1}/{MAX_SQL_FIX_RETRIES})\n")
                 try:
                     # Assuming `attempt_to_fix_sql_query` returns a modified SQL query
-                    conversation = attempt_to_fix_sql_query(sql_query, question, e.original_exception, filtered_schema_and_synonyms_df, conversation, retry_count)
+                    with span("fix_sql", retry_count=retry_count):
+                        conversation = attempt_to_fix_sql_query(sql_query, question, e.original_exception, filtered_schema_and_synonyms_df, conversation, retry_count, budget=budget)
                     fixed_sql_query = conversation[-1]["content"]
 
                     # Recursive call with incremented retry_count and last sql query updated
                     return execute_sql_with_fallback_subcall(fixed_sql_query, database_url, question, filtered_schema_and_synonyms_df, conversation, retry_count + 1, last_sql_query=sql_query)
-                    
+
+                except FallbackBudgetExceeded:
+                    raise
                 except Exception as fix_e:
-                    logging.debug(f"An error occurred while attempting to fix the SQL: {fix_e}. Retrying... ({retry_count + 1}/5)\n")
+                    if is_retryable(fix_e):
+                        # The model stayed unavailable through the scheduler's retries; another fix attempt would too
+                        raise
+                    logging.debug(f"An error occurred while attempting to fix the SQL: {fix_e}. Retrying... ({retry_count + 1}/{MAX_SQL_FIX_RETRIES})\n")
                     fixed_sql_query = conversation[-1]["content"]
                     return execute_sql_with_fallback_subcall(fixed_sql_query, database_url, question, filtered_schema_and_synonyms_df, conversation, retry_count + 1, last_sql_query=sql_query)
             else:
                 logging.debug(f"Exceeded maximum number of retries. Latest error: {e.original_exception}. Switching to error analysis.")
-                return execute_sql_with_error_analysis(sql_query, database_url, question, filtered_schema_and_synonyms_df, e.original_exception)
+                return execute_sql_with_error_analysis_subcall(sql_query, e.original_exception)
 
-    return execute_sql_with_fallback_subcall(sql_query, database_url, question, filtered_schema_and_synonyms_df, conversation, retry_count=0, last_sql_query=None)
+    try:
+        with span("execute_sql"):
+            sql_result = execute_sql_with_fallback_subcall(sql_query, database_url, question, filtered_schema_and_synonyms_df, conversation, retry_count=0, last_sql_query=None)
+    except FallbackBudgetExceeded as e:
+        logging.debug(f"{e} Quitting.")
+        event_publisher.emit("fallback_budget_exceeded_set", str(e))
+        sql_result = "Unable to answer."
+    except Exception as e:
+        if not is_retryable(e):
+            raise
+        # The model stayed rate limited or unavailable through every scheduler retry
+        logging.debug(f"Completion failed after retries: {e}. Quitting.")
+        event_publisher.emit("completion_unavailable_set", str(e))
+        sql_result = "Unable to answer."
+    if return_sql_query:
+        return sql_result, answered_sql_query
+    return sql_result
 
-def attempt_to_fix_sql_query(sql_query, question, exception, reference_df, conversation, retry_count):
+def build_first_fix_directive(sql_query, question, exception, reference_df):
+    return (
+        "I provide you with an SQL query that has produced an error, along with the original question it's meant to answer, "
+        "the specific error message, and a Database Schema Table. The Database Schema Table is meta-information: each row "
+        "represents a column in a specific table within the database. It details the 'table_name', 'column_name', "
+        "'data_type', and, if applicable, 'synonym_list' for that column. Your task is to diagnose the SQL error based on the "
+        "given information and produce a corrected query that should successfully execute and be different from the original one. "
+        "Please only respond with the corrected SQL code, without any additional explanations.\n"
+        "Here is the original question the query is meant to answer: " +
+        question +
+        "\nHere is the original query:\n" +
+        sql_query +
+        "\nHere is the error message:\n" +
+        exception +
+        "\nHere is the Database Schema Table:\n" +
+        render_schema(reference_df)
+    )
+
+def build_next_fix_directive(exception):
+    return (
+        "The SQL query you supplied returned the following error message:\n" + exception +
+        "\nPlease provide a new, corrected SQL query that should successfully execute and is "
+        "different from the original. Your response must be different from the original query "
+        "and it must answer the user's original question."
+        "Please only respond with the corrected SQL code, without additional explanations."
+    )
+
+def attempt_to_fix_sql_query(sql_query, question, exception, reference_df, conversation, retry_count, budget=None):
     if retry_count == 0:
-        prompt_directive = (
-            "I provide you with an SQL query that has produced an error, along with the original question it's meant to answer, "
-            "the specific error message, and a Database Schema Table. The Database Schema Table is meta-information: each row "
-            "represents a column in a specific table within the database. It details the 'table_name', 'column_name', "
-            "'data_type', and, if applicable, 'synonym_list' for that column. Your task is to diagnose the SQL error based on the "
-            "given information and produce a corrected query that should successfully execute and be different from the original one. "
-            "Please only respond with the corrected SQL code, without any additional explanations.\n"
-            "Here is the original question the query is meant to answer: " +
-            question +
-            "\nHere is the original query:\n" +
-            sql_query +
-            "\nHere is the error message:\n" +
-            exception +
-            "\nHere is the Database Schema Table:\n" +
-            reference_df.to_string()
-        )
+        prompt_directive = build_first_fix_directive(sql_query, question, exception, reference_df)
         conversation.append({"role": "user", "content": prompt_directive})
 
-        prompt = (prompt_directive)
-        completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        temperature=0,
-        messages=[{"role": "user", "content": prompt}]
-        )
-        logging.debug(f"PROMPT: {truncate_content(prompt_directive)}")
-        logging.debug(f"RESPONSE: {truncate_content(completion.choices[0].message['content'])}\n")
-        fixed_sql_result = completion.choices[0].message['content']
+        fixed_sql_result = prompt_on_directive([{"role": "user", "content": prompt_directive}],
+                                               model=get_stage_model("repair"), budget=budget)
 
         conversation.append({"role": "assistant", "content": fixed_sql_result})
         logging.debug(f"Original SQL query: {sql_query}\n")
         logging.debug(f"New SQL query: {fixed_sql_result}\n")
     else:
-        prompt_directive = (
-            "The SQL query you supplied returned the following error message:\n" + exception +
-            "\nPlease provide a new, corrected SQL query that should successfully execute and is "
-            "different from the original. Your response must be different from the original query "
-            "and it must answer the user's original question."
-            "Please only respond with the corrected SQL code, without additional explanations."
-        )
+        prompt_directive = build_next_fix_directive(exception)
         conversation.append({"role": "user", "content": prompt_directive})
-        fixed_sql_result = prompt_on_directive(conversation)
+        fixed_sql_result = prompt_on_directive(conversation, model=get_stage_model("repair"), budget=budget)
         conversation.append({"role": "assistant", "content": fixed_sql_result})
         logging.debug(f"New SQL query: {fixed_sql_result}\n")
     return conversation
 
-def execute_sql_with_error_analysis(sql_query, database_url, question, filtered_schema_and_synonyms_df, exception):
-    conversation = []
+ERROR_ANALYSIS_SECTIONS = ["SUMMARY", "INTENT", "ERROR", "SCHEMA CHANGES", "STEPS", "SQL"]
+
+def parse_error_analysis_sections(response):
+    # Splits a single-pass repair response into its labelled sections, in ERROR_ANALYSIS_SECTIONS order
+    section_pattern = re.compile(r"^[#*\s]*(" + "|".join(ERROR_ANALYSIS_SECTIONS) + r")[*\s]*:[*]*[ \t]*", re.M)
+    matches = list(section_pattern.finditer(response))
+    sections = {}
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        sections[match.group(1)] = response[match.end():next_match.start() if next_match else len(response)].strip()
 
-    # Set Direction and Summarize the User's Original Question
-    directive1 = (
+    sql = sections.get("SQL", response if not matches else "")
+    fenced_sql = re.search(r"```(?:sql)?\s*(.*?)```", sql, re.S | re.I)
+    sections["SQL"] = (fenced_sql.group(1) if fenced_sql else sql).strip()
+    return [sections.get(section, "") for section in ERROR_ANALYSIS_SECTIONS]
+
+def build_single_pass_repair_directive(sql_query, question, filtered_schema_and_synonyms_df, exception):
+    return (
+        "I provide you with an SQL query that has produced an error, along with the original question it's meant to answer, "
+        "the specific error message, and a Database Schema Table. The Database Schema Table is meta-information: each row "
+        "represents a column in a specific table within the database. It details the 'table_name', 'column_name', "
+        "'data_type', and, if applicable, 'synonym_list' for that column. Diagnose the error and correct the query. "
+        "Answer with exactly these labelled sections, in this order, and nothing else:\n"
+        "SUMMARY: a one-sentence summary of the user's question.\n"
+        "INTENT: what the original SQL query is trying to do.\n"
+        "ERROR: what the error message means.\n"
+        "SCHEMA CHANGES: the changes the schema suggests for the query.\n"
+        "STEPS: the steps to correct the query.\n"
+        "SQL: only the corrected SQL query, which must execute successfully.\n"
+        "\nOriginal Question: " + question + "\nOriginal SQL Query: " + sql_query + "\nError Message: " + exception +
+        "\nDatabase Schema:\n" + render_schema(filtered_schema_and_synonyms_df)
+    )
+
+def repair_sql_in_single_pass(sql_query, question, filtered_schema_and_synonyms_df, exception, budget=None):
+    directive = build_single_pass_repair_directive(sql_query, question, filtered_schema_and_synonyms_df, exception)
+    response = prompt_on_directive([{"role": "user", "content": directive}], model=get_stage_model("repair"), budget=budget)
+    sections = parse_error_analysis_sections(response)
+    for section_number, section_content in enumerate(sections, start=1):
+        event_publisher.emit(f"error_analysis_content_{section_number}_set", section_content)
+    return sections[-1]
+
+def execute_sql_with_error_analysis(sql_query, database_url, question, filtered_schema_and_synonyms_df, exception, return_sql_query=False, budget=None):
+    strategy = get_env_str_choice("ERROR_ANALYSIS_STRATEGY", "single_pass", ("single_pass", "conversation"))
+    with span("error_analysis", strategy=strategy):
+        if strategy == "single_pass":
+            corrected_sql_query = repair_sql_in_single_pass(sql_query, question, filtered_schema_and_synonyms_df, exception, budget=budget)
+        else:
+            corrected_sql_query = analyse_sql_error_in_conversation(sql_query, question, filtered_schema_and_synonyms_df, exception, budget=budget)
+
+    try:
+        if budget is not None:
+            budget.check()
+        sql_result = run_answer_sql(corrected_sql_query, database_url)
+        return (sql_result, corrected_sql_query) if return_sql_query else sql_result
+    except SQLExecutionError as e:
+        logging.debug("Corrected SQL query still produces an error. Quitting.")
+        return ("Unable to answer.", None) if return_sql_query else "Unable to answer."
+
+def build_error_analysis_directives(sql_query, question, filtered_schema_and_synonyms_df, exception):
+    return [
+        # Set Direction and Summarize the User's Original Question
         "I provide you with an SQL query that has produced an error, along with the original question it's meant to answer,"
         "the specific error message, and a Database Schema Table. Your task is to help diagnose and correct the issue. "
-        "Please start by summarizing the user's original question: " + question
-                )
-    conversation.append({"role": "user", "content": directive1})
-    summary_response = prompt_on_directive(conversation)
-    conversation.append({"role": "assistant", "content": summary_response})
-    event_publisher.emit("error_analysis_content_1_set", summary_response)
-
-    # Original SQL Query Intent
-    directive2 = "What do you think the original SQL query is trying to do?\nSQL Query: " + sql_query
-    conversation.append({"role": "user", "content": directive2})
-    intent_response = prompt_on_directive(conversation)
-    conversation.append({"role": "assistant", "content": intent_response})
-    event_publisher.emit("error_analysis_content_2_set", intent_response)
-
-    # Error Message Interpretation
-    directive3 = "What do you make of the following error message?\nError Message: " + exception
-    conversation.append({"role": "user", "content": directive3})
-    error_interpretation = prompt_on_directive(conversation)
-    conversation.append({"role": "assistant", "content": error_interpretation})
-    event_publisher.emit("error_analysis_content_3_set", error_interpretation)
-
-    # Schema-based Revision Needs
-    directive4 = (
+        "Please start by summarizing the user's original question: " + question,
+
+        # Original SQL Query Intent
+        "What do you think the original SQL query is trying to do?\nSQL Query: " + sql_query,
+
+        # Error Message Interpretation
+        "What do you make of the following error message?\nError Message: " + exception,
+
+        # Schema-based Revision Needs
         "Based on this Database Schema, what changes would you suggest for the original query? The Database Schema Table is"
         "meta-information: each row represents a column in a specific table within the database. It details the 'table_name',"
-        " 'column_name', 'data_type', and, if applicable, 'synonym_list' for that column. \nDatabase Schema:\n" + 
-        filtered_schema_and_synonyms_df.to_string()
-            )
-    conversation.append({"role": "user", "content": directive4})
-    schema_revision_suggestion = prompt_on_directive(conversation)
-    conversation.append({"role": "assistant", "content": schema_revision_suggestion})
-    event_publisher.emit("error_analysis_content_4_set", schema_revision_suggestion)
-
-    # Steps to Fix SQL Query
-    directive5 = "What are the steps to correct the SQL query based on the above information?"
-    conversation.append({"role": "user", "content": directive5})
-    steps_to_fix = prompt_on_directive(conversation)
-    conversation.append({"role": "assistant", "content": steps_to_fix})
-    event_publisher.emit("error_analysis_content_5_set", steps_to_fix)
-
-    # Corrected SQL Query
-    directive6 = (
+        " 'column_name', 'data_type', and, if applicable, 'synonym_list' for that column. \nDatabase Schema:\n" +
+        render_schema(filtered_schema_and_synonyms_df),
+
+        # Steps to Fix SQL Query
+        "What are the steps to correct the SQL query based on the above information?",
+
+        # Corrected SQL Query
         "Based on all the information and suggestions, please provide a corrected SQL query that should successfully execute. "
         "Please only respond with the corrected SQL code, without additional explanations. "
         "For example, do not preface your response with 'The corrected SQL query is...'\n"
-        "\nOriginal Question:"  + question + "\nOriginal SQL Query: " + sql_query + "\nError Message: " + exception + 
-        "\nDatabase Schema:\n" + filtered_schema_and_synonyms_df.to_string()      
-                )  
-    conversation.append({"role": "user", "content": directive6})
-    corrected_sql_query = prompt_on_directive(conversation)
-    event_publisher.emit("error_analysis_content_6_set", corrected_sql_query)
-    try:
-        sql_result = run_sql(corrected_sql_query, database_url)
-        return sql_result
-    except SQLExecutionError as e:
-        logging.debug("Corrected SQL query still produces an error. Quitting.")
-        return "Unable to answer."
+        "\nOriginal Question:"  + question + "\nOriginal SQL Query: " + sql_query + "\nError Message: " + exception +
+        "\nDatabase Schema:\n" + render_schema(filtered_schema_and_synonyms_df),
+    ]
+
+def analyse_sql_error_in_conversation(sql_query, question, filtered_schema_and_synonyms_df, exception, budget=None):
+    conversation = []
+    directives = build_error_analysis_directives(sql_query, question, filtered_schema_and_synonyms_df, exception)
+    for step_number, directive in enumerate(directives, start=1):
+        conversation.append({"role": "user", "content": directive})
+        response = prompt_on_directive(conversation, model=get_stage_model("repair"), budget=budget)
+        conversation.append({"role": "assistant", "content": response})
+        event_publisher.emit(f"error_analysis_content_{step_number}_set", response)
+    # The last answer is the corrected SQL query
+    return response
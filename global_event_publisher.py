@@ -1,14 +1,121 @@
+import contextvars
+import fnmatch
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+WILDCARD_CHARACTERS = ("*", "?", "[")
+
+_STOP = object()
+
 class EventPublisher:
-    def __init__(self):
+    """Calls listeners for named events. A request-scoped publisher also forwards each event to its parent.
+
+    Listeners for an exact event name are called with the data; listeners for a wildcard pattern such as
+    "fallback_*" are called with the data and the event name. With background=True, emit only queues the
+    event and a worker thread calls the listeners, so slow listeners never hold up the caller.
+    """
+
+    def __init__(self, parent=None, background=False):
         self.listeners = {}
-        
+        self.pattern_listeners = []
+        self.parent = parent
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+        if background:
+            self._queue = queue.SimpleQueue()
+            self._worker = threading.Thread(target=self._run_background_dispatch, args=(self._queue,), daemon=True)
+            self._worker.start()
+
     def emit(self, event_name, data):
+        # Queued under the lock, so close cannot put its stop marker between the check and the put
+        with self._lock:
+            event_queue = self._queue
+            if event_queue is not None:
+                event_queue.put((event_name, data))
+        if event_queue is None:
+            self._dispatch(event_name, data)
+        if self.parent is not None:
+            self.parent.emit(event_name, data)
+
+    def on(self, event_name, listener):
+        with self._lock:
+            if any(character in event_name for character in WILDCARD_CHARACTERS):
+                self.pattern_listeners = self.pattern_listeners + [(event_name, listener)]
+            else:
+                self.listeners[event_name] = self.listeners.get(event_name, []) + [listener]
+        return lambda: self.off(event_name, listener)
+
+    def off(self, event_name, listener):
+        with self._lock:
+            if (event_name, listener) in self.pattern_listeners:
+                self.pattern_listeners = [entry for entry in self.pattern_listeners if entry != (event_name, listener)]
+            elif listener in self.listeners.get(event_name, []):
+                remaining_listeners = [l for l in self.listeners[event_name] if l is not listener]
+                if remaining_listeners:
+                    self.listeners[event_name] = remaining_listeners
+                else:
+                    del self.listeners[event_name]
+
+    def close(self):
+        # Waits for queued events to reach their listeners; later events are dispatched synchronously
+        with self._lock:
+            worker = self._worker
+            if self._queue is None:
+                return
+            self._queue.put(_STOP)
+            self._queue = None
+            self._worker = None
+        worker.join()
+
+    def _dispatch(self, event_name, data):
+        # Listener lists are replaced rather than mutated, so a listener may unsubscribe while being called
         for listener in self.listeners.get(event_name, []):
             listener(data)
+        for pattern, listener in self.pattern_listeners:
+            if fnmatch.fnmatchcase(event_name, pattern):
+                listener(data, event_name)
+
+    def _run_background_dispatch(self, event_queue):
+        while True:
+            event = event_queue.get()
+            if event is _STOP:
+                return
+            try:
+                self._dispatch(*event)
+            except Exception:
+                logging.exception(f"Event listener for {event[0]} failed.")
+
+_process_event_publisher = EventPublisher()
+_current_event_publisher = contextvars.ContextVar("current_event_publisher", default=None)
+
+def get_event_publisher():
+    return _current_event_publisher.get() or _process_event_publisher
+
+@contextmanager
+def request_event_scope(publisher=None, background=False):
+    # Events emitted inside the scope, including from asyncio tasks it starts, go to a publisher of its own
+    if publisher is None:
+        publisher = EventPublisher(parent=get_event_publisher(), background=background)
+    token = _current_event_publisher.set(publisher)
+    try:
+        yield publisher
+    finally:
+        _current_event_publisher.reset(token)
+        publisher.close()
+
+class CurrentEventPublisher:
+    """Forwards to the publisher of the current request scope, or the process-wide one outside any scope."""
+
+    def emit(self, event_name, data):
+        get_event_publisher().emit(event_name, data)
 
     def on(self, event_name, listener):
-        if event_name not in self.listeners:
-            self.listeners[event_name] = []
-        self.listeners[event_name].append(listener)
+        return get_event_publisher().on(event_name, listener)
+
+    def off(self, event_name, listener):
+        get_event_publisher().off(event_name, listener)
 
-event_publisher = EventPublisher()
\ No newline at end of file
+event_publisher = CurrentEventPublisher()
@@ -0,0 +1,220 @@
+import contextvars
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import pandas as pd
+from utils import get_env_bool, get_env_int, get_env_str_choice
+from model_registry_manager import calculate_completion_cost
+
+# Counters that also add up into every enclosing span, so a stage reports the tokens of the calls inside it
+ROLLUP_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "cost_usd", "cache_hits", "llm_calls", "retries")
+
+class Span:
+    """Timing and counters for one pipeline stage."""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_time = time.time()
+        self.duration = None
+        self._started_at = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, value=1):
+        # Pipeline stages run model calls on worker threads, so counters are updated under a lock
+        with _span_lock:
+            span = self
+            while span is not None:
+                span.attributes[key] = span.attributes.get(key, 0) + value
+                span = span.parent if key in ROLLUP_ATTRIBUTES else None
+
+    def end(self):
+        self.duration = time.perf_counter() - self._started_at
+
+    def to_record(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent.span_id if self.parent is not None else None,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+    def to_otel_record(self):
+        # Shape of a span in the OpenTelemetry protocol's JSON encoding
+        start_time_ns = int(self.start_time * 1e9)
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent.span_id if self.parent is not None else "",
+            "name": self.name,
+            "startTimeUnixNano": str(start_time_ns),
+            "endTimeUnixNano": str(start_time_ns + int(self.duration * 1e9)),
+            "attributes": [{"key": key, "value": to_otel_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 1 if self.status == "ok" else 2},
+        }
+
+def to_otel_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+_span_lock = threading.Lock()
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class SpanRecorder:
+    """Keeps recently finished spans for reports and appends each one to a JSON lines file if configured."""
+
+    def __init__(self, max_spans=10000, file_path=None, export_format="jsonl"):
+        self.finished_spans = deque(maxlen=max_spans)
+        self.file_path = file_path
+        self.export_format = export_format
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        line = None
+        if self.file_path:
+            record = span.to_otel_record() if self.export_format == "otlp" else span.to_record()
+            line = json.dumps(record, default=str)
+        with self._lock:
+            self.finished_spans.append(span)
+            if line is not None:
+                with open(self.file_path, "a") as f:
+                    f.write(line + "\n")
+
+    def spans(self):
+        with self._lock:
+            return list(self.finished_spans)
+
+    def clear(self):
+        with self._lock:
+            self.finished_spans.clear()
+
+_span_recorder = None
+_span_recorder_lock = threading.Lock()
+
+def get_span_recorder():
+    global _span_recorder
+    if _span_recorder is None:
+        with _span_recorder_lock:
+            if _span_recorder is None:
+                _span_recorder = SpanRecorder(
+                    max_spans=get_env_int("INSTRUMENTATION_MAX_SPANS", 10000),
+                    file_path=os.getenv("INSTRUMENTATION_FILE_PATH"),
+                    export_format=get_env_str_choice("INSTRUMENTATION_FORMAT", "jsonl", ("jsonl", "otlp")))
+    return _span_recorder
+
+def set_span_recorder(span_recorder):
+    global _span_recorder
+    _span_recorder = span_recorder
+
+def get_current_span():
+    return _current_span.get()
+
+@contextmanager
+def span(name, **attributes):
+    if not get_env_bool("INSTRUMENTATION_ENABLED", True):
+        yield Span(name, attributes=attributes)
+        return
+
+    current_span = Span(name, parent=_current_span.get(), attributes=attributes)
+    token = _current_span.set(current_span)
+    try:
+        yield current_span
+    except BaseException as e:
+        current_span.status = "error"
+        current_span.set(error=type(e).__name__)
+        raise
+    finally:
+        current_span.end()
+        _current_span.reset(token)
+        get_span_recorder().record(current_span)
+
+def record_completion_usage(model, usage=None, cache_hit=False):
+    current_span = _current_span.get()
+    if current_span is None:
+        return
+    if cache_hit:
+        current_span.add("cache_hits")
+        return
+    current_span.add("llm_calls")
+    usage = usage if isinstance(usage, dict) else {}
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    current_span.add("prompt_tokens", prompt_tokens)
+    current_span.add("completion_tokens", completion_tokens)
+    cost_usd = calculate_completion_cost(model, prompt_tokens, completion_tokens)
+    if cost_usd is not None:
+        current_span.add("cost_usd", cost_usd)
+
+def record_retry():
+    current_span = _current_span.get()
+    if current_span is not None:
+        current_span.add("retries")
+
+def record_result_cache_hit():
+    current_span = _current_span.get()
+    if current_span is not None:
+        current_span.add("result_cache_hits")
+
+def read_span_records(file_path):
+    with open(file_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # OTLP-shaped records are flattened back into the plain layout
+    for position, record in enumerate(records):
+        if "spanId" in record:
+            records[position] = {
+                "name": record["name"],
+                "duration_ms": (int(record["endTimeUnixNano"]) - int(record["startTimeUnixNano"])) / 1e6,
+                "attributes": {attribute["key"]: next(iter(attribute["value"].values()))
+                               for attribute in record["attributes"]},
+            }
+    return records
+
+def latency_report(records=None):
+    # p50/p95 latency per stage, plus the tokens, cost, cache hits and retries each stage accounted for
+    if records is None:
+        records = [span.to_record() for span in get_span_recorder().spans()]
+    if not records:
+        return pd.DataFrame()
+    rows = []
+    for record in records:
+        row = {"name": record["name"], "duration_ms": float(record["duration_ms"])}
+        for key in ROLLUP_ATTRIBUTES:
+            row[key] = float(record["attributes"].get(key, 0))
+        rows.append(row)
+    spans_df = pd.DataFrame(rows)
+    grouped = spans_df.groupby("name", sort=False)
+    report_df = pd.DataFrame({
+        "count": grouped["duration_ms"].count(),
+        "p50_ms": grouped["duration_ms"].quantile(0.5).round(3),
+        "p95_ms": grouped["duration_ms"].quantile(0.95).round(3),
+        "mean_ms": grouped["duration_ms"].mean().round(3),
+    })
+    for key in ROLLUP_ATTRIBUTES:
+        report_df[key] = grouped[key].sum()
+    return report_df
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python instrumentation_manager.py <spans.jsonl>")
+        sys.exit(1)
+    print(latency_report(read_span_records(sys.argv[1])).to_string())
@@ -0,0 +1,107 @@
+import logging
+from collections import deque
+
+class JoinGraph:
+    """Undirected graph of tables whose edges are declared or inferred key relationships."""
+
+    def __init__(self, foreign_keys_df, primary_keys_df=None, schema_df=None):
+        # table -> list of (neighbour table, column in table, column in neighbour)
+        self.adjacency = {}
+        declared_edges = set()
+        for row in foreign_keys_df.itertuples(index=False):
+            self.add_edge(row.table_name, row.column_name, row.referenced_table_name, row.referenced_column_name)
+            declared_edges.add((row.table_name, row.column_name))
+
+        if schema_df is not None:
+            for table_name, column_name, referenced_table_name, referenced_column_name in infer_key_relationships(
+                    schema_df, primary_keys_df):
+                if (table_name, column_name) not in declared_edges:
+                    self.add_edge(table_name, column_name, referenced_table_name, referenced_column_name)
+
+    def add_edge(self, table_name, column_name, referenced_table_name, referenced_column_name):
+        if table_name == referenced_table_name:
+            return
+        self.adjacency.setdefault(table_name, []).append((referenced_table_name, column_name, referenced_column_name))
+        self.adjacency.setdefault(referenced_table_name, []).append((table_name, referenced_column_name, column_name))
+
+    def shortest_path(self, source_tables, target_table):
+        # Breadth-first search from any table already in the join tree; returns the edges to add
+        previous = {table: None for table in source_tables}
+        queue = deque(source_tables)
+        while queue:
+            table = queue.popleft()
+            if table == target_table:
+                path = []
+                while previous[table] is not None:
+                    previous_table, previous_column_name, column_name = previous[table]
+                    path.append((previous_table, previous_column_name, table, column_name))
+                    table = previous_table
+                return path[::-1]
+            for neighbour, column_name, neighbour_column_name in sorted(self.adjacency.get(table, [])):
+                if neighbour not in previous:
+                    previous[neighbour] = (table, column_name, neighbour_column_name)
+                    queue.append(neighbour)
+        return None
+
+    def find_join_columns(self, tables):
+        # Grows a join tree by connecting each table to the tables already joined, shortest path first
+        tables = list(dict.fromkeys(tables))
+        if len(tables) < 2:
+            return [], []
+        joined_tables = [tables[0]]
+        join_columns = []
+        unreachable_tables = []
+        for table in tables[1:]:
+            if table in joined_tables:
+                continue
+            path = self.shortest_path(joined_tables, table)
+            if path is None:
+                unreachable_tables.append(table)
+                continue
+            for from_table, from_column, to_table, to_column in path:
+                join_columns += [(from_table, from_column), (to_table, to_column)]
+                if to_table not in joined_tables:
+                    joined_tables.append(to_table)
+        return list(dict.fromkeys(join_columns)), unreachable_tables
+
+    def find_join_rows(self, schema_df, tables):
+        join_columns, unreachable_tables = self.find_join_columns(tables)
+        if unreachable_tables:
+            logging.debug(f"No join path to tables: {unreachable_tables}")
+        keys = set(join_columns)
+        mask = [(table_name, column_name) in keys
+                for table_name, column_name in zip(schema_df["table_name"], schema_df["column_name"])]
+        return schema_df[mask], unreachable_tables
+
+def infer_key_relationships(schema_df, primary_keys_df=None):
+    # Undeclared keys: a column named <table>_id points at that table's primary key, or its id/<table>_id column
+    columns_by_table = {}
+    for table_name, column_name in zip(schema_df["table_name"], schema_df["column_name"]):
+        columns_by_table.setdefault(table_name, set()).add(column_name)
+
+    primary_keys = {}
+    if primary_keys_df is not None:
+        for row in primary_keys_df.itertuples(index=False):
+            primary_keys.setdefault(row.table_name, []).append(row.column_name)
+
+    relationships = []
+    for table_name, column_names in columns_by_table.items():
+        for column_name in column_names:
+            if not column_name.endswith("_id"):
+                continue
+            referenced_table_name = column_name[:-3]
+            for candidate_table_name in (referenced_table_name, referenced_table_name + "s", referenced_table_name + "es"):
+                if candidate_table_name == table_name or candidate_table_name not in columns_by_table:
+                    continue
+                candidate_primary_keys = primary_keys.get(candidate_table_name, [])
+                if len(candidate_primary_keys) == 1:
+                    referenced_column_name = candidate_primary_keys[0]
+                elif column_name in columns_by_table[candidate_table_name]:
+                    referenced_column_name = column_name
+                elif "id" in columns_by_table[candidate_table_name]:
+                    referenced_column_name = "id"
+                else:
+                    continue
+                relationships.append((table_name, column_name, candidate_table_name, referenced_column_name))
+                break
+    return relationships
@@ -1,21 +1,77 @@
-from database_and_synonym_manager import set_database_connection, set_schema, add_synonyms_if_available, set_API_key
+from database_and_synonym_manager import set_database_connection, set_API_key
+from schema_catalog_manager import get_schema_catalog
+from question_cache_manager import get_question_cache, is_question_cache_enabled
 from data_preparation_manager import filter_schema_and_synonyms_df
-from execution_manager import execute_sql_with_fallback, generate_sql_query
-from global_event_publisher import event_publisher
+from execution_manager import execute_sql_with_fallback, generate_sql_query, run_answer_sql, SQLExecutionError
+from global_event_publisher import event_publisher, request_event_scope
+from instrumentation_manager import span
+from profiling_manager import use_value_hints, add_value_hints
+from speculative_sql_manager import get_sql_candidate_count, answer_with_sql_candidates
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+def answer_from_question_cache(question, database_url, schema_fingerprint, return_sql_query=False):
+    question_cache = get_question_cache()
+    cached_sql_query = question_cache.lookup(database_url, schema_fingerprint, question)
+    answer = None
+    if cached_sql_query is not None:
+        event_publisher.emit("cached_sql_query_set", cached_sql_query)
+        try:
+            answer = run_answer_sql(cached_sql_query, database_url)
+        except SQLExecutionError as e:
+            logging.debug(f"Cached SQL query no longer executes: {e.original_exception}. Answering from scratch.")
+            question_cache.discard(database_url, question)
+            cached_sql_query = None
+    return (answer, cached_sql_query) if return_sql_query else answer
+
 def main_program(question):
     set_API_key()
     database_url = set_database_connection()
-    df_schema = set_schema(database_url)
-    schema_and_synonyms_df = add_synonyms_if_available(df_schema)
-    filtered_schema_and_synonyms_df = filter_schema_and_synonyms_df(schema_and_synonyms_df, question)
-    sql_query = generate_sql_query(question, filtered_schema_and_synonyms_df)
-    answer = execute_sql_with_fallback(sql_query, database_url, question, filtered_schema_and_synonyms_df)
-    event_publisher.emit("answer_set", answer)
+    # Each question gets its own publisher; its events still reach listeners of the enclosing scope
+    with request_event_scope(), span("question"):
+        answer = answer_question(question, database_url)
+
     print(answer)
+    if getattr(answer, "attrs", {}).get("truncated"):
+        print(f"(Showing the first {len(answer)} rows; the result was truncated.)")
+
+def answer_question(question, database_url, return_sql_query=False):
+    schema_catalog = get_schema_catalog(database_url)
+    with span("schema_load"):
+        schema_and_synonyms_df = schema_catalog.get_schema_and_synonyms_df()
+        schema_index = schema_catalog.get_schema_index()
+        join_graph = schema_catalog.get_join_graph()
+
+    answer, answered_sql_query = None, None
+    if is_question_cache_enabled():
+        with span("question_cache"):
+            answer, answered_sql_query = answer_from_question_cache(
+                question, database_url, schema_catalog.fingerprint, return_sql_query=True)
+
+    if answer is None:
+        with span("filter_schema"):
+            filtered_schema_and_synonyms_df = filter_schema_and_synonyms_df(
+                schema_and_synonyms_df, question, schema_index=schema_index, join_graph=join_graph)
+        if use_value_hints():
+            with span("value_hints"):
+                filtered_schema_and_synonyms_df = add_value_hints(
+                    filtered_schema_and_synonyms_df, schema_catalog.get_column_profile_df())
+        if get_sql_candidate_count() > 1:
+            sql_query, answer, answered_sql_query = answer_with_sql_candidates(
+                question, database_url, filtered_schema_and_synonyms_df, schema_df=schema_and_synonyms_df)
+        else:
+            sql_query = generate_sql_query(question, filtered_schema_and_synonyms_df)
+        # The sequential repair chain runs only when no candidate answered
+        if answered_sql_query is None:
+            answer, answered_sql_query = execute_sql_with_fallback(
+                sql_query, database_url, question, filtered_schema_and_synonyms_df, return_sql_query=True,
+                schema_df=schema_and_synonyms_df)
+        if answered_sql_query is not None and is_question_cache_enabled():
+            get_question_cache().store(database_url, schema_catalog.fingerprint, question, answered_sql_query)
+
+    event_publisher.emit("answer_set", answer)
+    return (answer, answered_sql_query) if return_sql_query else answer
 
 if __name__ == "__main__":
     question = input("Enter a question: ")
@@ -0,0 +1,101 @@
+import logging
+import base64
+import os
+import threading
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# Environment variables naming the model of each pipeline stage; LLM_MODEL covers any stage left unset
+STAGE_MODEL_VARIABLES = {
+    "filter": "FILTER_MODEL",
+    "generation": "GENERATION_MODEL",
+    "repair": "REPAIR_MODEL",
+}
+
+class ModelSpec:
+    """Context window, tokenizer and USD prices per 1K prompt and completion tokens of one chat model."""
+
+    def __init__(self, name, context_window, encoding="cl100k_base", prompt_price=None, completion_price=None,
+                 max_output_tokens=None):
+        self.name = name
+        self.context_window = context_window
+        self.encoding = encoding
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.max_output_tokens = max_output_tokens
+
+    def response_token_reserve(self):
+        # Index-list answers grow with the partition, so larger windows keep more room for the answer
+        reserve = max(250, self.context_window // 16)
+        return min(reserve, self.max_output_tokens) if self.max_output_tokens else reserve
+
+MODEL_REGISTRY = {}
+
+def register_model(name, context_window, encoding="cl100k_base", prompt_price=None, completion_price=None,
+                   max_output_tokens=None):
+    MODEL_REGISTRY[name] = ModelSpec(name, context_window, encoding, prompt_price, completion_price, max_output_tokens)
+    return MODEL_REGISTRY[name]
+
+register_model("gpt-3.5-turbo", 4096, prompt_price=0.0015, completion_price=0.002)
+register_model("gpt-3.5-turbo-16k", 16384, prompt_price=0.003, completion_price=0.004)
+register_model("gpt-3.5-turbo-1106", 16385, prompt_price=0.001, completion_price=0.002, max_output_tokens=4096)
+register_model("gpt-4", 8192, prompt_price=0.03, completion_price=0.06)
+register_model("gpt-4-32k", 32768, prompt_price=0.06, completion_price=0.12)
+register_model("gpt-4-1106-preview", 128000, prompt_price=0.01, completion_price=0.03, max_output_tokens=4096)
+
+def get_model_spec(model):
+    # Dated snapshots such as gpt-4-0613 share the spec of their base model
+    if model in MODEL_REGISTRY:
+        return MODEL_REGISTRY[model]
+    base_models = [name for name in MODEL_REGISTRY if model.startswith(name + "-")]
+    if base_models:
+        return MODEL_REGISTRY[max(base_models, key=len)]
+    logging.debug(f"Model {model} is not registered; assuming a {MODEL_REGISTRY[DEFAULT_MODEL].context_window} token window.")
+    return ModelSpec(model, MODEL_REGISTRY[DEFAULT_MODEL].context_window)
+
+def get_stage_model(stage):
+    return os.getenv(STAGE_MODEL_VARIABLES[stage]) or os.getenv("LLM_MODEL") or DEFAULT_MODEL
+
+# Split pattern and special tokens of the encodings that can be loaded from a local file
+LOCAL_ENCODINGS = {
+    "cl100k_base": {
+        "pat_str": r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+        "special_tokens": {"<|endoftext|>": 100257, "<|fim_prefix|>": 100258, "<|fim_middle|>": 100259,
+                           "<|fim_suffix|>": 100260, "<|endofprompt|>": 100276},
+    },
+}
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def load_encoding_file(encoding_name, path):
+    # Reads a .tiktoken file (one "base64_token rank" pair per line), so loading the encoding never downloads it
+    import tiktoken
+    with open(path, "rb") as f:
+        mergeable_ranks = {base64.b64decode(token): int(rank)
+                           for token, rank in (line.split() for line in f.read().splitlines() if line)}
+    return tiktoken.Encoding(encoding_name, mergeable_ranks=mergeable_ranks, **LOCAL_ENCODINGS[encoding_name])
+
+def load_encoding(encoding_name):
+    encoding_file_path = os.getenv("TIKTOKEN_ENCODING_FILE_PATH")
+    if encoding_file_path and encoding_name in LOCAL_ENCODINGS:
+        return load_encoding_file(encoding_name, encoding_file_path)
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+def get_model_encoding(model):
+    encoding_name = get_model_spec(model).encoding
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(encoding_name)
+            if encoding is None:
+                encoding = load_encoding(encoding_name)
+                _encodings[encoding_name] = encoding
+    return encoding
+
+def calculate_completion_cost(model, prompt_tokens, completion_tokens):
+    model_spec = get_model_spec(model)
+    if model_spec.prompt_price is None or model_spec.completion_price is None:
+        return None
+    return (prompt_tokens * model_spec.prompt_price + completion_tokens * model_spec.completion_price) / 1000
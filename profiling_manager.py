@@ -0,0 +1,115 @@
+import contextvars
+import csv
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from database_and_synonym_manager import is_sqlite
+from execution_manager import run_sql, SQLExecutionError
+from instrumentation_manager import span
+from utils import get_env_bool, get_env_int
+
+# Planner statistics gathered by ANALYZE: most common values and distinct counts without scanning any table
+PG_STATS_SQL = """
+SELECT tablename AS table_name, attname AS column_name, null_frac AS null_fraction, n_distinct,
+       most_common_vals::text AS most_common_values
+FROM pg_catalog.pg_stats
+WHERE schemaname NOT IN ('pg_catalog', 'information_schema');
+"""
+
+PROFILE_COLUMNS = ["table_name", "column_name", "n_distinct", "null_fraction", "sample_values"]
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def build_table_sample_sql(table_name, column_names, sample_rows):
+    # One query per table covers all of its columns; LIMIT reads only the first pages
+    return (f"SELECT {', '.join(quote_identifier(column_name) for column_name in column_names)} "
+            f"FROM {quote_identifier(table_name)} LIMIT {int(sample_rows)}")
+
+def parse_pg_array(text):
+    # most_common_vals arrives as the text of a Postgres array, e.g. {G,PG,"PG-13"}
+    if not isinstance(text, str) or len(text) < 2:
+        return []
+    return next(csv.reader([text[1:-1]], quotechar='"', escapechar="\\"), [])
+
+def format_sample_value(value, max_length):
+    value = str(value)
+    return value if len(value) <= max_length else value[:max_length] + "..."
+
+def read_pg_stats(database_url):
+    try:
+        return run_sql(PG_STATS_SQL, database_url)
+    except SQLExecutionError as e:
+        logging.debug(f"Could not read pg_stats, sampling every table instead: {e.original_exception}")
+        return None
+
+def sample_table(table_name, column_names, database_url, sample_rows, values_per_column, max_value_length):
+    with span("profile_table", table=table_name, columns=len(column_names)):
+        try:
+            sample_df = run_sql(build_table_sample_sql(table_name, column_names, sample_rows), database_url)
+        except SQLExecutionError as e:
+            logging.debug(f"Could not sample {table_name}: {e.original_exception}")
+            return {}
+    sample_values = {}
+    for position, column_name in enumerate(column_names):
+        values = sample_df.iloc[:, position].dropna().astype(str).drop_duplicates()
+        sample_values[column_name] = [format_sample_value(value, max_value_length)
+                                      for value in values.head(values_per_column)]
+    return sample_values
+
+def profile_columns(schema_df, database_url, max_connections=None):
+    """Up to a few representative values, the distinct count and the null fraction of every schema column.
+
+    Columns with planner statistics take their most common values from pg_stats; every other table is
+    sampled once, in parallel across tables, using at most max_connections connections.
+    """
+    values_per_column = get_env_int("PROFILE_VALUES_PER_COLUMN", 3)
+    sample_rows = get_env_int("PROFILE_SAMPLE_ROWS", 100)
+    max_value_length = get_env_int("PROFILE_MAX_VALUE_LENGTH", 40)
+    max_connections = max_connections or get_env_int("PROFILE_MAX_CONNECTIONS", 4)
+
+    profile_df = schema_df[["table_name", "column_name"]].drop_duplicates().reset_index(drop=True)
+    profile_df["n_distinct"] = None
+    profile_df["null_fraction"] = None
+    profile_df["sample_values"] = [[] for _ in range(len(profile_df))]
+    positions = {(table_name, column_name): position for position, (table_name, column_name)
+                 in enumerate(zip(profile_df["table_name"], profile_df["column_name"]))}
+
+    stats_df = None if is_sqlite(database_url) else read_pg_stats(database_url)
+    if stats_df is not None:
+        for row in stats_df.itertuples(index=False):
+            position = positions.get((row.table_name, row.column_name))
+            if position is None:
+                continue
+            profile_df.at[position, "n_distinct"] = row.n_distinct
+            profile_df.at[position, "null_fraction"] = row.null_fraction
+            profile_df.at[position, "sample_values"] = [
+                format_sample_value(value, max_value_length)
+                for value in parse_pg_array(row.most_common_values)[:values_per_column]]
+
+    unprofiled_df = profile_df[profile_df["sample_values"].map(len) == 0]
+    columns_by_table = unprofiled_df.groupby("table_name", sort=False)["column_name"].apply(list).to_dict()
+    logging.debug(f"Profiling {len(profile_df)} columns: sampling {len(columns_by_table)} tables.")
+    if columns_by_table:
+        with ThreadPoolExecutor(max_workers=min(max_connections, len(columns_by_table))) as executor:
+            sample_values_list = list(executor.map(
+                lambda table_name, context: context.run(
+                    sample_table, table_name, columns_by_table[table_name], database_url, sample_rows,
+                    values_per_column, max_value_length),
+                columns_by_table, [contextvars.copy_context() for _ in columns_by_table]))
+        for table_name, sample_values in zip(columns_by_table, sample_values_list):
+            for column_name, values in sample_values.items():
+                profile_df.at[positions[(table_name, column_name)], "sample_values"] = values
+    return profile_df[PROFILE_COLUMNS]
+
+def use_value_hints():
+    return get_env_bool("SCHEMA_VALUE_HINTS", False)
+
+def add_value_hints(schema_and_synonyms_df, profile_df):
+    # Adds a sample_values column, keeping the row index the filtering and generation prompts rely on
+    sample_values = {(table_name, column_name): values for table_name, column_name, values
+                     in zip(profile_df["table_name"], profile_df["column_name"], profile_df["sample_values"])}
+    hinted_df = schema_and_synonyms_df.copy()
+    hinted_df["sample_values"] = [
+        "|".join(sample_values.get((table_name, column_name)) or []) or None
+        for table_name, column_name in zip(hinted_df["table_name"], hinted_df["column_name"])]
+    return hinted_df
@@ -0,0 +1,149 @@
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from utils import get_env_int, get_env_float, get_env_bool
+
+# Words that change the phrasing of a question but not the SQL that answers it
+FILLER_WORDS = {"please", "can", "could", "you", "tell", "me", "show", "give", "list", "the", "a", "an", "of"}
+
+PARAMETER_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"|\b\d+(?:\.\d+)?\b")
+PARAMETER_PLACEHOLDER = "<param>"
+
+def extract_parameters(question):
+    # Literal values (numbers and quoted strings) are swapped for placeholders so
+    # "films longer than 100 minutes" and "films longer than 120 minutes" share a template
+    parameters = [match.group(0).strip("'\"") for match in PARAMETER_PATTERN.finditer(question)]
+    template = PARAMETER_PATTERN.sub(f" {PARAMETER_PLACEHOLDER} ", question)
+    return template, parameters
+
+def normalize_question(question):
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"[^\w\s<>]", " ", question)
+    return " ".join(word for word in question.split() if word not in FILLER_WORDS)
+
+def character_ngram_vector(text, n=3):
+    padded = f" {text} "
+    return Counter(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+def cosine_similarity(vector_a, vector_b):
+    dot_product = sum(count * vector_b.get(ngram, 0) for ngram, count in vector_a.items())
+    norm_a = math.sqrt(sum(count * count for count in vector_a.values()))
+    norm_b = math.sqrt(sum(count * count for count in vector_b.values()))
+    return dot_product / (norm_a * norm_b) if norm_a and norm_b else 0.0
+
+def substitute_parameters(sql_query, cached_parameters, parameters):
+    if len(cached_parameters) != len(parameters):
+        return None
+    for cached_parameter, parameter in zip(cached_parameters, parameters):
+        if cached_parameter == parameter:
+            continue
+        # Only rewrite a literal that appears exactly once, otherwise the substitution is ambiguous
+        literal_pattern = re.compile(r"(?<![\w.])" + re.escape(cached_parameter) + r"(?![\w.])")
+        if len(literal_pattern.findall(sql_query)) != 1:
+            return None
+        sql_query = literal_pattern.sub(lambda _: parameter, sql_query)
+    return sql_query
+
+class QuestionCache:
+    """Question to SQL pairs whose SQL executed successfully, scoped to a database and schema fingerprint."""
+
+    def __init__(self, max_entries=1000, similarity_threshold=None, embed_function=None):
+        self.max_entries = max_entries
+        # None only reuses questions whose normalized template matches exactly
+        self.similarity_threshold = similarity_threshold
+        self.embed_function = embed_function or character_ngram_vector
+        self.similarity_function = cosine_similarity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, database_url, schema_fingerprint, question):
+        template, parameters = extract_parameters(question)
+        normalized_template = normalize_question(template)
+
+        with self._lock:
+            self._invalidate_if_schema_changed(database_url, schema_fingerprint)
+            key = (database_url, normalized_template)
+            entry = self._entries.get(key)
+            if entry is None and self.similarity_threshold is not None:
+                entry = self._find_similar_entry(database_url, normalized_template)
+
+            if entry is not None:
+                sql_query = substitute_parameters(entry["sql_query"], entry["parameters"], parameters)
+                if sql_query is not None:
+                    self._entries.move_to_end(entry["key"])
+                    self.hits += 1
+                    return sql_query
+
+            self.misses += 1
+            return None
+
+    def store(self, database_url, schema_fingerprint, question, sql_query):
+        template, parameters = extract_parameters(question)
+        normalized_template = normalize_question(template)
+        key = (database_url, normalized_template)
+
+        with self._lock:
+            self._invalidate_if_schema_changed(database_url, schema_fingerprint)
+            self._entries[key] = {
+                "key": key,
+                "parameters": parameters,
+                "sql_query": sql_query,
+                "vector": self.embed_function(normalized_template) if self.similarity_threshold is not None else None,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, database_url, question):
+        template, _ = extract_parameters(question)
+        with self._lock:
+            self._entries.pop((database_url, normalize_question(template)), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fingerprints.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _invalidate_if_schema_changed(self, database_url, schema_fingerprint):
+        if self._fingerprints.get(database_url, schema_fingerprint) != schema_fingerprint:
+            for key in [key for key in self._entries if key[0] == database_url]:
+                del self._entries[key]
+        self._fingerprints[database_url] = schema_fingerprint
+
+    def _find_similar_entry(self, database_url, normalized_template):
+        vector = self.embed_function(normalized_template)
+        best_entry, best_similarity = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if key[0] != database_url:
+                continue
+            similarity = self.similarity_function(vector, entry["vector"])
+            if similarity >= best_similarity:
+                best_entry, best_similarity = entry, similarity
+        return best_entry
+
+_question_cache = None
+_question_cache_lock = threading.Lock()
+
+def get_question_cache():
+    global _question_cache
+    with _question_cache_lock:
+        if _question_cache is None:
+            similarity_threshold = get_env_float("QUESTION_CACHE_SIMILARITY_THRESHOLD", 0)
+            _question_cache = QuestionCache(
+                max_entries=get_env_int("QUESTION_CACHE_MAX_ENTRIES", 1000),
+                similarity_threshold=similarity_threshold or None,
+            )
+        return _question_cache
+
+def is_question_cache_enabled():
+    return get_env_bool("QUESTION_CACHE_ENABLED", True)
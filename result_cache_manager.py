@@ -0,0 +1,214 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from engine_manager import get_engine
+from sql_validation_manager import tokenize_sql, parse_sql_references
+from utils import get_env_bool, get_env_float, get_env_int
+
+# Cumulative row changes per table, and per view or materialized view the sum over the tables its rewrite rule
+# reads (one level deep). The counters only grow, so any write to a table changes its version.
+PG_TABLE_VERSIONS_SQL = """
+WITH table_versions AS (
+    SELECT relid, relname, n_tup_ins + n_tup_upd + n_tup_del AS data_version
+    FROM pg_catalog.pg_stat_user_tables
+), view_tables AS (
+    SELECT DISTINCT r.ev_class AS view_oid, d.refobjid AS table_oid
+    FROM pg_catalog.pg_rewrite r
+    JOIN pg_catalog.pg_depend d ON d.objid = r.oid AND d.classid = 'pg_catalog.pg_rewrite'::regclass
+    WHERE d.refobjid <> r.ev_class
+)
+SELECT relname AS table_name, data_version FROM table_versions
+UNION ALL
+SELECT v.relname, sum(t.data_version)
+FROM view_tables vt
+JOIN pg_catalog.pg_class v ON v.oid = vt.view_oid AND v.relkind IN ('v', 'm')
+JOIN table_versions t ON t.relid = vt.table_oid
+GROUP BY v.relname;
+"""
+
+# Functions whose value changes between runs of the same query
+VOLATILE_FUNCTIONS = {"now", "random", "clock_timestamp", "statement_timestamp", "timeofday", "nextval",
+                      "current_date", "current_time", "current_timestamp", "localtime", "localtimestamp",
+                      "gen_random_uuid", "uuid_generate_v4"}
+
+def normalize_sql(sql):
+    # Whitespace, comments, keyword case and trailing semicolons do not change the result; string literals
+    # and quoted identifiers keep their case
+    tokens = tokenize_sql(sql)
+    while tokens and tokens[-1] == ("op", ";", False):
+        tokens.pop()
+    return " ".join('"' + value.replace('"', '""') + '"' if quoted else value for _, value, quoted in tokens)
+
+def get_cacheable_tables(sql):
+    # The tables a plain read-only query reads, or None when its result cannot be cached
+    if not re.match(r"(?is)^\s*(select|with)\b", sql):
+        return None
+    tokens = tokenize_sql(sql)
+    if any(kind == "name" and not quoted and value in VOLATILE_FUNCTIONS for kind, value, quoted in tokens):
+        return None
+    if any(kind == "name" and not quoted and value in ("insert", "update", "delete") for kind, value, quoted in tokens):
+        return None
+    try:
+        references = parse_sql_references(sql)
+    except Exception as e:
+        logging.debug(f"Could not parse the tables of a query, so its result is not cached: {e}")
+        return None
+    if references.has_unknown_source:
+        return None
+    return frozenset(table_name for table_name, _ in references.aliases.values())
+
+def result_budget_key(result_budget):
+    return tuple(sorted((result_budget or {}).items()))
+
+class ResultCache:
+    """LRU of query results bounded by their total bytes, keyed by normalized SQL, database URL and result budget.
+
+    Entries expire after max_age_seconds, and are dropped when a table they read changes: on Postgres through a
+    pg_stat_user_tables probe run at most once per probe_interval_seconds, elsewhere through explicit invalidate calls.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_age_seconds=None, probe_interval_seconds=5, version_probe=None):
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.probe_interval_seconds = probe_interval_seconds
+        self.version_probe = version_probe or read_table_versions
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.byte_count = 0
+        self._entries = OrderedDict()
+        self._table_versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, sql, database_url, result_budget=None):
+        key = (database_url, normalize_sql(sql), result_budget_key(result_budget))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and not self._is_expired(entry["created_at"], now) and \
+                self._versions_match(database_url, entry):
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self.hits += 1
+            # A shallow copy, so callers can set attrs or columns without changing the cached result
+            return entry["df"].copy(deep=False)
+
+        with self._lock:
+            if entry is not None and self._entries.get(key) is entry:
+                self._discard(key)
+            self.misses += 1
+        return None
+
+    def set(self, sql, database_url, sql_answer_df, result_budget=None):
+        tables = get_cacheable_tables(sql)
+        if tables is None:
+            return
+        entry_bytes = int(sql_answer_df.memory_usage(index=True, deep=True).sum())
+        if entry_bytes > self.max_bytes:
+            return
+        entry = {"df": sql_answer_df.copy(deep=False), "tables": tables, "bytes": entry_bytes, "created_at": time.time(),
+                 "versions": self._get_versions(database_url, tables)}
+        key = (database_url, normalize_sql(sql), result_budget_key(result_budget))
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self.byte_count += entry_bytes
+            while self.byte_count > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, database_url=None, tables=None):
+        # Drops the results of database_url (or every database) that read any of tables (or any table)
+        tables = {table_name.lower() for table_name in tables} if tables is not None else None
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if database_url is not None and key[0] != database_url:
+                    continue
+                if tables is None or tables & {table_name.lower() for table_name in entry["tables"]}:
+                    self._discard(key)
+            if database_url is None:
+                self._table_versions.clear()
+            else:
+                self._table_versions.pop(database_url, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._table_versions.clear()
+            self.byte_count = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.byte_count}
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.byte_count -= entry["bytes"]
+
+    def _is_expired(self, created_at, now):
+        return self.max_age_seconds is not None and now - created_at > self.max_age_seconds
+
+    def _get_versions(self, database_url, tables):
+        table_versions = self._read_table_versions(database_url)
+        if table_versions is None or not all(table_name in table_versions for table_name in tables):
+            # Tables the probe cannot see are only covered by the age limit and explicit invalidation
+            return None
+        return {table_name: table_versions[table_name] for table_name in tables}
+
+    def _versions_match(self, database_url, entry):
+        return entry["versions"] is None or self._get_versions(database_url, entry["tables"]) == entry["versions"]
+
+    def _read_table_versions(self, database_url):
+        now = time.time()
+        with self._lock:
+            probed = self._table_versions.get(database_url)
+        if probed is not None and now - probed[0] < self.probe_interval_seconds:
+            return probed[1]
+        table_versions = self.version_probe(database_url)
+        with self._lock:
+            self._table_versions[database_url] = (now, table_versions)
+        return table_versions
+
+def read_table_versions(database_url):
+    # Returns None where no probe is available, which leaves invalidation to the age limit and explicit calls
+    if make_url(database_url).get_backend_name() != "postgresql":
+        return None
+    try:
+        versions_df = pd.read_sql_query(PG_TABLE_VERSIONS_SQL, get_engine(database_url))
+    except SQLAlchemyError as e:
+        logging.debug(f"Could not read table versions: {e}")
+        return None
+    table_versions = {}
+    for table_name, data_version in zip(versions_df["table_name"], versions_df["data_version"]):
+        # Tables of the same name in different schemas share one version
+        table_versions[table_name] = table_versions.get(table_name, 0) + int(data_version)
+    return table_versions
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            max_age_seconds = get_env_int("RESULT_CACHE_MAX_AGE_SECONDS", 300)
+            _result_cache = ResultCache(
+                max_bytes=get_env_int("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+                max_age_seconds=max_age_seconds or None,
+                probe_interval_seconds=get_env_float("RESULT_CACHE_PROBE_INTERVAL_SECONDS", 5),
+            )
+            _result_cache.enabled = get_env_bool("RESULT_CACHE_ENABLED", True)
+            logging.debug(f"Result cache enabled: {_result_cache.enabled}")
+        return _result_cache
+
+def set_result_cache(result_cache):
+    global _result_cache
+    with _result_cache_lock:
+        _result_cache = result_cache
@@ -0,0 +1,199 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from sqlalchemy.engine import make_url
+from database_and_synonym_manager import set_schema, set_foreign_keys, set_primary_keys, add_synonyms_if_available, is_sqlite
+from execution_manager import run_sql
+from schema_index_manager import SchemaIndex
+from join_graph_manager import JoinGraph
+from profiling_manager import profile_columns
+from utils import get_env_int
+
+# Cheap stand-in for rescanning information_schema: hashes the catalog rows that change whenever a user
+# table, view or column is created, dropped, renamed or retyped, or a primary or foreign key changes.
+SCHEMA_FINGERPRINT_SQL = """
+SELECT md5(
+    (SELECT coalesce(string_agg(
+        c.oid::text || ':' || c.relname || ':' || a.attnum::text || ':' || a.attname || ':' || a.atttypid::text,
+        ',' ORDER BY c.oid, a.attnum), '')
+     FROM pg_catalog.pg_attribute a
+     JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+     JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+     WHERE c.relkind IN ('r', 'v', 'm', 'p', 'f')
+     AND a.attnum > 0
+     AND NOT a.attisdropped
+     AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+     AND n.nspname NOT LIKE 'pg_toast%')
+    || '|' ||
+    (SELECT coalesce(string_agg(oid::text, ',' ORDER BY oid), '')
+     FROM pg_catalog.pg_constraint
+     WHERE contype IN ('p', 'f'))
+) AS fingerprint;
+"""
+
+# SQLite bumps schema_version on every schema change
+SQLITE_SCHEMA_FINGERPRINT_SQL = "SELECT CAST(schema_version AS TEXT) AS fingerprint FROM pragma_schema_version;"
+
+SNAPSHOT_VERSION = 3
+
+class SchemaCatalog:
+    """Schema and synonym table loaded once per database and shared across questions."""
+
+    def __init__(self, database_url, snapshot_path=None, check_interval=None):
+        self.database_url = database_url
+        self.snapshot_path = snapshot_path if snapshot_path is not None else os.getenv("SCHEMA_SNAPSHOT_FILE_PATH")
+        self.check_interval = (check_interval if check_interval is not None
+                               else get_env_int("SCHEMA_FINGERPRINT_CHECK_INTERVAL", 60))
+        self.schema_df = None
+        self.schema_and_synonyms_df = None
+        self.fingerprint = None
+        self.synonym_state = None
+        self.last_checked = 0.0
+        self.foreign_keys_df = None
+        self.primary_keys_df = None
+        self.schema_index = None
+        self.join_graph = None
+        self.column_profile_df = None
+        # Set by invalidate, so the next access reads the database rather than the snapshot it would replace
+        self.snapshot_stale = False
+        self._lock = threading.RLock()
+
+    def get_schema_df(self):
+        with self._lock:
+            self._ensure_fresh()
+            return self.schema_df
+
+    def get_schema_and_synonyms_df(self):
+        with self._lock:
+            self._ensure_fresh()
+            return self.schema_and_synonyms_df
+
+    def get_schema_index(self):
+        with self._lock:
+            self._ensure_fresh()
+            # Rebuilt only when the schema or synonyms were reloaded
+            if self.schema_index is None or self.schema_index.schema_df is not self.schema_and_synonyms_df:
+                self.schema_index = SchemaIndex(self.schema_and_synonyms_df)
+            return self.schema_index
+
+    def get_join_graph(self):
+        with self._lock:
+            self._ensure_fresh()
+            if self.join_graph is None:
+                self.join_graph = JoinGraph(self.foreign_keys_df, self.primary_keys_df, self.schema_df)
+            return self.join_graph
+
+    def get_column_profile_df(self):
+        with self._lock:
+            self._ensure_fresh()
+            # Profiled on first use after each schema load, then kept in the snapshot
+            if self.column_profile_df is None:
+                self.column_profile_df = profile_columns(self.schema_df, self.database_url)
+                self._save_snapshot()
+            return self.column_profile_df
+
+    def invalidate(self):
+        with self._lock:
+            self.schema_df = None
+            self.schema_and_synonyms_df = None
+            self.fingerprint = None
+            self.snapshot_stale = True
+
+    def _ensure_fresh(self):
+        if self.schema_df is None and (self.snapshot_stale or not self._load_snapshot()):
+            self._refresh_schema(self._query_fingerprint())
+        elif time.monotonic() - self.last_checked >= self.check_interval:
+            fingerprint = self._query_fingerprint()
+            if fingerprint != self.fingerprint:
+                logging.debug("Schema fingerprint changed. Reloading schema.")
+                self._refresh_schema(fingerprint)
+
+        if self.synonym_state != get_synonym_state():
+            logging.debug("Synonym table changed. Re-merging synonyms.")
+            self._merge_synonyms()
+            self._save_snapshot()
+
+    def _query_fingerprint(self):
+        self.last_checked = time.monotonic()
+        fingerprint_sql = SQLITE_SCHEMA_FINGERPRINT_SQL if is_sqlite(self.database_url) else SCHEMA_FINGERPRINT_SQL
+        return run_sql(fingerprint_sql, self.database_url)["fingerprint"].iloc[0]
+
+    def _refresh_schema(self, fingerprint):
+        self.schema_df = set_schema(self.database_url)
+        self.foreign_keys_df = set_foreign_keys(self.database_url)
+        self.primary_keys_df = set_primary_keys(self.database_url)
+        self.join_graph = None
+        self.column_profile_df = None
+        self.fingerprint = fingerprint
+        self._merge_synonyms()
+        self._save_snapshot()
+        self.snapshot_stale = False
+
+    def _merge_synonyms(self):
+        # Read the state before the file so a concurrent edit is picked up on the next access
+        self.synonym_state = get_synonym_state()
+        self.schema_and_synonyms_df = add_synonyms_if_available(self.schema_df)
+
+    def _snapshot_key(self):
+        return make_url(self.database_url).render_as_string(hide_password=True)
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logging.debug(f"Ignoring unreadable schema snapshot: {e}")
+            return False
+        if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("database") != self._snapshot_key():
+            return False
+
+        logging.debug(f"Loaded schema snapshot from {self.snapshot_path}")
+        self.schema_df = snapshot["schema_df"]
+        self.schema_and_synonyms_df = snapshot["schema_and_synonyms_df"]
+        self.foreign_keys_df = snapshot["foreign_keys_df"]
+        self.primary_keys_df = snapshot["primary_keys_df"]
+        self.join_graph = None
+        self.column_profile_df = snapshot["column_profile_df"]
+        self.fingerprint = snapshot["fingerprint"]
+        self.synonym_state = snapshot["synonym_state"]
+        # Trust the snapshot until the next scheduled fingerprint check
+        self.last_checked = time.monotonic()
+        return True
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "database": self._snapshot_key(),
+            "fingerprint": self.fingerprint,
+            "synonym_state": self.synonym_state,
+            "schema_df": self.schema_df,
+            "schema_and_synonyms_df": self.schema_and_synonyms_df,
+            "foreign_keys_df": self.foreign_keys_df,
+            "primary_keys_df": self.primary_keys_df,
+            "column_profile_df": self.column_profile_df,
+        }
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(snapshot, f)
+        os.replace(temp_path, self.snapshot_path)
+
+def get_synonym_state():
+    synonym_table_file_path = os.getenv("SYNONYM_TABLE_FILE_PATH")
+    if synonym_table_file_path and os.path.exists(synonym_table_file_path):
+        return (synonym_table_file_path, os.path.getmtime(synonym_table_file_path))
+    return None
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def get_schema_catalog(database_url):
+    with _catalogs_lock:
+        if database_url not in _catalogs:
+            _catalogs[database_url] = SchemaCatalog(database_url)
+        return _catalogs[database_url]
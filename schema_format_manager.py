@@ -0,0 +1,44 @@
+from utils import get_env_str_choice
+
+SCHEMA_COLUMNS = ("table_name", "column_name", "data_type", "synonym_list")
+
+# First line of a compact schema, in the place of DataFrame.to_string()'s column header
+COMPACT_SCHEMA_HEADER = "table_name(index column_name:data_type[synonym_list], ...)"
+
+def get_schema_prompt_format():
+    return get_env_str_choice("SCHEMA_PROMPT_FORMAT", "compact", ("compact", "table"))
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+def render_compact_entries(df):
+    # One "index column_name:data_type[synonyms]" entry per row. Columns beyond the schema's own go in the brackets,
+    # except the "index" column reset_index leaves behind, which only repeats an earlier row index.
+    extra_columns = [column for column in df.columns if column not in SCHEMA_COLUMNS and column != "index"]
+    entries = []
+    for index, row in zip(df.index, df.to_dict("records")):
+        entry = f"{index} {row['column_name']}"
+        if not is_missing(row.get("data_type")):
+            entry += f":{row['data_type']}"
+        details = [str(row["synonym_list"])] if not is_missing(row.get("synonym_list")) else []
+        details += [f"{column}={row[column]}" for column in extra_columns if not is_missing(row[column])]
+        if details:
+            entry += "[" + "; ".join(details) + "]"
+        entries.append(entry)
+    return entries
+
+def render_compact_schema(df):
+    # One line per table, e.g. "film(12 film_id:integer, 13 title:text[movie name])", so table names and
+    # column padding are not repeated on every row
+    entries_by_table = {}
+    for table_name, entry in zip(df["table_name"], render_compact_entries(df)):
+        entries_by_table.setdefault(table_name, []).append(entry)
+    lines = [COMPACT_SCHEMA_HEADER]
+    lines += [f"{table_name}(" + ", ".join(entries) + ")" for table_name, entries in entries_by_table.items()]
+    return "\n".join(lines)
+
+def render_schema(df):
+    # Schema tables embedded in prompts; rows keep their index so the model can answer with index numbers
+    if get_schema_prompt_format() == "table" or not {"table_name", "column_name"} <= set(df.columns):
+        return df.to_string()
+    return render_compact_schema(df)
@@ -0,0 +1,120 @@
+import math
+import re
+from collections import Counter
+import numpy as np
+
+STOP_WORDS = {
+    "a", "all", "an", "and", "any", "are", "as", "at", "be", "by", "can", "do", "does", "each", "for", "from",
+    "give", "has", "have", "how", "i", "in", "is", "it", "its", "list", "many", "me", "much", "of", "on", "or",
+    "show", "tell", "than", "that", "the", "their", "there", "these", "this", "to", "was", "we", "were", "what",
+    "when", "where", "which", "who", "whose", "with", "you",
+}
+
+def stem(word):
+    # Plural folding is enough to match "films" to film and "categories" to category
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def split_words(text):
+    # Splits snake_case, camelCase and free text into lower-case words
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    return [stem(word) for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOP_WORDS]
+
+def character_ngrams(words, n=3):
+    ngrams = []
+    for word in words:
+        padded = f"#{word}#"
+        ngrams += [padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))]
+    return ngrams
+
+class BM25:
+    def __init__(self, documents, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.document_count = len(documents)
+        self.document_lengths = np.array([len(document) for document in documents], dtype=np.float64)
+        self.average_length = self.document_lengths.mean() if self.document_count else 0.0
+
+        postings = {}
+        for position, document in enumerate(documents):
+            for term, frequency in Counter(document).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(position)
+                postings[term][1].append(frequency)
+        self.postings = {term: (np.array(positions), np.array(frequencies, dtype=np.float64))
+                         for term, (positions, frequencies) in postings.items()}
+
+    def score(self, query_terms):
+        scores = np.zeros(self.document_count)
+        if not self.document_count or not self.average_length:
+            return scores
+        length_norm = self.k1 * (1 - self.b + self.b * self.document_lengths / self.average_length)
+        for term in set(query_terms):
+            if term not in self.postings:
+                continue
+            positions, frequencies = self.postings[term]
+            idf = math.log(1 + (self.document_count - len(positions) + 0.5) / (len(positions) + 0.5))
+            scores[positions] += idf * frequencies * (self.k1 + 1) / (frequencies + length_norm[positions])
+        return scores
+
+class SchemaIndex:
+    """Local retrieval index over schema rows, used to shortlist candidate rows before asking the model."""
+
+    def __init__(self, schema_df, embed_function=None, ngram_weight=0.3, embedding_weight=1.0):
+        self.schema_df = schema_df
+        self.ngram_weight = ngram_weight
+        self.embedding_weight = embedding_weight
+        self.embed_function = embed_function
+
+        row_words = []
+        for row in schema_df.itertuples(index=False):
+            row = row._asdict()
+            words = split_words(row["table_name"]) + split_words(row["column_name"]) * 2 + split_words(row["data_type"])
+            synonym_list = row.get("synonym_list")
+            if isinstance(synonym_list, str):
+                words += split_words(synonym_list)
+            row_words.append(words)
+
+        self.word_index = BM25(row_words)
+        self.ngram_index = BM25([character_ngrams(words) for words in row_words])
+
+        self.row_embeddings = None
+        if embed_function is not None:
+            row_texts = [" ".join(words) for words in row_words]
+            self.row_embeddings = normalize_rows(np.asarray(embed_function(row_texts), dtype=np.float64))
+
+    def score(self, question):
+        question_words = split_words(question)
+        scores = self.word_index.score(question_words) + self.ngram_weight * self.ngram_index.score(
+            character_ngrams(question_words))
+        if self.row_embeddings is not None:
+            question_embedding = normalize_rows(np.asarray(self.embed_function([question]), dtype=np.float64))[0]
+            scores = scores + self.embedding_weight * (self.row_embeddings @ question_embedding)
+        return scores
+
+    def search(self, question, top_k):
+        if top_k >= len(self.schema_df):
+            return self.schema_df
+        scores = self.score(question)
+        # Stable sort keeps schema order among equal scores; the result is returned in schema order
+        top_positions = np.sort(np.argsort(-scores, kind="stable")[:top_k])
+        return self.schema_df.iloc[top_positions]
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def find_join_candidate_rows(schema_df, selected_df):
+    # Columns of the selected tables whose names recur in other tables, together with those other tables' rows
+    if selected_df.empty or "table_name" not in selected_df:
+        return schema_df.iloc[0:0]
+    tables_per_column = schema_df.groupby("column_name")["table_name"].nunique()
+    shared_column_names = set(tables_per_column[tables_per_column > 1].index)
+    selected_tables = set(selected_df["table_name"])
+    key_column_names = set(schema_df.loc[schema_df["table_name"].isin(selected_tables), "column_name"]) & shared_column_names
+    return schema_df[schema_df["column_name"].isin(key_column_names)]
@@ -0,0 +1,207 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from global_event_publisher import event_publisher
+from engine_manager import get_engine
+from execution_manager import (SQLExecutionError, create_chat_completion, build_sql_generation_directive, stream_sql,
+                               get_answer_result_budget, backend_slot)
+from sql_validation_manager import check_sql_before_execution
+from schema_format_manager import render_schema
+from model_registry_manager import get_stage_model
+from instrumentation_manager import span, record_result_cache_hit
+from result_cache_manager import get_result_cache, normalize_sql
+from utils import get_env_float, get_env_int, get_env_str_choice
+
+def get_sql_candidate_count():
+    return max(get_env_int("SQL_CANDIDATES", 1), 1)
+
+def get_candidate_selection():
+    return get_env_str_choice("SQL_CANDIDATE_SELECTION", "first", ("first", "agreement"))
+
+def get_candidate_timeout_seconds():
+    return get_env_float("SQL_CANDIDATE_TIMEOUT_SECONDS", 10)
+
+def build_candidate_messages(question, filtered_schema_and_synonyms_df):
+    # The same prompt as generate_sql_query, so the greedy candidate shares its completion cache entry
+    prompt = build_sql_generation_directive(question) + render_schema(filtered_schema_and_synonyms_df)
+    return [{"role": "user", "content": prompt}]
+
+def candidate_completion_options(candidate_number):
+    # The first candidate is the usual greedy query; the others are sampled, and sampled answers are not cached
+    if candidate_number == 0:
+        return {"temperature": 0, "use_cache": True}
+    return {"temperature": get_env_float("SQL_CANDIDATE_TEMPERATURE", 0.7), "use_cache": False}
+
+def distinct_sql_queries(sql_queries):
+    distinct_queries = {}
+    # Candidates differing only in whitespace, comments or keyword case run once; string literals keep their case
+    for sql_query in sql_queries:
+        if sql_query is not None:
+            distinct_queries.setdefault(normalize_sql(sql_query), sql_query)
+    return list(distinct_queries.values())
+
+def generate_sql_candidates(question, filtered_schema_and_synonyms_df, candidate_count):
+    messages = build_candidate_messages(question, filtered_schema_and_synonyms_df)
+    model = get_stage_model("generation")
+
+    def generate(candidate_number):
+        try:
+            return create_chat_completion(messages, model=model, **candidate_completion_options(candidate_number))
+        except Exception as e:
+            if candidate_number == 0:
+                raise
+            logging.debug(f"Candidate {candidate_number} could not be generated: {e}")
+            return None
+
+    with span("generate_sql", schema_rows=len(filtered_schema_and_synonyms_df), candidates=candidate_count):
+        with ThreadPoolExecutor(max_workers=candidate_count) as executor:
+            sql_queries = list(executor.map(
+                lambda candidate_number, context: context.run(generate, candidate_number),
+                range(candidate_count), [contextvars.copy_context() for _ in range(candidate_count)]))
+    return sql_queries
+
+def cancel_dbapi_connection(dbapi_connection):
+    # psycopg2 cancels the running statement on the server; sqlite3 interrupts it in process
+    cancel = getattr(dbapi_connection, "cancel", None) or getattr(dbapi_connection, "interrupt", None)
+    if cancel is not None:
+        try:
+            cancel()
+        except Exception as e:
+            logging.debug(f"Could not cancel candidate query: {e}")
+
+class CandidateQuery:
+    """One candidate's execution, which another thread can cancel while it runs."""
+
+    def __init__(self, sql, database_url, timeout_seconds=None):
+        self.sql = sql
+        self.database_url = database_url
+        self.timeout_seconds = timeout_seconds
+        self.cancelled = False
+        self._dbapi_connection = None
+        self._lock = threading.Lock()
+
+    def run(self, schema_df=None):
+        check_sql_before_execution(self.sql, self.database_url, schema_df)
+        result_cache = get_result_cache()
+        result_budget = get_answer_result_budget()
+        sql_answer_df = result_cache.get(self.sql, self.database_url, result_budget) if result_cache.enabled else None
+        if sql_answer_df is not None:
+            record_result_cache_hit()
+            return sql_answer_df
+        sql_answer_df = self._execute(result_budget)
+        if result_cache.enabled:
+            result_cache.set(self.sql, self.database_url, sql_answer_df, result_budget)
+        return sql_answer_df
+
+    def _execute(self, result_budget):
+        timer = threading.Timer(self.timeout_seconds, self.cancel) if self.timeout_seconds else None
+        try:
+            with backend_slot("database"), get_engine(self.database_url).connect() as connection:
+                with self._lock:
+                    if self.cancelled:
+                        raise SQLExecutionError("Candidate query cancelled.")
+                    self._dbapi_connection = connection.connection.dbapi_connection
+                if timer is not None:
+                    timer.start()
+                try:
+                    with connection.begin():
+                        if self.timeout_seconds and make_url(self.database_url).get_backend_name() == "postgresql":
+                            # Also enforced by the server, in case the cancel request is lost
+                            connection.execute(text(f"SET LOCAL statement_timeout = {int(self.timeout_seconds * 1000)}"))
+                        return stream_sql(self.sql, self.database_url, **result_budget).to_dataframe(connection)
+                finally:
+                    with self._lock:
+                        self._dbapi_connection = None
+        except SQLExecutionError:
+            raise
+        except Exception as e:
+            if self.cancelled:
+                raise SQLExecutionError("Candidate query cancelled or timed out.")
+            raise SQLExecutionError(getattr(e, "orig", None) or e)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def cancel(self):
+        # Cancels under the lock, so the connection cannot meanwhile go back to the pool and run another query
+        with self._lock:
+            self.cancelled = True
+            if self._dbapi_connection is not None:
+                cancel_dbapi_connection(self._dbapi_connection)
+
+def result_signature(sql_answer_df):
+    # Results agree when they hold the same values, whatever their column names and row order
+    try:
+        row_hashes = sorted(pd.util.hash_pandas_object(sql_answer_df, index=False).tolist())
+        return sql_answer_df.shape, hash(tuple(row_hashes))
+    except TypeError:
+        return sql_answer_df.shape, None
+
+def choose_agreed_candidate(successes):
+    # successes holds (candidate_number, sql_query, sql_answer_df); the largest group of agreeing results wins,
+    # and ties go to the group holding the lowest-numbered candidate
+    groups = {}
+    for success in sorted(successes, key=lambda success: success[0]):
+        groups.setdefault(result_signature(success[2]), []).append(success)
+    return max(groups.values(), key=lambda group: (len(group), -group[0][0]))[0]
+
+def execute_sql_candidates(sql_queries, database_url, schema_df=None, selection=None):
+    """Validates and runs the candidates in parallel; returns (answer, sql_query), or (None, None) if all fail.
+
+    In "first" selection the first candidate to succeed wins and the others are cancelled. In "agreement"
+    selection every candidate runs to completion or its timeout and the most agreed-upon result wins.
+    """
+    selection = selection or get_candidate_selection()
+    candidate_queries = [CandidateQuery(sql_query, database_url, get_candidate_timeout_seconds())
+                         for sql_query in distinct_sql_queries(sql_queries)]
+    if not candidate_queries:
+        return None, None
+
+    def run_candidate(candidate_number, candidate_query):
+        with span("candidate_sql", candidate=candidate_number):
+            return candidate_query.run(schema_df)
+
+    successes = []
+    executor = ThreadPoolExecutor(max_workers=len(candidate_queries))
+    try:
+        futures = {executor.submit(contextvars.copy_context().run, run_candidate, candidate_number, candidate_query):
+                   candidate_number for candidate_number, candidate_query in enumerate(candidate_queries)}
+        for future in as_completed(futures):
+            candidate_number = futures[future]
+            try:
+                sql_answer_df = future.result()
+            except SQLExecutionError as e:
+                event_publisher.emit(f"candidate_exception_{candidate_number}_set", e.original_exception)
+                continue
+            successes.append((candidate_number, candidate_queries[candidate_number].sql, sql_answer_df))
+            if selection == "first":
+                for candidate_query in candidate_queries:
+                    if candidate_query is not candidate_queries[candidate_number]:
+                        candidate_query.cancel()
+                break
+    finally:
+        # Cancelled candidates wind down in the background instead of holding up the answer
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if not successes:
+        return None, None
+    candidate_number, sql_query, sql_answer_df = successes[0] if selection == "first" else choose_agreed_candidate(successes)
+    event_publisher.emit("winning_candidate_set", candidate_number)
+    if sql_answer_df.attrs.get("truncated"):
+        event_publisher.emit("answer_truncated_set", len(sql_answer_df))
+    return sql_answer_df, sql_query
+
+def answer_with_sql_candidates(question, database_url, filtered_schema_and_synonyms_df, schema_df=None,
+                               candidate_count=None):
+    # Returns (greedy_sql_query, answer, answered_sql_query); the greedy query seeds the repair chain if all fail
+    candidate_count = candidate_count or get_sql_candidate_count()
+    sql_queries = generate_sql_candidates(question, filtered_schema_and_synonyms_df, candidate_count)
+    event_publisher.emit("initial_sql_query_set", sql_queries[0])
+    event_publisher.emit("sql_candidates_set", sql_queries)
+    with span("execute_candidates", candidates=candidate_count):
+        answer, answered_sql_query = execute_sql_candidates(sql_queries, database_url, schema_df)
+    return sql_queries[0], answer, answered_sql_query
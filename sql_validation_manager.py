@@ -0,0 +1,317 @@
+import difflib
+import logging
+import re
+from utils import get_env_bool
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[eE]?'(?:[^']|'')*')
+  | (?P<dollar>\$(?P<tag>[A-Za-z_]\w*)?\$.*?\$(?P=tag)?\$)
+  | (?P<quoted>"(?:[^"]|"")+")
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+  | (?P<word>[A-Za-z_][\w$]*)
+  | (?P<param>%\(\w+\)s|%s|\$\d+)
+  | (?P<op>::|<>|!=|<=|>=|\|\||[(),.;*+\-/<>=%^~!@#&|\[\]:?])
+""", re.S | re.X)
+
+# Words that can appear where a column name could, but never name one in generated queries
+SQL_KEYWORDS = {
+    "all", "and", "any", "array", "as", "asc", "at", "between", "both", "by", "case", "cast", "collate", "cross",
+    "current", "current_date", "current_time", "current_timestamp", "current_user", "date", "day", "default",
+    "desc", "distinct", "dow", "doy", "else", "end", "epoch", "escape", "except", "exists", "false", "fetch",
+    "filter", "first", "following", "for", "from", "full", "group", "having", "hour", "ilike", "in", "inner",
+    "intersect", "interval", "into", "is", "isnull", "join", "last", "lateral", "leading", "left", "like", "limit",
+    "localtime", "localtimestamp", "minute", "month", "natural", "next", "not", "notnull", "null", "nulls",
+    "offset", "on", "only", "or", "order", "outer", "over", "partition", "precision", "preceding", "quarter",
+    "range", "recursive", "right", "row", "rows", "second", "select", "similar", "some", "symmetric", "then",
+    "ties", "time", "timestamp", "to", "trailing", "true", "unbounded", "union", "unknown", "using", "values",
+    "varying", "week", "when", "where", "window", "with", "within", "without", "year", "zone",
+}
+
+# Keywords that end a FROM list at the same nesting level
+FROM_LIST_TERMINATORS = {
+    "where", "group", "having", "order", "limit", "offset", "union", "intersect", "except", "window", "fetch",
+    "for", "on", "using", "join", "inner", "left", "right", "full", "cross", "natural", "returning",
+}
+
+class SQLReferences:
+    def __init__(self):
+        # Maps each FROM-clause alias (or bare table name) to the table name and whether it was quoted
+        self.aliases = {}
+        self.cte_names = set()
+        self.derived_aliases = set()
+        self.output_aliases = set()
+        self.has_unknown_source = False
+        self.column_references = []
+
+def tokenize_sql(sql):
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(sql):
+        kind = match.lastgroup
+        value = match.group(0)
+        if kind in ("space", "comment"):
+            continue
+        if kind == "word":
+            tokens.append(("name", value.lower(), False))
+        elif kind == "quoted":
+            tokens.append(("name", value[1:-1].replace('""', '"'), True))
+        elif kind == "dollar":
+            tokens.append(("string", value, False))
+        else:
+            tokens.append((kind, value.lower() if kind == "op" else value, False))
+    return tokens
+
+def is_keyword(token):
+    return token[0] == "name" and not token[2] and token[1] in SQL_KEYWORDS
+
+def read_name(tokens, position):
+    # Reads a dotted name such as film.title or public.film and returns (parts, quoted flags, next position)
+    parts, quoted = [tokens[position][1]], [tokens[position][2]]
+    position += 1
+    while (position + 1 < len(tokens) and tokens[position] == ("op", ".", False)
+           and tokens[position + 1][0] == "name"):
+        parts.append(tokens[position + 1][1])
+        quoted.append(tokens[position + 1][2])
+        position += 2
+    return parts, quoted, position
+
+def find_cte_names(tokens):
+    # CTE names are followed by AS and a parenthesised query, optionally after a column list
+    cte_names = set()
+    for position, token in enumerate(tokens):
+        if token[0] != "name" or is_keyword(token):
+            continue
+        after_name = position + 1
+        if after_name < len(tokens) and tokens[after_name] == ("op", "(", False):
+            depth = 0
+            while after_name < len(tokens):
+                if tokens[after_name] == ("op", "(", False):
+                    depth += 1
+                elif tokens[after_name] == ("op", ")", False):
+                    depth -= 1
+                    if depth == 0:
+                        break
+                after_name += 1
+            after_name += 1
+        if (after_name + 2 < len(tokens) and tokens[after_name][1] == "as" and tokens[after_name + 1][1] == "("
+                and tokens[after_name + 2][1] in ("select", "with", "values")):
+            cte_names.add(token[1])
+    return cte_names
+
+def parse_sql_references(sql):
+    tokens = tokenize_sql(sql)
+    references = SQLReferences()
+    references.cte_names = find_cte_names(tokens)
+
+    # Each open parenthesis is a subquery, a derived table in a FROM list, or part of an expression
+    paren_stack = []
+    from_list_depths = set()
+
+    def token_at(position):
+        return tokens[position] if 0 <= position < len(tokens) else (None, None, False)
+
+    def at_clause_level():
+        return not paren_stack or paren_stack[-1] in ("subquery", "from_subquery")
+
+    def read_alias(position):
+        if token_at(position)[1] == "as" and not token_at(position)[2]:
+            position += 1
+        if token_at(position)[0] == "name" and not is_keyword(token_at(position)):
+            return token_at(position)[1], position + 1
+        return None, position
+
+    def read_table_source(position):
+        if token_at(position)[1] in ("lateral", "only") and not token_at(position)[2]:
+            position += 1
+        if token_at(position)[0] != "name":
+            # Derived tables are handled when their parenthesis opens and closes
+            return position
+
+        parts, quoted_parts, position = read_name(tokens, position)
+        if token_at(position) == ("op", "(", False):
+            references.has_unknown_source = True
+            return position
+        alias, position = read_alias(position)
+
+        if len(parts) == 1 and parts[0] in references.cte_names:
+            references.derived_aliases.update(name for name in (parts[0], alias) if name)
+        elif len(parts) > 1 and parts[-2].lower() != "public":
+            # Tables outside the loaded schema cannot be checked
+            references.has_unknown_source = True
+            references.derived_aliases.update(name for name in (parts[-1], alias) if name)
+        else:
+            references.aliases[alias or parts[-1]] = (parts[-1], quoted_parts[-1])
+        return position
+
+    position = 0
+    while position < len(tokens):
+        kind, value, quoted = token = tokens[position]
+        previous = token_at(position - 1)
+
+        if token == ("op", "(", False):
+            if token_at(position + 1)[1] in ("select", "with", "values"):
+                opens_derived_table = previous[1] in ("from", "join", "lateral") or (
+                    previous == ("op", ",", False) and len(paren_stack) in from_list_depths)
+                paren_stack.append("from_subquery" if opens_derived_table else "subquery")
+            else:
+                paren_stack.append("expression")
+            position += 1
+            continue
+
+        if token == ("op", ")", False):
+            closed = paren_stack.pop() if paren_stack else None
+            from_list_depths.discard(len(paren_stack) + 1)
+            position += 1
+            if closed == "from_subquery":
+                alias, position = read_alias(position)
+                if alias:
+                    references.derived_aliases.add(alias)
+            continue
+
+        if kind == "name" and not quoted and value in ("from", "join") and at_clause_level():
+            # IS [NOT] DISTINCT FROM compares values rather than naming a table
+            if value == "join" or previous[1] != "distinct":
+                if value == "from":
+                    from_list_depths.add(len(paren_stack))
+                else:
+                    from_list_depths.discard(len(paren_stack))
+                position = read_table_source(position + 1)
+                continue
+
+        if token == ("op", ",", False) and len(paren_stack) in from_list_depths:
+            position = read_table_source(position + 1)
+            continue
+
+        if kind == "name" and not quoted and value in FROM_LIST_TERMINATORS:
+            from_list_depths.discard(len(paren_stack))
+
+        if kind == "name" and not is_keyword(token):
+            parts, quoted_parts, next_position = read_name(tokens, position)
+
+            if token_at(next_position)[1] == "." and token_at(next_position + 1)[1] == "*":
+                references.column_references.append((parts + ["*"], quoted_parts + [False]))
+                position = next_position + 2
+                continue
+
+            function_name = token_at(position - 2) if previous == ("op", "(", False) else (None, None, False)
+            if (previous[1] in ("over", "collate") and not previous[2]
+                    or function_name[1] in ("extract", "over") and not function_name[2]
+                    or token_at(next_position)[1] == "as" and token_at(next_position + 1) == ("op", "(", False)):
+                # EXTRACT fields, window names (after OVER and in WINDOW w AS (...)), collations and CTE names
+                position = next_position
+                continue
+
+            if previous[1] == "as" and not previous[2]:
+                references.output_aliases.add(value)
+            elif len(parts) == 1 and (previous == ("op", ")", False) or previous[1] == "end" and not previous[2]
+                                      or previous[0] in ("name", "number", "string") and not is_keyword(previous)):
+                # An identifier straight after an expression is an alias written without AS
+                references.output_aliases.add(value)
+            elif previous == ("op", "::", False) or token_at(next_position) == ("op", "(", False):
+                # Type casts and function calls
+                pass
+            else:
+                references.column_references.append((parts, quoted_parts))
+            position = next_position
+            continue
+
+        position += 1
+
+    return references
+
+def build_schema_lookup(schema_df):
+    columns_by_table = {}
+    for table_name, column_name in zip(schema_df["table_name"], schema_df["column_name"]):
+        columns_by_table.setdefault(table_name, set()).add(column_name)
+    return columns_by_table
+
+def resolve_name(name, quoted, known_names):
+    if name in known_names:
+        return name
+    if not quoted:
+        # Unquoted identifiers are case-insensitive; stay lenient rather than reject a valid query
+        for known_name in known_names:
+            if known_name.lower() == name:
+                return known_name
+    return None
+
+def describe_candidates(name, candidates):
+    close_matches = difflib.get_close_matches(name, sorted(candidates), n=5, cutoff=0.5)
+    if close_matches:
+        return "HINT: Perhaps you meant " + ", ".join(f'"{candidate}"' for candidate in close_matches) + "."
+    if len(candidates) <= 20:
+        return "HINT: Available names are " + ", ".join(f'"{candidate}"' for candidate in sorted(candidates)) + "."
+    return ""
+
+def validate_sql_against_schema(sql, schema_df):
+    # Returns Postgres-style error messages for references that cannot exist in the schema
+    if not re.match(r"(?is)^\s*(select|with)\b", sql) or ";" in sql.strip().rstrip(";"):
+        return []
+
+    references = parse_sql_references(sql)
+    columns_by_table = build_schema_lookup(schema_df)
+    errors = []
+
+    resolved_tables = {}
+    for alias, (table_name, quoted) in references.aliases.items():
+        resolved_table = resolve_name(table_name, quoted, columns_by_table)
+        if resolved_table is None:
+            errors.append(f'relation "{table_name}" does not exist\n' + describe_candidates(table_name, columns_by_table))
+        else:
+            resolved_tables[alias] = resolved_table
+    if errors:
+        return [error.strip() for error in errors]
+
+    known_qualifiers = set(references.aliases) | references.derived_aliases | references.cte_names
+    scope_columns = set()
+    for table_name in resolved_tables.values():
+        scope_columns |= columns_by_table[table_name]
+    # Unqualified names can only be checked when every source in the query has known columns
+    check_unqualified = resolved_tables and not references.has_unknown_source and not references.derived_aliases
+    known_unqualified_names = (scope_columns | references.output_aliases | set(references.aliases)
+                               | set(resolved_tables.values()))
+
+    for parts, quoted_parts in references.column_references:
+        column_name = parts[-1]
+        if len(parts) >= 2:
+            qualifier, qualifier_quoted = parts[-2], quoted_parts[-2]
+            table_alias = resolve_name(qualifier, qualifier_quoted, resolved_tables)
+            if table_alias is None:
+                if len(parts) == 2 and resolve_name(qualifier, qualifier_quoted, known_qualifiers) is None:
+                    errors.append(f'missing FROM-clause entry for table "{qualifier}"')
+                continue
+            table_name = resolved_tables[table_alias]
+            if column_name != "*" and resolve_name(column_name, quoted_parts[-1], columns_by_table[table_name]) is None:
+                errors.append(f"column {qualifier}.{column_name} does not exist\n"
+                              + describe_candidates(column_name, columns_by_table[table_name]))
+        elif check_unqualified and resolve_name(column_name, quoted_parts[-1], known_unqualified_names) is None:
+            errors.append(f'column "{column_name}" does not exist\n' + describe_candidates(column_name, scope_columns))
+
+    return [error.strip() for error in dict.fromkeys(errors)]
+
+def build_explain_sql(sql):
+    return "EXPLAIN " + sql.strip().rstrip(";")
+
+def explain_sql(sql, database_url):
+    # EXPLAIN plans the query without running it, surfacing type and permission errors as well
+    from execution_manager import run_sql
+    run_sql(build_explain_sql(sql), database_url)
+
+def check_sql_against_schema(sql, schema_df):
+    # Raises on schema errors; returns whether the query should also be planned with EXPLAIN
+    from execution_manager import SQLExecutionError
+    if not get_env_bool("SQL_VALIDATION_ENABLED", True):
+        return False
+
+    if schema_df is not None:
+        errors = validate_sql_against_schema(sql, schema_df)
+        if errors:
+            logging.debug(f"SQL failed schema validation: {errors}")
+            raise SQLExecutionError("\n".join(errors))
+
+    return get_env_bool("SQL_VALIDATION_EXPLAIN", False) and bool(re.match(r"(?is)^\s*(select|with)\b", sql))
+
+def check_sql_before_execution(sql, database_url, schema_df):
+    if check_sql_against_schema(sql, schema_df):
+        explain_sql(sql, database_url)
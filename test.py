@@ -1,9 +1,42 @@
+import asyncio
 import unittest
-from unittest.mock import patch
-from main import main_program
+from unittest.mock import patch, MagicMock, AsyncMock
+from main import main_program, answer_question
 from database_and_synonym_manager import set_database_connection, set_schema, set_API_key
-from execution_manager import run_sql, prompt_on_df
-from global_event_publisher import event_publisher
+from execution_manager import (run_sql, prompt_on_df, prompt_on_directive, create_chat_completion,
+                               get_completion_call_count, reset_completion_call_count, set_completion_backend,
+                               generate_sql_query, run_answer_sql, execute_sql_with_fallback, FallbackBudget,
+                               FallbackBudgetExceeded, parse_error_analysis_sections,
+                               stream_sql, get_answer_result_budget)
+from completion_cache_manager import get_completion_cache, CompletionCache
+from engine_manager import dispose_engine
+from sql_validation_manager import validate_sql_against_schema
+from join_graph_manager import JoinGraph
+from schema_catalog_manager import SchemaCatalog
+from async_pipeline_manager import RequestContext, async_filter_schema_and_synonyms_df, async_answer_from_question_cache
+from data_preparation_manager import identify_rows_using_LLM, create_list_of_df_partitions_limited_by_token_count, render_rows, token_count
+from global_event_publisher import event_publisher, request_event_scope
+from instrumentation_manager import span, get_span_recorder, latency_report
+from schema_format_manager import render_schema
+from profiling_manager import profile_columns, add_value_hints
+from model_registry_manager import get_model_spec
+from data_preparation_manager import calculate_table_token_cap
+from completion_replay_manager import ReplayCompletionBackend
+from benchmark import build_fixture
+from batch_manager import run_batch, answer_batch_question
+from daemon_manager import QuestionServer, ask
+from model_registry_manager import load_encoding
+from result_cache_manager import ResultCache, set_result_cache
+from question_cache_manager import QuestionCache
+from completion_scheduler_manager import CompletionScheduler, set_completion_scheduler
+import threading
+import time
+from speculative_sql_manager import execute_sql_candidates, distinct_sql_queries
+from arrow_result_manager import run_sql_arrow, write_arrow_result
+import importlib.util
+import base64
+import json
+import tempfile
 import pandas as pd
 import ast
 import os
@@ -12,26 +45,13 @@ import csv
 from dotenv import load_dotenv
 
 def sample_data_from_schema(df_schema: pd.DataFrame, database_url: str) -> pd.DataFrame:
-    # Initialize new columns for storing sample values
-    df_schema['sample_value_1'] = None
-    df_schema['sample_value_2'] = None
-    df_schema['sample_value_3'] = None
-
-    for idx, row in df_schema.iterrows():
-        table = row['table_name']
-        column = row['column_name']
-
-        # Create the SQL query to fetch up to 3 sample values
-        sql = f'SELECT "{column}" FROM "{table}" LIMIT 3'
-
-        # Run the query and fetch the results
-        sample_values = run_sql(sql, database_url)
-        
-        # If the query returned results, store them in the new columns
-        if not sample_values.empty:
-            for i, val in enumerate(sample_values[column]):
-                df_schema.at[idx, f'sample_value_{i+1}'] = val
-                
+    # Up to 3 sample values per column, from pg_stats or one sample query per table
+    profile_df = profile_columns(df_schema, database_url)
+    sample_values = dict(zip(zip(profile_df['table_name'], profile_df['column_name']), profile_df['sample_values']))
+    column_values = [sample_values.get(key, []) for key in zip(df_schema['table_name'], df_schema['column_name'])]
+
+    for i in range(3):
+        df_schema[f'sample_value_{i+1}'] = [values[i] if i < len(values) else None for values in column_values]
     return df_schema
 
 def create_question_list(df_schema: pd.DataFrame) -> list:
@@ -103,11 +123,6 @@ class TestMainProgram(unittest.TestCase):
             print(f"Captured event: {event_name}")  # Debugging
             captured_data[event_name] = data
 
-        for event_name in events:
-            def handler(data, event_name=event_name):
-                capture_event(data, event_name)
-            event_publisher.on(event_name, handler)
-
         try:
             with open(csv_file, mode='w', newline='') as f:
                 writer = csv.writer(f)
@@ -120,8 +135,10 @@ class TestMainProgram(unittest.TestCase):
                         mock_print.reset_mock()
                         captured_data.clear()
                         
-                        # Run the program
-                        main_program(question)
+                        # Run the program; the scope's listeners go away with it and the CSV capture runs off the hot path
+                        with request_event_scope(background=True) as publisher:
+                            publisher.on("*_set", capture_event)
+                            main_program(question)
 
                         row_data = [test_case_number, iteration_number, database_name, question]
                         
@@ -134,6 +151,715 @@ class TestMainProgram(unittest.TestCase):
         except Exception as e:
             print(f"An error occurred: {e}")
 
+def mock_completion(content):
+    return MagicMock(choices=[MagicMock(message={'content': content})])
+
+
+class TestIdentifyRowsUsingLLM(unittest.TestCase):
+
+    def setUp(self):
+        reset_completion_call_count()
+        get_completion_cache().clear()
+        self.partitioned_df_list = [
+            pd.DataFrame({"table_name": ["film", "film"], "column_name": ["film_id", "title"]}, index=[0, 1]),
+            pd.DataFrame({"table_name": ["actor", "actor"], "column_name": ["actor_id", "last_name"]}, index=[2, 3]),
+        ]
+
+    @staticmethod
+    def respond(film_reply, actor_replies):
+        # Replies are chosen by partition so the test does not depend on the order of concurrent requests
+        actor_replies = iter(actor_replies)
+
+        def create(**kwargs):
+            prompt = kwargs["messages"][0]["content"]
+            return mock_completion(film_reply if "film_id" in prompt else next(actor_replies))
+        return create
+
+    @patch('openai.ChatCompletion.create')
+    def test_one_completion_per_partition(self, mock_create):
+        mock_create.side_effect = self.respond("[1]", ["[2, 3]"])
+
+        result_df = identify_rows_using_LLM(self.partitioned_df_list, "directive")
+
+        self.assertEqual(get_completion_call_count(), 2)
+        self.assertEqual(list(result_df.index), [1, 2, 3])
+
+    @patch('openai.ChatCompletion.create')
+    def test_malformed_response_reasks_only_that_partition(self, mock_create):
+        mock_create.side_effect = self.respond("[0]", ["The rows are actor_id and last_name.", "[2, 3, 7]"])
+
+        result_df = identify_rows_using_LLM(self.partitioned_df_list, "directive")
+
+        self.assertEqual(get_completion_call_count(), 3)
+        self.assertEqual(list(result_df.index), [0, 2, 3])
+
+class TestCompletionCache(unittest.TestCase):
+
+    def setUp(self):
+        reset_completion_call_count()
+        get_completion_cache().clear()
+
+    @patch('openai.ChatCompletion.create')
+    def test_repeated_prompt_is_served_from_cache(self, mock_create):
+        mock_create.return_value = mock_completion("SELECT 1")
+        messages = [{"role": "user", "content": "How many films are there?"}]
+
+        responses = [prompt_on_directive(messages) for _ in range(3)]
+
+        self.assertEqual(responses, ["SELECT 1"] * 3)
+        self.assertEqual(get_completion_call_count(), 1)
+        self.assertEqual(get_completion_cache().stats()["hits"], 2)
+
+    @patch('openai.ChatCompletion.create')
+    def test_bypass_sends_every_request(self, mock_create):
+        mock_create.return_value = mock_completion("SELECT 1")
+        messages = [{"role": "user", "content": "How many films are there?"}]
+
+        for _ in range(2):
+            create_chat_completion(messages, use_cache=False)
+
+        self.assertEqual(get_completion_call_count(), 2)
+
+    def test_file_tier_is_trimmed_while_running(self):
+        with tempfile.TemporaryDirectory() as directory:
+            completion_cache = CompletionCache(file_path=os.path.join(directory, "cache.db"), max_file_entries=5)
+            for number in range(12):
+                completion_cache.set(f"key-{number}", "SELECT 1")
+            row_count = completion_cache._connection.execute("SELECT count(*) FROM completions").fetchone()[0]
+
+            completion_cache.max_age_seconds = 0.05
+            time.sleep(0.1)
+            completion_cache.set("fresh-key", "SELECT 2")
+            keys = [row[0] for row in completion_cache._connection.execute("SELECT key FROM completions")]
+            completion_cache._connection.close()
+
+        self.assertEqual(row_count, 5)
+        self.assertEqual(keys, ["fresh-key"])
+
+class TestQuestionCache(unittest.TestCase):
+
+    database_url = "postgresql://localhost/test"
+
+    def test_substitutes_changed_literals(self):
+        question_cache = QuestionCache()
+        question_cache.store(self.database_url, "v1", "Which films are longer than 100 minutes?",
+                             "SELECT title FROM film WHERE length > 100")
+        question_cache.store(self.database_url, "v1", "How many rentals were there in 2005?",
+                             "SELECT count(*) FROM rental WHERE EXTRACT(YEAR FROM rental_date) = 2005")
+
+        self.assertEqual(question_cache.lookup(self.database_url, "v1", "Which films are longer than 120 minutes?"),
+                         "SELECT title FROM film WHERE length > 120")
+        self.assertEqual(question_cache.lookup(self.database_url, "v1", "how many rentals were there in 2006"),
+                         "SELECT count(*) FROM rental WHERE EXTRACT(YEAR FROM rental_date) = 2006")
+
+    def test_does_not_substitute_ambiguous_literals(self):
+        question_cache = QuestionCache()
+        question_cache.store(self.database_url, "v1", "Which films are longer than 100 minutes?",
+                             "SELECT title FROM film WHERE length > 100 AND replacement_cost < 100")
+
+        self.assertIsNone(question_cache.lookup(self.database_url, "v1", "Which films are longer than 120 minutes?"))
+        self.assertEqual(question_cache.lookup(self.database_url, "v1", "Which films are longer than 100 minutes?"),
+                         "SELECT title FROM film WHERE length > 100 AND replacement_cost < 100")
+
+    def test_reuses_similar_questions_above_the_threshold(self):
+        sql_query = "SELECT category_id, count(*) FROM film_category GROUP BY category_id"
+        exact_cache, similar_cache = QuestionCache(), QuestionCache(similarity_threshold=0.8)
+        for question_cache in (exact_cache, similar_cache):
+            question_cache.store(self.database_url, "v1", "How many films are in each category?", sql_query)
+
+        self.assertIsNone(exact_cache.lookup(self.database_url, "v1", "How many films are there in each category?"))
+        self.assertEqual(similar_cache.lookup(self.database_url, "v1", "How many films are there in each category?"),
+                         sql_query)
+        self.assertIsNone(similar_cache.lookup(self.database_url, "v1", "Which actors have the longest last names?"))
+
+    def test_schema_change_invalidates_entries(self):
+        question_cache = QuestionCache()
+        question_cache.store(self.database_url, "v1", "How many films are there?", "SELECT count(*) FROM film")
+
+        self.assertIsNone(question_cache.lookup(self.database_url, "v2", "How many films are there?"))
+        self.assertIsNone(question_cache.lookup(self.database_url, "v1", "How many films are there?"))
+        self.assertEqual(question_cache.stats()["entries"], 0)
+
+class TestErrorAnalysis(unittest.TestCase):
+
+    def test_parses_labelled_sections(self):
+        response = ("SUMMARY: Count films per category.\n**INTENT:** Group films by category.\n"
+                    "ERROR: The column does not exist.\nSCHEMA CHANGES: Join film_category.\n"
+                    "STEPS:\n1. Join film_category.\n2. Group by category_id.\n"
+                    "SQL:\n```sql\nSELECT category_id, count(*) FROM film_category GROUP BY category_id;\n```")
+
+        self.assertEqual(parse_error_analysis_sections(response), [
+            "Count films per category.", "Group films by category.", "The column does not exist.",
+            "Join film_category.", "1. Join film_category.\n2. Group by category_id.",
+            "SELECT category_id, count(*) FROM film_category GROUP BY category_id;"])
+
+    def test_parses_replies_with_missing_sections(self):
+        self.assertEqual(parse_error_analysis_sections("ERROR: Typo in the column.\nSQL: SELECT title FROM film"),
+                         ["", "", "Typo in the column.", "", "", "SELECT title FROM film"])
+        # A reply without any labels is taken as the SQL itself
+        self.assertEqual(parse_error_analysis_sections("SELECT title FROM film"), ["", "", "", "", "", "SELECT title FROM film"])
+        self.assertEqual(parse_error_analysis_sections("SUMMARY: Films.")[-1], "")
+
+    def test_budget_limits_time_and_tokens(self):
+        time_budget = FallbackBudget(max_seconds=5)
+        time_budget.check()
+        time_budget.started_at -= 6
+        with self.assertRaises(FallbackBudgetExceeded):
+            time_budget.check()
+
+        token_budget = FallbackBudget(max_tokens=100)
+        token_budget.charge(90)
+        token_budget.check(10)
+        with self.assertRaises(FallbackBudgetExceeded):
+            token_budget.check(11)
+        token_budget.charge(20)
+        with self.assertRaises(FallbackBudgetExceeded):
+            token_budget.check()
+
+class TestValidateSqlAgainstSchema(unittest.TestCase):
+
+    schema_df = pd.DataFrame({
+        "table_name": ["film", "film", "film", "actor", "actor", "film_actor", "film_actor"],
+        "column_name": ["film_id", "title", "last_update", "actor_id", "last_name", "actor_id", "film_id"],
+    })
+
+    def test_reports_missing_columns_and_relations(self):
+        self.assertTrue(validate_sql_against_schema(
+            "SELECT title FROM film JOIN actor ON film.film_id = actor.film_id", self.schema_df)[0].startswith(
+            "column actor.film_id does not exist"))
+        self.assertTrue(validate_sql_against_schema(
+            "SELECT category, COUNT(*) AS frequency FROM film GROUP BY category", self.schema_df)[0].startswith(
+            'column "category" does not exist'))
+        self.assertTrue(validate_sql_against_schema("SELECT * FROM films", self.schema_df)[0].startswith(
+            'relation "films" does not exist'))
+        self.assertTrue(validate_sql_against_schema(
+            "SELECT EXTRACT(YEAR FROM release_date) FROM film", self.schema_df)[0].startswith(
+            'column "release_date" does not exist'))
+        self.assertTrue(validate_sql_against_schema(
+            "SELECT rank() OVER (ORDER BY rating) FROM film", self.schema_df)[0].startswith(
+            'column "rating" does not exist'))
+
+    def test_accepts_valid_queries(self):
+        valid_queries = [
+            "SELECT f.title, COUNT(*) AS actor_count FROM film f JOIN film_actor fa ON fa.film_id = f.film_id "
+            "GROUP BY f.title ORDER BY actor_count DESC;",
+            "WITH counts AS (SELECT film_id, count(*) n FROM film_actor GROUP BY film_id) "
+            "SELECT title, counts.n FROM film JOIN counts ON counts.film_id = film.film_id",
+            "SELECT last_name FROM actor WHERE actor_id IN (SELECT actor_id FROM film_actor WHERE film_id = 1)",
+            "SELECT EXTRACT(ISODOW FROM last_update), EXTRACT(decade FROM last_update) FROM film",
+            "SELECT EXTRACT(ISOYEAR FROM last_update), EXTRACT(CENTURY FROM last_update), "
+            "EXTRACT(MICROSECONDS FROM last_update), EXTRACT(MILLENNIUM FROM last_update) FROM film",
+            "SELECT title, rank() OVER w, sum(film_id) OVER (w ROWS UNBOUNDED PRECEDING) FROM film "
+            "WINDOW w AS (ORDER BY film_id), w2 AS (PARTITION BY title)",
+            'SELECT title FROM film ORDER BY title COLLATE "C"',
+            'SELECT title COLLATE pg_catalog."C" AS sorted_title FROM film',
+        ]
+        for sql in valid_queries:
+            self.assertEqual(validate_sql_against_schema(sql, self.schema_df), [], sql)
+
+class TestCreateListOfDfPartitions(unittest.TestCase):
+
+    def test_partitions_are_ordered_slices_within_token_cap(self):
+        schema_df = pd.DataFrame({
+            "table_name": [f"table_{i // 5}" for i in range(60)],
+            "column_name": [f"column_{i}" for i in range(60)],
+            "data_type": ["integer", "character varying", "text"] * 20,
+            "synonym_list": [None if i % 2 else f"synonym {i}" for i in range(60)],
+        }, index=range(100, 160))
+        table_token_cap = 80
+
+        partitioned_df_list = create_list_of_df_partitions_limited_by_token_count(schema_df, table_token_cap)
+
+        self.assertGreater(len(partitioned_df_list), 1)
+        pd.testing.assert_frame_equal(pd.concat(partitioned_df_list), schema_df)
+        for df in partitioned_df_list:
+            self.assertLessEqual(token_count(df), table_token_cap)
+
+    def test_compact_schema_groups_rows_by_table(self):
+        schema_df = pd.DataFrame({
+            "table_name": [f"table_{i // 5}" for i in range(60)],
+            "column_name": [f"column_{i}" for i in range(60)],
+            "data_type": ["integer", "character varying", "text"] * 20,
+            "synonym_list": [None if i % 2 else f"synonym {i}" for i in range(60)],
+        }, index=range(100, 160))
+
+        compact_schema = render_schema(schema_df)
+        with patch.dict(os.environ, {"SCHEMA_PROMPT_FORMAT": "table"}):
+            table_schema = render_schema(schema_df)
+
+        self.assertEqual(table_schema, schema_df.to_string())
+        self.assertLess(token_count(compact_schema), token_count(table_schema))
+        self.assertEqual(compact_schema.splitlines()[1], "table_0(100 column_0:integer[synonym 0], 101 column_1:character "
+                         "varying, 102 column_2:text[synonym 2], 103 column_3:integer, 104 column_4:character varying[synonym 4])")
+
+    def test_render_rows_matches_one_row_to_string(self):
+        schema_df = pd.DataFrame({"table_name": ["film", "actor", "actor"], "column_name": ["title", "actor_id", "name"],
+                                  "synonym_list": ["movie name", float("nan"), None]}, index=[8, 12, 15])
+
+        expected = [pd.DataFrame([row]).to_string(header=False, index=True) for _, row in schema_df.iterrows()]
+
+        self.assertEqual(render_rows(schema_df), expected)
+
+class TestModelRegistry(unittest.TestCase):
+
+    def test_token_cap_follows_the_filtering_model(self):
+        directive = "Only return the index numbers of the rows."
+
+        with patch.dict(os.environ, {"FILTER_MODEL": "gpt-3.5-turbo"}):
+            small_cap = calculate_table_token_cap(directive)
+        with patch.dict(os.environ, {"FILTER_MODEL": "gpt-4-32k-0613"}):
+            large_cap = calculate_table_token_cap(directive)
+
+        self.assertEqual(get_model_spec("gpt-4-32k-0613").context_window, 32768)
+        self.assertLess(small_cap, 4096)
+        self.assertGreater(large_cap, 7 * small_cap)
+
+    @patch('openai.ChatCompletion.create')
+    def test_each_stage_uses_its_own_model(self, mock_create):
+        get_completion_cache().clear()
+        mock_create.side_effect = [mock_completion("[0]"), mock_completion("SELECT title FROM film")]
+        schema_df = pd.DataFrame({"table_name": ["film"], "column_name": ["title"], "data_type": ["text"]})
+
+        with patch.dict(os.environ, {"FILTER_MODEL": "gpt-3.5-turbo", "GENERATION_MODEL": "gpt-4"}):
+            identify_rows_using_LLM([schema_df], "directive")
+            generate_sql_query("Which films are there?", schema_df)
+
+        self.assertEqual([call.kwargs["model"] for call in mock_create.call_args_list], ["gpt-3.5-turbo", "gpt-4"])
+
+class TestProfiling(unittest.TestCase):
+
+    def test_samples_each_table_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            schema_df = set_schema(database_url)
+            get_span_recorder().clear()
+            try:
+                profile_df = profile_columns(schema_df, database_url)
+            finally:
+                dispose_engine(database_url)
+
+        sampled_tables = [span.attributes["table"] for span in get_span_recorder().spans() if span.name == "profile_table"]
+        self.assertEqual(sorted(sampled_tables), sorted(schema_df["table_name"].unique()))
+        ratings = profile_df.set_index(["table_name", "column_name"]).loc[("film", "rating"), "sample_values"]
+        self.assertEqual(len(ratings), 3)
+        hinted_df = add_value_hints(schema_df[schema_df["table_name"] == "film"], profile_df)
+        self.assertEqual(hinted_df.loc[hinted_df["column_name"] == "rating", "sample_values"].iloc[0], "|".join(ratings))
+
+class TestSpeculativeSql(unittest.TestCase):
+
+    def test_skips_failing_candidates_and_picks_agreed_result(self):
+        sql_queries = ["SELECT titel FROM film", "SELECT title FROM film WHERE film_id <= 2",
+                       "SELECT f.title FROM film f WHERE f.film_id < 3", "SELECT title FROM film WHERE film_id = 1"]
+        exceptions = []
+        unsubscribe = event_publisher.on("candidate_exception_*_set", lambda data, event_name: exceptions.append(event_name))
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            try:
+                try:
+                    answer, sql_query = execute_sql_candidates(sql_queries, database_url, selection="agreement")
+                finally:
+                    unsubscribe()
+                # In first mode the winner may finish before the failing candidate, whose error is then never seen
+                first_answer, _ = execute_sql_candidates(sql_queries[:2], database_url, selection="first")
+            finally:
+                dispose_engine(database_url)
+
+        self.assertEqual(sql_query, sql_queries[1])
+        self.assertEqual(len(answer), 2)
+        self.assertEqual(len(first_answer), 2)
+        self.assertEqual(exceptions, ["candidate_exception_0_set"])
+
+    def test_distinct_candidates_keep_literal_case(self):
+        sql_queries = ["SELECT title FROM film WHERE rating = 'PG'", "select title\nfrom film where rating = 'PG';",
+                       "SELECT title FROM film WHERE rating = 'pg'", None]
+
+        self.assertEqual(distinct_sql_queries(sql_queries), [sql_queries[0], sql_queries[2]])
+
+class TestResultStream(unittest.TestCase):
+
+    def stream_to_dataframe(self, environment, sql="SELECT value FROM numbers ORDER BY value"):
+        from sqlalchemy import create_engine
+        engine = create_engine("sqlite://")
+        with engine.connect() as connection:
+            pd.DataFrame({"value": range(100)}).to_sql("numbers", connection, index=False)
+            with patch.dict(os.environ, {"SQL_MAX_ROWS": "", "SQL_MAX_BYTES": "", "SQL_PREVIEW_ROWS": "", **environment}):
+                stream = stream_sql(sql, "sqlite://", chunksize=30, **get_answer_result_budget())
+                sql_answer_df = stream.to_dataframe(connection)
+        engine.dispose()
+        return stream, sql_answer_df
+
+    def test_trims_to_row_and_byte_budgets(self):
+        _, rows_df = self.stream_to_dataframe({"SQL_MAX_ROWS": "45"})
+        # One int64 column takes 8 bytes per row
+        _, bytes_df = self.stream_to_dataframe({"SQL_MAX_BYTES": "400"})
+
+        self.assertEqual(rows_df["value"].tolist(), list(range(45)))
+        self.assertTrue(rows_df.attrs["truncated"])
+        self.assertEqual(bytes_df["value"].tolist(), list(range(50)))
+        self.assertTrue(bytes_df.attrs["truncated"])
+
+    def test_exact_fit_is_not_truncated(self):
+        for environment in ({"SQL_MAX_ROWS": "100"}, {"SQL_MAX_BYTES": "800"}, {"SQL_PREVIEW_ROWS": "100"}):
+            _, sql_answer_df = self.stream_to_dataframe(environment)
+            self.assertEqual(len(sql_answer_df), 100, environment)
+            self.assertFalse(sql_answer_df.attrs["truncated"], environment)
+
+    def test_preview_wraps_query_with_limit(self):
+        stream, sql_answer_df = self.stream_to_dataframe({"SQL_PREVIEW_ROWS": "10"}, "SELECT value FROM numbers;")
+
+        self.assertTrue(stream.sql.endswith("LIMIT 11"))
+        self.assertNotIn(";", stream.sql)
+        self.assertEqual(stream.row_count, 10)
+        self.assertEqual(sql_answer_df["value"].tolist(), list(range(10)))
+        self.assertTrue(sql_answer_df.attrs["truncated"])
+
+@unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+class TestArrowResults(unittest.TestCase):
+
+    def test_fetches_and_writes_arrow_results(self):
+        import pyarrow.parquet as pq
+        import pyarrow as pa
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            try:
+                table = run_sql_arrow("SELECT film_id, title FROM film", database_url)
+                with patch.dict(os.environ, {"SQL_DTYPE_BACKEND": "pyarrow"}):
+                    film_df = run_sql("SELECT title FROM film", database_url)
+            finally:
+                dispose_engine(database_url)
+            parquet_path = os.path.join(directory, "films.parquet")
+            ipc_path = os.path.join(directory, "films.arrow")
+            write_arrow_result(table, parquet_path)
+            write_arrow_result(film_df, ipc_path)
+            parquet_table = pq.read_table(parquet_path)
+            ipc_table = pa.ipc.open_file(ipc_path).read_all()
+
+        self.assertEqual(table.column_names, ["film_id", "title"])
+        self.assertIsInstance(film_df["title"].dtype, pd.ArrowDtype)
+        self.assertTrue(parquet_table.equals(table))
+        self.assertEqual(ipc_table.column("title").to_pylist(), table.column("title").to_pylist())
+
+class TestDaemon(unittest.TestCase):
+
+    def test_answers_questions_over_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            socket_path = os.path.join(directory, "daemon.sock")
+            server = QuestionServer(socket_path, database_url, answer_batch_question)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            set_completion_backend(ReplayCompletionBackend())
+            try:
+                result = ask("Which films are there?", socket_path=socket_path, timeout=30)
+            finally:
+                server.shutdown()
+                server.server_close()
+                set_completion_backend(None)
+                dispose_engine(database_url)
+
+        self.assertIsNone(result["error"])
+        self.assertTrue(result["sql_query"].startswith("SELECT"))
+        self.assertTrue(result["rows"])
+
+    def test_loads_encoding_from_local_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            encoding_path = os.path.join(directory, "cl100k_base.tiktoken")
+            with open(encoding_path, "w") as f:
+                f.write("\n".join(f"{base64.b64encode(bytes([rank])).decode()} {rank}" for rank in range(256)))
+            with patch.dict(os.environ, {"TIKTOKEN_ENCODING_FILE_PATH": encoding_path}):
+                encoding = load_encoding("cl100k_base")
+
+        self.assertEqual(encoding.encode("ab"), [97, 98])
+
+class TestResultCache(unittest.TestCase):
+
+    def tearDown(self):
+        set_result_cache(None)
+
+    def test_reuses_results_until_a_table_changes(self):
+        table_versions = {"film": 1, "actor": 1}
+        result_cache = ResultCache(probe_interval_seconds=0, version_probe=lambda database_url: dict(table_versions))
+        set_result_cache(result_cache)
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            try:
+                first_df = run_answer_sql("SELECT title FROM film WHERE film_id < 3;", database_url)
+                cached_df = run_answer_sql("select title\n  FROM film where film_id < 3", database_url)
+                table_versions["actor"] = 2
+                run_answer_sql("SELECT title FROM film WHERE film_id < 3", database_url)
+                table_versions["film"] = 2
+                run_answer_sql("SELECT title FROM film WHERE film_id < 3", database_url)
+                result_cache.invalidate(database_url, tables=["FILM"])
+                run_answer_sql("SELECT title FROM film WHERE film_id < 3", database_url)
+            finally:
+                dispose_engine(database_url)
+
+        self.assertTrue(cached_df.equals(first_df))
+        self.assertEqual(result_cache.stats()["hits"], 2)
+        self.assertEqual(result_cache.stats()["misses"], 3)
+
+    def test_evicts_least_recently_used_results_by_bytes(self):
+        result_cache = ResultCache(max_bytes=2000, version_probe=lambda database_url: None)
+        for number in range(3):
+            result_cache.set(f"SELECT * FROM t{number}", "sqlite://", pd.DataFrame({"value": range(100)}))
+        result_cache.set("SELECT now()", "sqlite://", pd.DataFrame({"value": [1]}))
+
+        self.assertIsNone(result_cache.get("SELECT * FROM t0", "sqlite://"))
+        self.assertIsNotNone(result_cache.get("SELECT * FROM t2", "sqlite://"))
+        self.assertIsNone(result_cache.get("SELECT now()", "sqlite://"))
+        self.assertLessEqual(result_cache.stats()["bytes"], 2000)
+
+class RateLimitError(Exception):
+
+    def __init__(self, headers):
+        super().__init__("Rate limit reached")
+        self.headers = headers
+
+class TestCompletionScheduler(unittest.TestCase):
+
+    def test_retries_rate_limit_errors_after_retry_after(self):
+        scheduler = CompletionScheduler(base_delay_seconds=0.01)
+        request = MagicMock(side_effect=[RateLimitError({"retry-after": "0.05"}), mock_completion("SELECT 1")])
+
+        completion = scheduler.run(request, [{"role": "user", "content": "Question"}], "gpt-3.5-turbo")
+
+        self.assertEqual(completion.choices[0].message["content"], "SELECT 1")
+        self.assertEqual(request.call_count, 2)
+        self.assertGreater(scheduler.paused_until, 0)
+        with self.assertRaises(ValueError):
+            scheduler.run(MagicMock(side_effect=ValueError("Bad request")), [], "gpt-3.5-turbo")
+
+    @patch('openai.ChatCompletion.create')
+    def test_fallback_gives_up_when_the_model_stays_rate_limited(self, mock_create):
+        mock_create.side_effect = RateLimitError({})
+        set_completion_scheduler(CompletionScheduler(max_retries=1, base_delay_seconds=0.01))
+        get_completion_cache().clear()
+        try:
+            answer = execute_sql_with_fallback("SELECT missing_column FROM missing_table", "sqlite://", "Question?",
+                                               pd.DataFrame({"table_name": ["film"], "column_name": ["film_id"]}))
+        finally:
+            set_completion_scheduler(None)
+
+        self.assertEqual(answer, "Unable to answer.")
+        self.assertEqual(mock_create.call_count, 2)
+
+    def test_waits_stop_at_the_fallback_budget(self):
+        scheduler = CompletionScheduler(max_retries=4)
+        request = MagicMock(side_effect=RateLimitError({"retry-after": "60"}))
+        started_at = time.monotonic()
+
+        with self.assertRaises(FallbackBudgetExceeded):
+            scheduler.run(request, [], "gpt-3.5-turbo", budget=FallbackBudget(max_seconds=0.2))
+        with self.assertRaises(FallbackBudgetExceeded):
+            scheduler.acquire(0, budget=FallbackBudget(max_seconds=0.2))
+
+        self.assertEqual(request.call_count, 1)
+        self.assertLess(time.monotonic() - started_at, 5)
+
+    def test_interactive_requests_go_ahead_of_waiting_batch_requests(self):
+        scheduler = CompletionScheduler(requests_per_minute=600)
+        scheduler.request_bucket.tokens = 0
+        admitted = []
+
+        def acquire(priority):
+            scheduler.acquire(0, priority)
+            admitted.append(priority)
+
+        batch_thread = threading.Thread(target=acquire, args=("batch",))
+        batch_thread.start()
+        time.sleep(0.02)
+        interactive_thread = threading.Thread(target=acquire, args=("interactive",))
+        interactive_thread.start()
+        batch_thread.join(5)
+        interactive_thread.join(5)
+
+        self.assertEqual(admitted, ["interactive", "batch"])
+
+class TestSchemaCatalog(unittest.TestCase):
+
+    def test_invalidate_rereads_schema_despite_snapshot(self):
+        from sqlalchemy import text
+        from engine_manager import get_engine
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            snapshot_path = os.path.join(directory, "schema.pkl")
+            try:
+                schema_catalog = SchemaCatalog(database_url, snapshot_path=snapshot_path, check_interval=3600)
+                self.assertNotIn("review", set(schema_catalog.get_schema_df()["table_name"]))
+                with get_engine(database_url).begin() as connection:
+                    connection.execute(text("CREATE TABLE review (review_id INTEGER PRIMARY KEY, film_id INTEGER)"))
+                schema_catalog.invalidate()
+                schema_df = schema_catalog.get_schema_df()
+                reloaded_catalog = SchemaCatalog(database_url, snapshot_path=snapshot_path, check_interval=3600)
+                reloaded_schema_df = reloaded_catalog.get_schema_df()
+            finally:
+                dispose_engine(database_url)
+
+        self.assertIn("review", set(schema_df["table_name"]))
+        # The re-read schema replaced the old snapshot
+        self.assertIn("review", set(reloaded_schema_df["table_name"]))
+
+class TestJoinGraph(unittest.TestCase):
+
+    def test_finds_join_columns_through_bridge_table(self):
+        schema_df = pd.DataFrame({
+            "table_name": ["film", "film", "film_category", "film_category", "category", "category", "actor"],
+            "column_name": ["film_id", "title", "film_id", "category_id", "category_id", "name", "actor_id"],
+        })
+        foreign_keys_df = pd.DataFrame({
+            "table_name": ["film_category"], "column_name": ["film_id"],
+            "referenced_table_name": ["film"], "referenced_column_name": ["film_id"],
+        })
+        join_graph = JoinGraph(foreign_keys_df, schema_df=schema_df)
+
+        join_columns, unreachable_tables = join_graph.find_join_columns(["film", "category", "actor"])
+
+        self.assertEqual(join_columns, [("film", "film_id"), ("film_category", "film_id"),
+                                        ("film_category", "category_id"), ("category", "category_id")])
+        self.assertEqual(unreachable_tables, ["actor"])
+
+class TestAsyncPipeline(unittest.TestCase):
+
+    def setUp(self):
+        reset_completion_call_count()
+        get_completion_cache().clear()
+
+    @patch('openai.ChatCompletion.acreate', new_callable=AsyncMock)
+    def test_filters_partitions_concurrently(self, mock_acreate):
+        mock_acreate.return_value = mock_completion("[0, 1]")
+        schema_df = pd.DataFrame({"table_name": ["film", "film", "actor"], "column_name": ["film_id", "title", "actor_id"],
+                                  "data_type": ["integer", "text", "integer"]})
+        context = RequestContext("Which films are there?", "postgresql://localhost/test", api_key="test-key")
+
+        filtered_df = asyncio.run(async_filter_schema_and_synonyms_df(context, schema_df))
+
+        self.assertEqual(list(filtered_df["column_name"]), ["film_id", "title"])
+        self.assertEqual(mock_acreate.call_args.kwargs["api_key"], "test-key")
+        self.assertIn("filtered_schema_and_synonyms_set", context.events)
+
+    @patch('async_pipeline_manager.async_run_answer_sql', new_callable=AsyncMock)
+    def test_question_cache_hit_records_answered_sql(self, mock_run_answer_sql):
+        mock_run_answer_sql.return_value = pd.DataFrame({"count": [16]})
+        question_cache = QuestionCache()
+        question_cache.store("postgresql://localhost/test", "v1", "How many categories are there?",
+                             "SELECT count(*) FROM category")
+        context = RequestContext("How many categories are there?", "postgresql://localhost/test", api_key="test-key")
+
+        with patch('async_pipeline_manager.get_question_cache', return_value=question_cache):
+            answer = asyncio.run(async_answer_from_question_cache(context, "v1"))
+
+        self.assertEqual(answer["count"].tolist(), [16])
+        self.assertEqual(context.answered_sql_query, "SELECT count(*) FROM category")
+
+class TestEventPublisher(unittest.TestCase):
+
+    def test_request_scopes_isolate_listeners(self):
+        outer_events = []
+        unsubscribe = event_publisher.on("fallback_*_set", lambda data, event_name: outer_events.append(event_name))
+        try:
+            with request_event_scope(background=True) as publisher:
+                scoped_events = []
+                publisher.on("answer_set", scoped_events.append)
+                event_publisher.emit("fallback_query_1_set", "SELECT 1")
+                event_publisher.emit("answer_set", 42)
+            event_publisher.emit("answer_set", 43)
+        finally:
+            unsubscribe()
+        event_publisher.emit("fallback_query_2_set", "SELECT 2")
+
+        self.assertEqual(scoped_events, [42])
+        self.assertEqual(outer_events, ["fallback_query_1_set"])
+
+    def test_close_delivers_events_emitted_concurrently(self):
+        from global_event_publisher import EventPublisher
+        publisher = EventPublisher(background=True)
+        received = []
+        publisher.on("answer_set", received.append)
+        threads = [threading.Thread(target=lambda: [publisher.emit("answer_set", number) for number in range(200)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        publisher.close()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(received), 800)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        get_completion_cache().clear()
+        get_span_recorder().clear()
+
+    @patch('openai.ChatCompletion.create')
+    def test_spans_roll_up_tokens_and_cache_hits(self, mock_create):
+        mock_create.return_value = mock_completion("SELECT 1")
+        mock_create.return_value.get.return_value = {"prompt_tokens": 100, "completion_tokens": 20}
+        messages = [{"role": "user", "content": "Count the films."}]
+
+        with span("question") as question_span:
+            create_chat_completion(messages)
+            create_chat_completion(messages)
+
+        self.assertEqual(question_span.attributes["llm_calls"], 1)
+        self.assertEqual(question_span.attributes["cache_hits"], 1)
+        self.assertEqual(question_span.attributes["prompt_tokens"], 100)
+        report_df = latency_report()
+        self.assertEqual(report_df.loc["llm_completion", "count"], 2)
+        self.assertEqual(report_df.loc["question", "completion_tokens"], 20)
+
+class TestReplayBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        get_completion_cache().clear()
+
+    def test_replays_question_against_sqlite_fixture(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            backend = ReplayCompletionBackend()
+            set_completion_backend(backend)
+            try:
+                answer = answer_question("How many films are in each category?", database_url)
+            finally:
+                set_completion_backend(None)
+                dispose_engine(database_url)
+
+        self.assertGreater(len(answer), 0)
+        self.assertEqual(backend.replayed, 0)
+        self.assertGreaterEqual(backend.stubbed, 2)
+
+class TestBatch(unittest.TestCase):
+
+    @patch('batch_manager.set_API_key')
+    def test_resumes_after_answered_questions(self, mock_set_API_key):
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = "sqlite:///" + os.path.join(directory, "fixture.db")
+            build_fixture(database_url, 100)
+            questions_path = os.path.join(directory, "questions.csv")
+            output_path = os.path.join(directory, "results.jsonl")
+            with open(questions_path, "w") as f:
+                f.write("id,question\na,Which films are there?\nb,Which actors are there?\nc,Which stores are there?\n")
+            with open(output_path, "w") as f:
+                f.write(json.dumps({"id": "a", "error": None}) + "\n" + json.dumps({"id": "b", "error": "Timeout"}) + "\n")
+            set_completion_backend(ReplayCompletionBackend())
+            try:
+                failed_count = run_batch(questions_path, output_path, database_url=database_url, workers=2)
+            finally:
+                set_completion_backend(None)
+                dispose_engine(database_url)
+            with open(output_path) as f:
+                results = [json.loads(line) for line in f]
+
+        self.assertEqual(failed_count, 0)
+        self.assertEqual(sorted(result["id"] for result in results[2:]), ["b", "c"])
+        self.assertTrue(all(result["sql_query"].startswith("SELECT") for result in results[2:]))
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -1,4 +1,24 @@
+import os
+
 def truncate_content(content, length=500):
     return content[:length] + "..." if len(content) > length else content
 
+def get_env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+def get_env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+def get_env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
 
+def get_env_str_choice(name, default, choices):
+    value = (os.getenv(name) or default).strip().lower()
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}, got '{value}'")
+    return value